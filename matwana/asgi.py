@@ -2,6 +2,8 @@
 ASGI config for matwana project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Run it under an ASGI server (e.g. ``uvicorn matwana.asgi:application``) for
+the live update stream at /api/live/; under WSGI the dashboards poll instead.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
@@ -3,6 +3,7 @@ from pathlib import Path
 from urllib.parse import urlparse
 import dj_database_url
 from dotenv import load_dotenv
+from django.core.exceptions import ImproperlyConfigured
 
 # 1. INITIAL SETUP
 load_dotenv()
@@ -41,6 +42,10 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# Sessions are read on every request (including dashboard polls), so serve
+# them from the cache and only fall back to the database on a miss
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+
 ROOT_URLCONF = 'matwana.urls'
 
 TEMPLATES = [
@@ -69,6 +74,17 @@ if not database_url:
         'default': {
             'ENGINE': 'django.db.backends.sqlite3',
             'NAME': BASE_DIR / 'db.sqlite3',
+            # Take the write lock when a transaction starts so concurrent
+            # bookings queue up instead of failing with "database is locked"
+            'OPTIONS': {
+                'transaction_mode': 'IMMEDIATE',
+                'timeout': 20,
+            },
+            # File-backed test database: the in-memory one cannot be shared
+            # between the threads of the concurrency tests
+            'TEST': {
+                'NAME': BASE_DIR / 'test_db.sqlite3',
+            },
         }
     }
 else:
@@ -115,4 +131,85 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 if not DEBUG:
     SECURE_SSL_REDIRECT = True
     SESSION_COOKIE_SECURE = True
-    CSRF_COOKIE_SECURE = True
\ No newline at end of file
+    CSRF_COOKIE_SECURE = True
+
+# 9. BACKGROUND TASKS (see matwanaapp/tasks.py)
+TASK_WORKERS = int(os.getenv('TASK_WORKERS', '4'))
+# Run tasks inline after commit instead of on the worker pool (tests)
+TASKS_ALWAYS_EAGER = os.getenv('TASKS_ALWAYS_EAGER', '') == '1'
+
+# 10. LIVE UPDATES (see matwanaapp/live.py)
+# Pub/sub behind the /api/live/ event stream; the default only reaches
+# clients connected to the same process
+LIVE_BROKER = os.getenv('LIVE_BROKER', 'matwanaapp.live.LocalBroker')
+
+# 11. NEARBY VEHICLES (see matwanaapp/nearby.py)
+# Serve "matatus near me" from an in-process grid; off means query the database
+NEARBY_INDEX = os.getenv('NEARBY_INDEX', '1') == '1'
+
+# 12. TRANSACTION IDS (see matwanaapp/ids.py)
+# Node number (0-65535) built into payment ids; unset means a hash of the
+# host name. Give each host its own when running several.
+ID_NODE = int(os.environ['ID_NODE']) if os.getenv('ID_NODE') else None
+
+# 13. PAYMENT GATEWAY (see matwanaapp/payments.py)
+# Adapter top-ups are sent through; the default approves everything at once
+PAYMENT_GATEWAY = os.getenv('PAYMENT_GATEWAY', 'matwanaapp.payments.SimulatedGateway')
+# HttpGateway: where to send payments, and where the gateway reports results
+PAYMENT_GATEWAY_URL = os.getenv('PAYMENT_GATEWAY_URL', 'http://127.0.0.1:8765')
+PAYMENT_GATEWAY_TIMEOUT = float(os.getenv('PAYMENT_GATEWAY_TIMEOUT', '10'))
+PAYMENT_CALLBACK_URL = os.getenv('PAYMENT_CALLBACK_URL', 'http://127.0.0.1:8000/api/payments/callback/')
+# Signs result callbacks (HMAC-SHA256 of the body). Shared with the gateway,
+# so never SECRET_KEY; while unset, every callback is refused
+PAYMENT_CALLBACK_SECRET = os.getenv('PAYMENT_CALLBACK_SECRET', '')
+if PAYMENT_GATEWAY.endswith('.HttpGateway') and not PAYMENT_CALLBACK_SECRET:
+    raise ImproperlyConfigured('PAYMENT_CALLBACK_SECRET must be set to use HttpGateway')
+
+# 14. PASSWORD HASHING (see matwanaapp/hashing.py)
+# New hashes use the first hasher; logins rehash passwords stored with any
+# other (or with a different PBKDF2 cost) to it
+PASSWORD_HASHERS = [
+    'matwanaapp.hashing.TunablePBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.Argon2PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+    'django.contrib.auth.hashers.ScryptPasswordHasher',
+]
+PASSWORD_HASH_ITERATIONS = int(os.getenv('PASSWORD_HASH_ITERATIONS', '1000000'))
+# Threads that hash, and how many more logins may wait for one before
+# being turned away (after HASH_QUEUE_TIMEOUT seconds)
+HASH_WORKERS = int(os.getenv('HASH_WORKERS', '4'))
+HASH_QUEUE_LIMIT = int(os.getenv('HASH_QUEUE_LIMIT', '64'))
+HASH_QUEUE_TIMEOUT = float(os.getenv('HASH_QUEUE_TIMEOUT', '5'))
+
+# 15. CACHE
+# Response-cache and search/graph/nearby index versions, unread counts and
+# principal invalidations live here, so every worker process must share it:
+# set CACHE_URL to redis://host:6379/0 or memcached://host:11211. The
+# local-memory fallback is only right for a single development process.
+cache_url = os.getenv('CACHE_URL') or os.getenv('REDIS_URL')
+
+if not cache_url:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+elif urlparse(cache_url).scheme in ('redis', 'rediss'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': cache_url,
+            'KEY_PREFIX': 'matwana',
+        }
+    }
+elif urlparse(cache_url).scheme == 'memcached':
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache',
+            'LOCATION': urlparse(cache_url).netloc,
+            'KEY_PREFIX': 'matwana',
+        }
+    }
+else:
+    raise ImproperlyConfigured(f'Unsupported CACHE_URL scheme: {urlparse(cache_url).scheme}')
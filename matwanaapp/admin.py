@@ -1,11 +1,13 @@
 from django.contrib import admin
-from .models import User, Sacco, Matatu, Route, Trip, PassengerTrip, Payment, Notification
+from .models import User, Sacco, Matatu, Route, Trip, PassengerTrip, Payment, Notification, StatsRollup, TripStatusCount
 
 @admin.register(User)
 class UserAdmin(admin.ModelAdmin):
     list_display = ('phone_number', 'first_name', 'last_name', 'user_type', 'is_verified')
     list_filter = ('user_type', 'is_active', 'is_verified')
     search_fields = ('phone_number', 'id_number', 'email')
+    # Balances move through wallet.py so the ledger stays in step
+    readonly_fields = ('credits',)
 
 @admin.register(Matatu)
 class MatatuAdmin(admin.ModelAdmin):
@@ -27,4 +29,6 @@ class TripAdmin(admin.ModelAdmin):
 admin.site.register(Route)
 admin.site.register(PassengerTrip)
 admin.site.register(Payment)
-admin.site.register(Notification)
\ No newline at end of file
+admin.site.register(Notification)
+admin.site.register(StatsRollup)
+admin.site.register(TripStatusCount)
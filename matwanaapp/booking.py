@@ -0,0 +1,140 @@
+"""Trip booking and cancellation.
+
+A booking debits the passenger's wallet, takes a seat on the trip and writes
+the PassengerTrip and Payment rows in one short transaction. Seats and credit
+are taken with conditional UPDATEs (``booked_seats < capacity`` here,
+``credits >= fare`` in wallet.debit()), so two concurrent requests can never
+both take the last seat or spend the same shillings; the trip row is locked
+first to keep the lock order fixed.
+
+Trip.booked_seats is only ever moved here, with F() expressions. Anything
+that bypasses these paths (admin deletes, raw SQL) is caught by
+``manage.py reconcile_seats``. Those updates send no signals, so every path
+that moves the counter bumps the 'trips' response cache scope itself.
+"""
+from django.db import IntegrityError, transaction
+from django.db.models import F, OuterRef
+from django.utils import timezone
+
+from . import ids, wallet
+from .models import Trip, PassengerTrip, Payment
+from .querysets import count_subquery
+from .response_cache import bump
+
+BOOKABLE_STATUSES = ('scheduled', 'active')
+
+
+class BookingError(Exception):
+    """A booking was refused; the message is safe to show the passenger"""
+
+
+def book_trip(passenger_id, trip_id, route_id=None):
+    """Book a seat on ``trip_id`` for ``passenger_id`` and pay from credits"""
+    try:
+        with transaction.atomic():
+            trip = _lock_trip(trip_id, route_id)
+            fare = trip.route.standard_fare
+
+            if PassengerTrip.objects.filter(passenger_id=passenger_id, trip=trip).exists():
+                raise BookingError('You have already booked this trip')
+
+            taken = Trip.objects.filter(
+                pk=trip.pk, booked_seats__lt=trip.matatu.capacity
+            ).update(booked_seats=F('booked_seats') + 1)
+            if not taken:
+                raise BookingError('This trip is fully booked')
+            bump('trips')
+
+            booking = PassengerTrip.objects.create(
+                passenger_id=passenger_id,
+                trip=trip,
+                boarding_stop=trip.route.start_point,
+                alighting_stop=trip.route.end_point,
+                fare_paid=fare,
+                payment_method='credits',
+                is_paid=True
+            )
+
+            payment = Payment.objects.create(
+                passenger_id=passenger_id,
+                payment_type='trip',
+                amount=fare,
+                transaction_id=ids.transaction_id('trip'),
+                payment_method='credits',
+                status='completed',
+                description=f'Trip booking for {trip.route.name}',
+                completed_at=timezone.now()
+            )
+
+            # Last, so a refusal rolls the rows above back with it
+            if not wallet.debit(passenger_id, fare, 'trip', payment, payment.description):
+                raise BookingError('Insufficient wallet balance')
+    except IntegrityError:
+        # The (passenger, trip) unique constraint lost a race with a retry
+        raise BookingError('You have already booked this trip')
+
+    return booking
+
+
+def _lock_trip(trip_id, route_id):
+    trips = Trip.objects.select_for_update(of=('self',)).select_related('route', 'matatu')
+    if route_id is not None:
+        trips = trips.filter(route_id=route_id)
+
+    try:
+        trip = trips.get(pk=trip_id)
+    except (Trip.DoesNotExist, ValueError, TypeError):
+        raise BookingError('Trip not found')
+
+    if trip.status not in BOOKABLE_STATUSES:
+        raise BookingError('This trip is no longer taking bookings')
+    return trip
+
+
+def cancel_booking(passenger_id, booking_id):
+    """Cancel a booking before departure, free the seat and refund the fare"""
+    with transaction.atomic():
+        try:
+            booking = PassengerTrip.objects.select_related('trip__route').get(
+                pk=booking_id, passenger_id=passenger_id
+            )
+        except (PassengerTrip.DoesNotExist, ValueError, TypeError):
+            raise BookingError('Booking not found')
+
+        trip = _lock_trip(booking.trip_id, None)
+        if trip.status != 'scheduled' or trip.scheduled_departure <= timezone.now():
+            raise BookingError('This trip has already departed')
+
+        booking.delete()
+        Trip.objects.filter(pk=trip.pk, booked_seats__gt=0).update(booked_seats=F('booked_seats') - 1)
+        bump('trips')
+
+        if booking.is_paid and booking.payment_method == 'credits':
+            payment = Payment.objects.create(
+                passenger_id=passenger_id,
+                payment_type='refund',
+                amount=booking.fare_paid,
+                transaction_id=ids.transaction_id('refund'),
+                payment_method='credits',
+                status='completed',
+                description=f'Refund for cancelled booking on {trip.route.name}',
+                completed_at=timezone.now()
+            )
+            wallet.credit(passenger_id, booking.fare_paid, 'refund', payment, payment.description)
+
+    return booking
+
+
+def repair_seat_counts(trips=None):
+    """Reset booked_seats from the bookings table for trips that drifted.
+
+    Returns the (trip id, counter, actual) triples that were repaired.
+    """
+    trips = Trip.objects.all() if trips is None else trips
+    drifted = list(trips.with_seat_drift().values_list('pk', 'booked_seats', 'actual_seats'))
+    if drifted:
+        Trip.objects.filter(pk__in=[pk for pk, _, _ in drifted]).update(
+            booked_seats=count_subquery(PassengerTrip.objects.filter(trip=OuterRef('pk')))
+        )
+        bump('trips')
+    return drifted
@@ -0,0 +1,503 @@
+"""Bulk imports of users, matatus and routes from CSV or XLSX files.
+
+Onboarding a SACCO used to take one admin form post per row, each running
+its own uniqueness checks. run() streams the file instead (csv, or openpyxl
+in read-only mode), so memory stays flat however long it is:
+
+- each unique column is read from the database once, into a set, before the
+  first row; every accepted row adds its keys, so duplicates are caught
+  against the table and earlier rows alike;
+- rows are validated and inserted CHUNK_SIZE at a time with bulk_create, one
+  transaction per chunk, and references (SACCO, driver, conductor) are
+  resolved with one query per chunk;
+- a bad row is reported with its line number and skipped; the rest go in.
+
+A chunk that still hits a unique constraint (a row added since the sets
+were read) is retried row by row so only the clashing rows fail. Anything
+else that goes wrong stops the import with ImportStopped, which carries
+the report so far; the chunks already written stay, and their follow-up
+work (finished()) still runs.
+
+bulk_create sends no signals, so each importer does what the receivers
+would have for the rows it wrote. Users get an unusable password unless
+the file has a password column. Passwords are hashed a chunk at a time,
+one per hashing pool worker in parallel (hashing.make_passwords), and not
+at all on a dry run; a row whose password could not be hashed is reported
+like any other bad row.
+``manage.py import_data`` runs an import from the command line, and
+superadmin/import/ from the browser.
+"""
+from abc import ABC, abstractmethod
+from collections import Counter
+import csv
+from decimal import Decimal, InvalidOperation
+import io
+
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from . import hashing, journeys, live, logins, principal, stats
+from .forms import normalise_phone
+from .models import Matatu, Route, Sacco, User, UserManager
+from .response_cache import bump
+from .route_search import search_document
+
+CHUNK_SIZE = 1000
+
+# Errors kept for the report; the rest are only counted
+MAX_ERRORS = 1000
+
+
+class ImportStopped(Exception):
+    """The import failed part way; ``report`` covers the rows before it"""
+
+    def __init__(self, message, report):
+        super().__init__(message)
+        self.report = report
+
+
+class ImportReport:
+    def __init__(self, kind, dry_run=False):
+        self.kind = kind
+        self.dry_run = dry_run
+        self.rows = 0
+        self.created = 0
+        self.errors = []
+        self.error_count = 0
+
+    def add_error(self, line, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append((line, message))
+
+
+def read_rows(file, filename):
+    """(header, rows) for a CSV or XLSX file; rows yields (line, {column: text})"""
+    name = filename.lower()
+    if name.endswith('.xlsx'):
+        return _xlsx_rows(file)
+    if name.endswith('.csv'):
+        return _csv_rows(file)
+    raise ValueError('Upload a .csv or .xlsx file')
+
+
+def _columns(values):
+    return [str(value or '').strip().lower().replace(' ', '_') for value in values]
+
+
+def _csv_rows(file):
+    reader = csv.reader(io.TextIOWrapper(file, encoding='utf-8-sig', newline=''))
+    header = _columns(next(reader, []))
+
+    def rows():
+        for values in reader:
+            if any(value.strip() for value in values):
+                yield reader.line_num, dict(zip(header, (value.strip() for value in values)))
+    return header, rows()
+
+
+def _text(value):
+    if value is None:
+        return ''
+    # Spreadsheets turn ID and phone numbers into floats
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+
+def _xlsx_rows(file):
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(file, read_only=True, data_only=True)
+    values = workbook.active.iter_rows(values_only=True)
+    header = _columns(next(values, ()))
+
+    def rows():
+        try:
+            for line, row in enumerate(values, start=2):
+                texts = [_text(value) for value in row]
+                if any(texts):
+                    yield line, dict(zip(header, texts))
+        finally:
+            workbook.close()
+    return header, rows()
+
+
+def _required(row, *columns):
+    missing = [column for column in columns if not row.get(column)]
+    if missing:
+        raise ValueError(f'Missing {", ".join(missing)}')
+    return [row[column] for column in columns]
+
+
+def _decimal(value, column):
+    try:
+        number = Decimal(value).quantize(Decimal('0.01'))
+    except InvalidOperation:
+        raise ValueError(f'{column} must be a number')
+    if not number.is_finite() or number <= 0 or number >= 10000:
+        raise ValueError(f'{column} must be between 0 and 10000')
+    return number
+
+
+def _integer(value, column):
+    try:
+        number = int(Decimal(value))
+    except (InvalidOperation, ValueError):
+        raise ValueError(f'{column} must be a whole number')
+    if number <= 0:
+        raise ValueError(f'{column} must be more than 0')
+    return number
+
+
+def _unique_set(model, column):
+    return set(model.objects.values_list(column, flat=True).iterator(chunk_size=10000))
+
+
+class Importer(ABC):
+    model = None
+    columns = ()
+
+    def __init__(self):
+        self.saccos = {}
+        self.created_ids = []
+
+    def prefetch(self):
+        """Read what every row is checked against"""
+        for pk, name, registration_number in Sacco.objects.values_list('pk', 'name', 'registration_number'):
+            self.saccos[name.lower()] = pk
+            self.saccos[registration_number.lower()] = pk
+
+    def sacco(self, value):
+        try:
+            return self.saccos[value.lower()]
+        except KeyError:
+            raise ValueError(f'SACCO "{value}" not found')
+
+    def prepare(self, chunk):
+        """Resolve what the rows of ``chunk`` refer to"""
+
+    @abstractmethod
+    def build(self, row):
+        """An unsaved instance for ``row``; raises ValueError"""
+
+    def claim(self, instance):
+        """Record the unique keys of an accepted row"""
+
+    def release(self, instance):
+        """Undo claim() for a row rejected after all"""
+
+    def complete(self, accepted):
+        """Finish the accepted (line, instance) rows of a chunk before they
+        are written; returns the (line, message) of any that failed"""
+        return []
+
+    def inserted(self, instances):
+        """Side effects of rows written, in their transaction"""
+        self.created_ids.extend(instance.pk for instance in instances)
+
+    def finished(self):
+        """Side effects once everything is written"""
+
+
+class UserImporter(Importer):
+    model = User
+    columns = ('user_type', 'first_name', 'last_name', 'email', 'phone_number', 'id_number')
+
+    def prefetch(self):
+        super().prefetch()
+        self.emails = _unique_set(User, 'email')
+        self.phones = _unique_set(User, 'phone_number')
+        self.id_numbers = _unique_set(User, 'id_number')
+        self.user_types = {value for value, _ in User.USER_TYPES}
+        self.saccos_changed = False
+        self.unusable_password = hashing.make_password(None)
+
+    def build(self, row):
+        user_type, first_name, last_name, email, phone, id_number = _required(row, *self.columns)
+        if user_type not in self.user_types:
+            raise ValueError(f'Unknown user_type "{user_type}"')
+
+        email = UserManager.normalize_email(email)
+        try:
+            validate_email(email)
+        except ValidationError:
+            raise ValueError(f'Invalid email "{email}"')
+        if email in self.emails:
+            raise ValueError(f'Email {email} already registered')
+
+        if phone.strip('+0123456789 -()') or len(normalise_phone(phone)) != 13:
+            raise ValueError(f'Invalid phone number "{phone}"')
+        phone = normalise_phone(phone)
+        if phone in self.phones:
+            raise ValueError(f'Phone number {phone} already registered')
+
+        id_number = ''.join(filter(str.isdigit, id_number))
+        if len(id_number) not in (8, 9):
+            raise ValueError('ID number must be 8 or 9 digits')
+        if id_number in self.id_numbers:
+            raise ValueError(f'ID number {id_number} already registered')
+
+        sacco_id = None
+        if user_type == 'sacco_admin' and row.get('sacco'):
+            sacco_id = self.sacco(row['sacco'])
+
+        user = User(
+            user_type=user_type,
+            first_name=first_name[:255],
+            last_name=last_name[:255],
+            email=email,
+            phone_number=phone,
+            id_number=id_number,
+            password=self.unusable_password,
+            is_verified=True,
+        )
+        user._import_sacco_id = sacco_id
+        user._import_password = row.get('password') or None
+        return user
+
+    def claim(self, user):
+        self.emails.add(user.email)
+        self.phones.add(user.phone_number)
+        self.id_numbers.add(user.id_number)
+
+    def release(self, user):
+        self.emails.discard(user.email)
+        self.phones.discard(user.phone_number)
+        self.id_numbers.discard(user.id_number)
+
+    def complete(self, accepted):
+        with_password = [(line, user) for line, user in accepted if user._import_password]
+        hashes = hashing.make_passwords([user._import_password for _, user in with_password])
+        failed = []
+        for (line, user), encoded in zip(with_password, hashes):
+            if isinstance(encoded, hashing.HashingBusy):
+                failed.append((line, 'Password could not be hashed now; import this row again later'))
+            else:
+                user.password = encoded
+        return failed
+
+    def inserted(self, users):
+        super().inserted(users)
+        # What signals.user_saved does; imported users start without credits,
+        # so there is no opening wallet entry to write
+        first_of_hour = {}
+        for user in users:
+            first_of_hour.setdefault(stats.hour_bucket(user.date_joined), user)
+        hours = Counter(stats.hour_bucket(user.date_joined) for user in users)
+        for hour, user in first_of_hour.items():
+            stats.record_registration(user, delta=hours[hour])
+        for user in users:
+            if user._import_sacco_id:
+                Sacco.objects.filter(pk=user._import_sacco_id).update(admin=user)
+                self.saccos_changed = True
+
+    def finished(self):
+        if self.saccos_changed:
+            bump('notifications')
+        if self.created_ids:
+            # What signals.user_changed does
+            bump('stats')
+            live.stats_changed()
+            principal.forget_all()
+
+
+class MatatuImporter(Importer):
+    model = Matatu
+    columns = ('plate_number', 'fleet_number', 'sacco', 'vehicle_type', 'capacity')
+
+    def prefetch(self):
+        super().prefetch()
+        self.plates = _unique_set(Matatu, 'plate_number')
+        self.fleet_numbers = _unique_set(Matatu, 'fleet_number')
+        self.vehicle_types = {value for value, _ in Matatu.VEHICLE_TYPES}
+        self.crew = {}
+
+    def prepare(self, chunk):
+        # Drivers and conductors by email, phone or ID number: one query per kind
+        lookups = {}
+        for _, row in chunk:
+            for column in ('driver', 'conductor'):
+                lookup = logins.classify(row.get(column))
+                if lookup:
+                    lookups.setdefault(lookup[0], set()).add(lookup[1])
+        self.crew = {}
+        for field, values in lookups.items():
+            users = User.objects.filter(**{f'{field}__in': values}, user_type__in=['driver', 'conductor'])
+            for pk, user_type, value in users.values_list('pk', 'user_type', field):
+                self.crew[field, value] = (pk, user_type)
+
+    def member(self, row, column):
+        if not row.get(column):
+            return None
+        lookup = logins.classify(row[column])
+        pk, user_type = self.crew.get(lookup, (None, None)) if lookup else (None, None)
+        if user_type != column:
+            raise ValueError(f'{column.capitalize()} "{row[column]}" not found')
+        return pk
+
+    def build(self, row):
+        plate_number, fleet_number, sacco, vehicle_type, capacity = _required(row, *self.columns)
+        plate_number = plate_number.upper()
+        if len(plate_number) > 20 or len(fleet_number) > 50:
+            raise ValueError('Plate or fleet number too long')
+        if plate_number in self.plates:
+            raise ValueError(f'Plate number {plate_number} already registered')
+        if fleet_number in self.fleet_numbers:
+            raise ValueError(f'Fleet number {fleet_number} already exists')
+        if vehicle_type not in self.vehicle_types:
+            raise ValueError(f'Unknown vehicle_type "{vehicle_type}"')
+
+        return Matatu(
+            plate_number=plate_number,
+            fleet_number=fleet_number,
+            sacco_id=self.sacco(sacco),
+            vehicle_type=vehicle_type,
+            capacity=_integer(capacity, 'capacity'),
+            current_driver_id=self.member(row, 'driver'),
+            current_conductor_id=self.member(row, 'conductor'),
+            qr_code_data=f'MATATU:{plate_number}:{fleet_number}:{int(timezone.now().timestamp())}',
+        )
+
+    def claim(self, matatu):
+        self.plates.add(matatu.plate_number)
+        self.fleet_numbers.add(matatu.fleet_number)
+
+    def finished(self):
+        if self.created_ids:
+            # What the Matatu receivers do: audiences and principals may move
+            bump('notifications')
+            principal.forget_all()
+
+
+class RouteImporter(Importer):
+    model = Route
+    columns = ('name', 'start_point', 'end_point', 'distance_km', 'estimated_duration_minutes', 'standard_fare', 'sacco')
+
+    def prefetch(self):
+        super().prefetch()
+        self.names = set(Route.objects.values_list('sacco_id', 'name').iterator(chunk_size=10000))
+        self.sacco_names = dict(Sacco.objects.values_list('pk', 'name'))
+
+    def build(self, row):
+        name, start_point, end_point, distance, duration, fare, sacco = _required(row, *self.columns)
+        sacco_id = self.sacco(sacco)
+        if (sacco_id, name) in self.names:
+            raise ValueError(f'Route "{name}" already exists for {self.sacco_names[sacco_id]}')
+
+        route = Route(
+            name=name[:255],
+            start_point=start_point[:255],
+            end_point=end_point[:255],
+            distance_km=_decimal(distance, 'distance_km'),
+            estimated_duration_minutes=_integer(duration, 'estimated_duration_minutes'),
+            standard_fare=_decimal(fare, 'standard_fare'),
+            sacco_id=sacco_id,
+        )
+        # Route.save() fills this in; bulk_create does not call it
+        route.search_text = search_document(route, self.sacco_names[sacco_id])
+        return route
+
+    def claim(self, route):
+        self.names.add((route.sacco_id, route.name))
+
+    def finished(self):
+        if self.created_ids:
+            # Search indexes, stops and the journey graph rebuild
+            bump('routes', journeys.SCOPE)
+
+
+IMPORTERS = {
+    'users': UserImporter,
+    'matatus': MatatuImporter,
+    'routes': RouteImporter,
+}
+
+
+def _chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def run(kind, file, filename, dry_run=False, chunk_size=CHUNK_SIZE):
+    """Import ``file`` as ``kind`` (users, matatus or routes); returns an ImportReport.
+
+    Raises ValueError when the file cannot be read or lacks a column, and
+    ImportStopped when a chunk fails.
+    """
+    importer = IMPORTERS[kind]()
+    report = ImportReport(kind, dry_run)
+    header, rows = read_rows(file, filename)
+    missing = [column for column in importer.columns if column not in header]
+    if missing:
+        raise ValueError(f'Missing column(s): {", ".join(missing)}')
+
+    importer.prefetch()
+    try:
+        for chunk in _chunks(rows, chunk_size):
+            _import_chunk(importer, chunk, report)
+    except Exception as e:
+        raise ImportStopped(f'Stopped after {report.rows} rows: {e}', report) from e
+    finally:
+        # Even after a failure: the chunks written so far need it
+        if importer.created_ids:
+            with transaction.atomic():
+                importer.finished()
+    return report
+
+
+def _import_chunk(importer, chunk, report):
+    importer.prepare(chunk)
+    accepted = []
+    for line, row in chunk:
+        report.rows += 1
+        try:
+            instance = importer.build(row)
+        except ValueError as e:
+            report.add_error(line, str(e))
+            continue
+        importer.claim(instance)
+        accepted.append((line, instance))
+
+    if report.dry_run:
+        report.created += len(accepted)
+        return
+
+    failed = dict(importer.complete(accepted))
+    for line, instance in accepted:
+        if line in failed:
+            importer.release(instance)
+            report.add_error(line, failed[line])
+    accepted = [(line, instance) for line, instance in accepted if line not in failed]
+    if accepted:
+        _insert(importer, accepted, report)
+
+
+def _insert(importer, accepted, report):
+    try:
+        with transaction.atomic():
+            created = importer.model.objects.bulk_create([instance for _, instance in accepted])
+            importer.inserted(created)
+        report.created += len(created)
+        return
+    except IntegrityError:
+        pass
+
+    # Something was added since prefetch(); find the rows it clashes with
+    for line, instance in accepted:
+        try:
+            with transaction.atomic():
+                created = importer.model.objects.bulk_create([instance])
+                importer.inserted(created)
+            report.created += 1
+        except IntegrityError:
+            instance.pk = None
+            report.add_error(line, 'Already exists')
@@ -0,0 +1,212 @@
+"""Trip duration estimates from how long trips actually took.
+
+Completed trips with an actual departure and arrival are binned per route
+and hour of the week (local time) into histograms of one-minute bins. The
+50th, 80th and 95th percentiles of every histogram are stored on
+RouteDurationStats, so serving an estimate is a dictionary lookup in the
+per-process table built from those rows.
+
+refresh() reads only the trips completed since it last ran (a cursor on
+Trip.completed_at, when the status was set, kept REFRESH_LAG behind the
+clock so trips still being committed are not skipped), adds them to the
+affected histograms with NumPy and recomputes those percentiles in one
+pass. The cursor is not on actual_arrival: a trip is often marked completed
+well after it arrived, and would land behind a cursor on its arrival. Run it from cron with
+``manage.py refresh_eta``; ``--rebuild`` starts over from all trips.
+
+An hour with fewer than MIN_SAMPLES trips falls back to the route across all
+hours, and a route without history to Route.estimated_duration_minutes.
+"""
+from datetime import timedelta
+
+import numpy as np
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import ExtractHour, ExtractIsoWeekDay
+from django.utils import timezone
+
+from .models import DurationStatsCursor, RouteDurationStats, Trip
+from .response_cache import bump
+from .route_search import ProcessIndex
+
+SCOPE = 'eta'
+
+# One-minute bins; longer trips count in the last bin
+MAX_MINUTES = 720
+BINS = MAX_MINUTES
+
+PERCENTILES = (0.50, 0.80, 0.95)
+
+MIN_SAMPLES = 5
+
+REFRESH_LAG = timedelta(minutes=5)
+
+ANY_HOUR = RouteDurationStats.ANY_HOUR
+
+
+def hour_of_week(value):
+    local = timezone.localtime(value)
+    return local.weekday() * 24 + local.hour
+
+
+def percentiles(histograms):
+    """Percentile minutes for each row of ``histograms`` (n x BINS counts).
+
+    Interpolates within the bin, so e.g. three trips of 20 minutes give a
+    median of 20.5 (the middle of the 20-21 minute bin).
+    """
+    histograms = np.asarray(histograms, dtype=np.float64)
+    totals = histograms.sum(axis=1)
+    cumulative = np.cumsum(histograms, axis=1)
+    result = np.full((len(histograms), len(PERCENTILES)), np.nan)
+    filled = totals > 0
+
+    for column, q in enumerate(PERCENTILES):
+        target = totals * q
+        # First bin whose running total reaches the target
+        index = (cumulative >= target[:, None]).argmax(axis=1)
+        rows = np.arange(len(histograms))
+        before = cumulative[rows, index] - histograms[rows, index]
+        counts = np.where(histograms[rows, index] > 0, histograms[rows, index], 1)
+        result[:, column] = index + (target - before) / counts
+    result[~filled] = np.nan
+    return result
+
+
+def _completed_trips(start=None, end=None):
+    trips = Trip.objects.filter(
+        status='completed', actual_departure__isnull=False, actual_arrival__isnull=False,
+        actual_arrival__gt=F('actual_departure'),
+    )
+    if start is not None:
+        trips = trips.filter(completed_at__gte=start)
+    if end is not None:
+        trips = trips.filter(completed_at__lt=end)
+    # Weekday and hour in the local time zone, worked out by the database
+    return trips.annotate(
+        iso_weekday=ExtractIsoWeekDay('actual_departure'), departure_hour=ExtractHour('actual_departure'),
+    ).values_list('route_id', 'iso_weekday', 'departure_hour', 'actual_departure', 'actual_arrival')
+
+
+def _histograms_from(rows):
+    """{(route_id, hour_of_week): counts} for the trips in ``rows``"""
+    if not rows:
+        return {}
+
+    route_ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+    hours = np.fromiter(((row[1] - 1) * 24 + row[2] for row in rows), dtype=np.int64, count=len(rows))
+    minutes = np.fromiter(
+        ((row[4] - row[3]).total_seconds() / 60 for row in rows), dtype=np.float64, count=len(rows),
+    )
+    bins = np.minimum(minutes.astype(np.int64), BINS - 1)
+
+    # One row per (route, hour) cell plus one per route for ANY_HOUR
+    cells = np.concatenate([
+        np.stack([route_ids, hours], axis=1),
+        np.stack([route_ids, np.full_like(route_ids, ANY_HOUR)], axis=1),
+    ])
+    keys, cell_index = np.unique(cells, axis=0, return_inverse=True)
+    counts = np.zeros((len(keys), BINS), dtype=np.int64)
+    np.add.at(counts, (cell_index.ravel(), np.concatenate([bins, bins])), 1)
+    return {(int(route_id), int(hour)): counts[n] for n, (route_id, hour) in enumerate(keys)}
+
+
+def _merge(additions, replace=False):
+    """Add histogram counts to the stored cells and recompute their percentiles"""
+    if not additions:
+        return 0
+
+    keys = list(additions)
+    existing = {}
+    if not replace:
+        route_ids = {route_id for route_id, _ in keys}
+        for stats in RouteDurationStats.objects.filter(route_id__in=route_ids):
+            existing[(stats.route_id, stats.hour_of_week)] = stats
+
+    histograms = np.zeros((len(keys), BINS), dtype=np.int64)
+    for n, key in enumerate(keys):
+        histograms[n] = additions[key]
+        if key in existing:
+            histograms[n] += np.frombuffer(existing[key].histogram, dtype=np.int32)
+    values = percentiles(histograms)
+
+    now = timezone.now()
+    created, updated = [], []
+    for n, (route_id, hour) in enumerate(keys):
+        stats = existing.get((route_id, hour)) or RouteDurationStats(route_id=route_id, hour_of_week=hour)
+        stats.updated_at = now
+        stats.samples = int(histograms[n].sum())
+        stats.p50_minutes, stats.p80_minutes, stats.p95_minutes = (round(float(v), 1) for v in values[n])
+        stats.histogram = histograms[n].astype(np.int32).tobytes()
+        (updated if stats.pk else created).append(stats)
+
+    RouteDurationStats.objects.bulk_create(created, batch_size=500)
+    RouteDurationStats.objects.bulk_update(
+        updated, ['samples', 'p50_minutes', 'p80_minutes', 'p95_minutes', 'histogram', 'updated_at'],
+        batch_size=500,
+    )
+    return len(keys)
+
+
+def refresh(now=None):
+    """Fold trips completed since the last refresh into the tables; returns the trip count"""
+    end = (now or timezone.now()) - REFRESH_LAG
+    with transaction.atomic():
+        cursor, _ = DurationStatsCursor.objects.select_for_update().get_or_create(pk=1)
+        if cursor.processed_through is not None and cursor.processed_through >= end:
+            return 0
+        rows = list(_completed_trips(cursor.processed_through, end))
+        _merge(_histograms_from(rows))
+        cursor.processed_through = end
+        cursor.save()
+    if rows:
+        bump(SCOPE)
+    return len(rows)
+
+
+def rebuild(now=None):
+    """Recompute every table from all completed trips; returns the trip count"""
+    end = (now or timezone.now()) - REFRESH_LAG
+    with transaction.atomic():
+        cursor, _ = DurationStatsCursor.objects.select_for_update().get_or_create(pk=1)
+        RouteDurationStats.objects.all().delete()
+        rows = list(_completed_trips(None, end))
+        _merge(_histograms_from(rows), replace=True)
+        cursor.processed_through = end
+        cursor.save()
+    bump(SCOPE)
+    return len(rows)
+
+
+def _build_table():
+    return {
+        (route_id, hour): (p50, p80, p95, samples)
+        for route_id, hour, p50, p80, p95, samples in RouteDurationStats.objects.filter(
+            samples__gte=MIN_SAMPLES
+        ).values_list('route_id', 'hour_of_week', 'p50_minutes', 'p80_minutes', 'p95_minutes', 'samples')
+    }
+
+
+_table = ProcessIndex(SCOPE, _build_table)
+
+
+def estimate(route, departure=None):
+    """Expected duration of a trip on ``route`` leaving at ``departure`` (default now)"""
+    table = _table.get()
+    departure = departure or timezone.now()
+    for key, basis in (((route.pk, hour_of_week(departure)), 'hour'), ((route.pk, ANY_HOUR), 'route')):
+        found = table.get(key)
+        if found is not None:
+            p50, p80, p95, samples = found
+            return {'minutes': p50, 'p80_minutes': p80, 'p95_minutes': p95, 'samples': samples, 'basis': basis}
+
+    minutes = route.estimated_duration_minutes
+    return {'minutes': minutes, 'p80_minutes': minutes, 'p95_minutes': minutes, 'samples': 0, 'basis': 'schedule'}
+
+
+def arrival(trip):
+    """Estimate for ``trip`` plus its expected arrival time"""
+    departure = trip.actual_departure or trip.scheduled_departure
+    result = estimate(trip.route, departure)
+    result['arrival'] = (departure + timedelta(minutes=result['minutes'])).isoformat()
+    return result
@@ -2,7 +2,27 @@ from django import forms
 from django.core.validators import RegexValidator
 from django.core.exceptions import ValidationError
 from .models import User
-from django.contrib.auth.hashers import make_password
+from .hashing import make_password
+
+def normalise_phone(phone):
+    """A Kenyan phone number in the +254XXXXXXXXX form it is stored in"""
+    # 1. Remove all non-digits (keeps just 254740095168)
+    digits = ''.join(filter(str.isdigit, phone))
+    
+    # 2. If it starts with 0, remove it (0740... -> 740...)
+    if digits.startswith('0'):
+        digits = digits[1:]
+    
+    # 3. If it starts with 254 and is long, it's already prefixed
+    if digits.startswith('254') and len(digits) > 9:
+        # Just use the digits as they are, but we'll add the + back
+        clean_digits = digits
+    else:
+        # It's a raw number like 740...
+        clean_digits = f"254{digits}"
+    
+    # 4. Final formatted number for storage
+    return f"+{clean_digits}"
 
 class SignupForm(forms.ModelForm):
     password = forms.CharField(
@@ -84,26 +104,9 @@ class SignupForm(forms.ModelForm):
     # forms.py
 
     def clean_phone_number(self):
-        phone = self.cleaned_data.get('phone_number')
-        # 1. Remove all non-digits (keeps just 254740095168)
-        digits = ''.join(filter(str.isdigit, phone))
-        
-        # 2. If it starts with 0, remove it (0740... -> 740...)
-        if digits.startswith('0'):
-            digits = digits[1:]
-        
-        # 3. If it starts with 254 and is long, it's already prefixed
-        if digits.startswith('254') and len(digits) > 9:
-            # Just use the digits as they are, but we'll add the + back
-            clean_digits = digits
-        else:
-            # It's a raw number like 740...
-            clean_digits = f"254{digits}"
-
-        # 4. Final formatted number for storage
-        formatted_phone = f"+{clean_digits}"
+        formatted_phone = normalise_phone(self.cleaned_data.get('phone_number'))
         
-        # 5. Check uniqueness (VERY IMPORTANT)
+        # Check uniqueness (VERY IMPORTANT)
         # Exclude the current user if this is an update form
         user_exists = User.objects.filter(phone_number=formatted_phone)
         if self.instance.pk:
@@ -0,0 +1,161 @@
+"""Password hashing off the request threads.
+
+PBKDF2 is meant to be slow, and a morning rush of logins would otherwise
+hash on every request thread at once and starve everything else. verify()
+and make_password() run the work on a pool of settings.HASH_WORKERS
+threads (hashlib releases the GIL while it hashes, so they do run in
+parallel). At most HASH_QUEUE_LIMIT more wait behind them. A caller that
+cannot get a place within HASH_QUEUE_TIMEOUT seconds gets HashingBusy,
+which the login view answers with a 503, rather than queueing without
+bound.
+
+New hashes use the first of settings.PASSWORD_HASHERS, by default PBKDF2
+with PASSWORD_HASH_ITERATIONS rounds. verify() reports when a stored hash
+uses another hasher or cost, and the login view then rehashes it in the
+background, so raising the cost migrates users as they sign in.
+
+metrics() gives this process's hash times and queue depth for sizing the
+pool. It is served at superadmin/api/hashing-metrics/, and ``manage.py
+bench_hashing`` measures a burst.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth import hashers
+
+# Hash times kept for the percentiles in metrics()
+SAMPLES = 1000
+
+
+class HashingBusy(Exception):
+    """More passwords are waiting to be hashed than the queue allows"""
+
+
+class TunablePBKDF2PasswordHasher(hashers.PBKDF2PasswordHasher):
+    """PBKDF2-SHA256 with settings.PASSWORD_HASH_ITERATIONS rounds"""
+
+    @property
+    def iterations(self):
+        return settings.PASSWORD_HASH_ITERATIONS
+
+
+class HashPool:
+    def __init__(self, workers, queue_limit, timeout):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='matwana-hash')
+        self.slots = threading.BoundedSemaphore(workers + queue_limit)
+        self.lock = threading.Lock()
+        self.waiting = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.hash_times = deque(maxlen=SAMPLES)
+        self.wait_times = deque(maxlen=SAMPLES)
+
+    def run(self, func, *args):
+        """``func(*args)`` on the pool; raises HashingBusy when the queue stays full"""
+        if not self.slots.acquire(timeout=self.timeout):
+            with self.lock:
+                self.rejected += 1
+            raise HashingBusy('Too many passwords waiting to be hashed')
+
+        submitted = time.perf_counter()
+        with self.lock:
+            self.waiting += 1
+
+        def job():
+            started = time.perf_counter()
+            with self.lock:
+                self.waiting -= 1
+                self.running += 1
+            try:
+                return func(*args)
+            finally:
+                finished = time.perf_counter()
+                with self.lock:
+                    self.running -= 1
+                    self.completed += 1
+                    self.hash_times.append(finished - started)
+                    self.wait_times.append(started - submitted)
+
+        try:
+            return self.executor.submit(job).result()
+        finally:
+            self.slots.release()
+
+    def metrics(self):
+        with self.lock:
+            hash_times = sorted(self.hash_times)
+            wait_times = sorted(self.wait_times)
+            return {
+                'workers': self.workers,
+                'queue_limit': self.queue_limit,
+                'running': self.running,
+                'queue_depth': self.waiting,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'hash_ms': _percentiles(hash_times),
+                'wait_ms': _percentiles(wait_times),
+            }
+
+
+def _percentiles(samples):
+    if not samples:
+        return {'p50': None, 'p95': None, 'max': None}
+
+    def at(share):
+        return round(samples[min(len(samples) - 1, int(len(samples) * share))] * 1000, 2)
+    return {'p50': at(0.5), 'p95': at(0.95), 'max': round(samples[-1] * 1000, 2)}
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = HashPool(settings.HASH_WORKERS, settings.HASH_QUEUE_LIMIT, settings.HASH_QUEUE_TIMEOUT)
+    return _pool
+
+
+def verify(password, encoded):
+    """(valid, outdated): whether ``password`` matches, and whether ``encoded`` wants rehashing"""
+    outdated = []
+    valid = get_pool().run(hashers.check_password, password, encoded, outdated.append)
+    return valid, bool(outdated)
+
+
+def make_password(password):
+    """Hash ``password`` with the preferred hasher (None gives an unusable password)"""
+    if password is None:
+        return hashers.make_password(None)
+    return get_pool().run(hashers.make_password, password)
+
+
+def make_passwords(passwords):
+    """Hash many passwords, one per pool worker at a time (bulk imports).
+
+    Returns, in order, each hash or the HashingBusy it met. Keeping to one
+    per worker leaves the queue to logins.
+    """
+    with ThreadPoolExecutor(max_workers=get_pool().workers) as executor:
+        futures = [executor.submit(make_password, password) for password in passwords]
+    results = []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except HashingBusy as e:
+            results.append(e)
+    return results
+
+
+def metrics():
+    return get_pool().metrics()
@@ -0,0 +1,162 @@
+"""Idempotency keys for POSTs that move money.
+
+A client on a flaky connection cannot tell a lost request from a lost
+response, so it sends an ``Idempotency-Key`` header (any unique string,
+e.g. a UUID per attempted action) and retries with the same key. The first
+request with a key claims an IdempotencyRecord, runs, and stores its
+response in the same transaction as the view's own writes; a retry gets the
+stored response back (marked with an ``Idempotent-Replayed`` header)
+without running the view again. A retry that arrives while the first is
+still running is told so instead of running alongside it.
+
+Keys are per user and kept for TTL; a key reused for a different request
+(other path or body) is refused. A claim whose request died before storing
+anything can be taken over after LOCK_TIMEOUT. Expired rows are removed by
+``manage.py prune_idempotency_keys``.
+"""
+from datetime import timedelta
+from functools import wraps
+import hashlib
+
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse, JsonResponse
+from django.utils import timezone
+
+from .models import IdempotencyRecord
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+
+TTL = timedelta(hours=24)
+
+# A request still unanswered after this long is assumed dead
+LOCK_TIMEOUT = timedelta(minutes=2)
+
+# Hop-by-hop headers (RFC 9110 section 7.6.1) describe one connection, not the
+# response, so they are never stored; Content-Type has its own column
+UNSTORED_HEADERS = {
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailer', 'transfer-encoding', 'upgrade', 'content-type', 'content-length',
+}
+
+
+def _digest(*parts):
+    hasher = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode()
+        hasher.update(len(part).to_bytes(8, 'big'))
+        hasher.update(part)
+    return hasher.hexdigest()
+
+
+def claim(key, fingerprint, now=None):
+    """Claim ``key`` for a new request.
+
+    Returns (True, record) when the caller should run the request, or
+    (False, record) with the record that already holds the key.
+    """
+    now = now or timezone.now()
+    try:
+        with transaction.atomic():
+            record = IdempotencyRecord.objects.create(
+                key=key, fingerprint=fingerprint, created_at=now, expires_at=now + TTL,
+            )
+        return True, record
+    except IntegrityError:
+        pass
+
+    record = IdempotencyRecord.objects.filter(key=key).first()
+    if record is None:
+        # Pruned in between; try once more
+        return claim(key, fingerprint, now)
+
+    expired = record.expires_at <= now
+    abandoned = record.status_code is None and record.created_at <= now - LOCK_TIMEOUT
+    if not (expired or abandoned):
+        return False, record
+
+    # Take the key over, unless another retry just did
+    taken = IdempotencyRecord.objects.filter(pk=record.pk, created_at=record.created_at).update(
+        fingerprint=fingerprint, status_code=None, content_type='', headers=[], body=None,
+        created_at=now, expires_at=now + TTL,
+    )
+    if not taken:
+        return False, IdempotencyRecord.objects.get(pk=record.pk)
+    record.refresh_from_db()
+    return True, record
+
+
+def stored_headers(response):
+    """The headers and cookies of ``response`` worth replaying, as [name, value] pairs"""
+    headers = [[name, value] for name, value in response.items() if name.lower() not in UNSTORED_HEADERS]
+    headers += [['Set-Cookie', morsel.OutputString()] for morsel in response.cookies.values()]
+    return headers
+
+
+def replay(record):
+    response = HttpResponse(bytes(record.body), status=record.status_code, content_type=record.content_type)
+    for name, value in record.headers:
+        if name == 'Set-Cookie':
+            response.cookies.load(value)
+        else:
+            response[name] = value
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def idempotent(view):
+    """Make a session-authenticated POST view safe to retry with an Idempotency-Key"""
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        user_id = request.session.get('user_id')
+        # Without a key (or a user to scope it to) nothing changes
+        if request.method != 'POST' or not key or user_id is None:
+            return view(request, *args, **kwargs)
+
+        if len(key) > MAX_KEY_LENGTH:
+            return JsonResponse({'success': False, 'message': f'{HEADER} is too long'})
+
+        fingerprint = _digest(request.method, request.path, request.body)
+        claimed, record = claim(_digest(str(user_id), key), fingerprint)
+        if not claimed:
+            if record.fingerprint != fingerprint:
+                return JsonResponse({
+                    'success': False,
+                    'message': f'This {HEADER} was already used for a different request'
+                })
+            if record.status_code is None:
+                return JsonResponse({
+                    'success': False,
+                    'message': 'This request is still being processed, please retry shortly'
+                })
+            return replay(record)
+
+        try:
+            with transaction.atomic():
+                response = view(request, *args, **kwargs)
+                if response.streaming or response.status_code >= 500:
+                    # Not worth replaying; let the retry run
+                    IdempotencyRecord.objects.filter(pk=record.pk).delete()
+                else:
+                    # Stored with the view's writes: both happen or neither does
+                    IdempotencyRecord.objects.filter(pk=record.pk).update(
+                        status_code=response.status_code,
+                        content_type=response.get('Content-Type', ''),
+                        headers=stored_headers(response),
+                        body=response.content,
+                    )
+        except Exception:
+            # Free the key so the retry can run
+            IdempotencyRecord.objects.filter(pk=record.pk).delete()
+            raise
+        return response
+
+    return wrapper
+
+
+def prune(now=None):
+    """Delete expired records; returns how many went"""
+    deleted, _ = IdempotencyRecord.objects.filter(expires_at__lte=now or timezone.now()).delete()
+    return deleted
@@ -0,0 +1,115 @@
+"""Per-user notification inbox: read state, unread counts and pages.
+
+Read state is a cursor plus exceptions. InboxState.read_through_id marks
+everything up to that notification id as read, so "mark all read" is one
+row whatever the backlog. A notification opened on its own, above the
+cursor, gets a NotificationRead row. Notifications that predate the
+user's account never count as unread.
+
+Unread counts are cached per user, keyed on the 'notifications' version
+(any notification or audience change) and the user's own inbox version
+(their reads).
+
+Every function takes a User or the request's principal.Principal, so the
+inbox endpoints never load the user row.
+"""
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import BooleanField, Case, Exists, Max, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce
+
+from .models import InboxState, NotificationRead, User
+from .notifications import visible_to
+from .pagination import KeysetPaginator
+from .response_cache import bump, get_versions
+
+PER_PAGE = 20
+UNREAD_TIMEOUT = 300
+
+
+def inbox_scope(user_id):
+    return f'inbox:{user_id}'
+
+
+def _read_condition(user):
+    read_through = Subquery(InboxState.objects.filter(user_id=user.id).values('read_through_id')[:1])
+    joined = Subquery(User.objects.filter(pk=user.id).values('date_joined')[:1])
+    opened = NotificationRead.objects.filter(user_id=user.id, notification=OuterRef('pk'))
+    return (
+        Q(pk__lte=Coalesce(read_through, Value(0))) |
+        Q(created_at__lt=joined) |
+        Q(Exists(opened))
+    )
+
+
+def with_read_state(queryset, user):
+    """Annotate is_read on a Notification queryset (no extra queries)"""
+    return queryset.annotate(is_read=Case(
+        When(_read_condition(user), then=Value(True)),
+        default=Value(False),
+        output_field=BooleanField(),
+    ))
+
+
+def notifications_for(user):
+    """Everything in ``user``'s inbox, with is_read, newest first"""
+    return with_read_state(visible_to(user), user).order_by('-created_at', '-pk')
+
+
+def page(user, cursor=None, per_page=None):
+    """One keyset page of the inbox"""
+    paginator = KeysetPaginator(with_read_state(visible_to(user), user), '-created_at', per_page or PER_PAGE)
+    return paginator.page(cursor)
+
+
+def _count_unread(user):
+    return visible_to(user).exclude(_read_condition(user)).count()
+
+
+def unread_count(user):
+    versions = get_versions(['notifications', inbox_scope(user.id)])
+    key = f'inbox-unread:{user.id}:' + ':'.join(str(v) for v in versions)
+    count = cache.get(key)
+    if count is None:
+        count = _count_unread(user)
+        cache.set(key, count, UNREAD_TIMEOUT)
+    return count
+
+
+def mark_read(user, notification_id):
+    """Mark one notification read; False if it is not in the user's inbox"""
+    if not visible_to(user).filter(pk=notification_id).exists():
+        return False
+    NotificationRead.objects.bulk_create(
+        [NotificationRead(user_id=user.id, notification_id=notification_id)], ignore_conflicts=True
+    )
+    bump(inbox_scope(user.id))
+    return True
+
+
+def mark_all_read(user):
+    """Move the read cursor past everything visible now; returns how many were unread"""
+    with transaction.atomic():
+        unread = _count_unread(user)
+        latest = visible_to(user).aggregate(latest=Max('pk'))['latest'] or 0
+        state, created = InboxState.objects.select_for_update().get_or_create(
+            user_id=user.id, defaults={'read_through_id': latest}
+        )
+        if not created and latest > state.read_through_id:
+            state.read_through_id = latest
+            state.save(update_fields=['read_through_id', 'updated_at'])
+        # Individual reads under the cursor are redundant now
+        NotificationRead.objects.filter(user_id=user.id, notification_id__lte=state.read_through_id).delete()
+    bump(inbox_scope(user.id))
+    return unread
+
+
+def serialize(notification):
+    return {
+        'id': notification.id,
+        'title': notification.title,
+        'message': notification.message,
+        'type': notification.notification_type,
+        'created_at': notification.created_at.isoformat(),
+        'is_read': notification.is_read,
+    }
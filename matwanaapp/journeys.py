@@ -0,0 +1,270 @@
+"""Multi-leg journey planning over the network of active routes.
+
+Stops (normalised start/end points, see route_search.normalise) are the
+nodes and every active Route is a directed edge from its start to its end,
+carrying its duration, distance and fare. The graph lives in memory once
+per process. Route writes are journalled (signals.py) so the graph applies
+just the changed routes; if it missed any changes (another process, a cleared
+cache) it rebuilds from scratch.
+
+plan() returns the k cheapest journeys for the chosen weight with at most
+``max_transfers`` changes of matatu. A reverse Dijkstra from the destination
+gives every stop an exact lower bound on the remaining cost, so the k-best
+search (A* with that bound) only expands stops that can still lead to one
+of the k answers.
+"""
+from collections import deque
+import heapq
+import threading
+
+from django.db import transaction
+
+from .response_cache import bump, get_versions
+from .route_search import normalise
+
+SCOPE = 'route-graph'
+
+WEIGHTS = ('time', 'fare', 'distance')
+
+# Minutes added per change of matatu when optimising for time
+TRANSFER_MINUTES = 10
+
+
+class Edge:
+    __slots__ = ('route_id', 'name', 'origin', 'destination', 'minutes', 'km', 'fare')
+
+    def __init__(self, route_id, name, origin, destination, minutes, km, fare):
+        self.route_id = route_id
+        self.name = name
+        self.origin = origin
+        self.destination = destination
+        self.minutes = minutes
+        self.km = km
+        self.fare = fare
+
+    def weight(self, weight):
+        if weight == 'fare':
+            return self.fare
+        if weight == 'distance':
+            return self.km
+        return self.minutes
+
+
+class RouteGraph:
+    def __init__(self, rows=()):
+        self.edges = {}
+        self.outgoing = {}
+        self.incoming = {}
+        self.names = {}
+        for row in rows:
+            self.add_route(*row)
+
+    def add_route(self, route_id, name, start_point, end_point, minutes, km, fare, is_active=True):
+        """Add or replace the edge for one route (inactive routes are removed)"""
+        self.remove_route(route_id)
+        origin, destination = normalise(start_point), normalise(end_point)
+        if not is_active or not origin or not destination or origin == destination:
+            return
+
+        edge = Edge(route_id, name, origin, destination, minutes, float(km), float(fare))
+        self.edges[route_id] = edge
+        self.outgoing.setdefault(origin, {})[route_id] = edge
+        self.incoming.setdefault(destination, {})[route_id] = edge
+        self.names.setdefault(origin, start_point.strip())
+        self.names.setdefault(destination, end_point.strip())
+
+    def remove_route(self, route_id):
+        edge = self.edges.pop(route_id, None)
+        if edge is not None:
+            del self.outgoing[edge.origin][route_id]
+            del self.incoming[edge.destination][route_id]
+
+    def __contains__(self, stop):
+        return stop in self.outgoing or stop in self.incoming
+
+    def plan(self, origin, destination, k=3, max_transfers=1, weight='time'):
+        """The ``k`` cheapest journeys, each a list of Edges"""
+        origin, destination = normalise(origin), normalise(destination)
+        if origin not in self or destination not in self or origin == destination:
+            return []
+
+        # Only stops within max_legs of the destination can be on a journey,
+        # so the lower bounds are computed over just those
+        max_legs = max_transfers + 1
+        hops = self._hops_to(destination, max_legs)
+        if origin not in hops:
+            return []
+        remaining = self._cost_to(destination, weight, hops)
+
+        penalty = TRANSFER_MINUTES if weight == 'time' else 0
+        journeys = []
+        # A stop is settled at most k times per leg count; any further path
+        # through it cannot be among the k cheapest
+        settled = {}
+        counter = 0
+        queue = [(remaining[origin], 0.0, counter, origin, ())]
+
+        while queue and len(journeys) < k:
+            _, cost, _, stop, legs = heapq.heappop(queue)
+            if stop == destination:
+                journeys.append(list(legs))
+                continue
+
+            state = (stop, len(legs))
+            settled[state] = settled.get(state, 0) + 1
+            if settled[state] > k:
+                continue
+
+            visited = {edge.origin for edge in legs}
+            visited.add(stop)
+            for edge in self.outgoing.get(stop, {}).values():
+                nxt = edge.destination
+                if nxt in visited or nxt not in remaining:
+                    continue
+                if len(legs) + 1 + hops.get(nxt, max_legs + 1) > max_legs:
+                    continue
+                step = edge.weight(weight) + (penalty if legs else 0)
+                counter += 1
+                heapq.heappush(queue, (
+                    cost + step + remaining[nxt], cost + step, counter, nxt, legs + (edge,),
+                ))
+
+        return journeys
+
+    def describe(self, journey):
+        """JSON-ready summary of one journey"""
+        transfers = len(journey) - 1
+        return {
+            'legs': [
+                {
+                    'route_id': edge.route_id,
+                    'route_name': edge.name,
+                    'from': self.names[edge.origin],
+                    'to': self.names[edge.destination],
+                    'duration_minutes': edge.minutes,
+                    'distance_km': edge.km,
+                    'fare': edge.fare,
+                }
+                for edge in journey
+            ],
+            'transfers': transfers,
+            # Riding time plus the usual wait at each change
+            'duration_minutes': sum(edge.minutes for edge in journey) + TRANSFER_MINUTES * transfers,
+            'distance_km': round(sum(edge.km for edge in journey), 2),
+            'fare': round(sum(edge.fare for edge in journey), 2),
+        }
+
+    def _cost_to(self, destination, weight, within):
+        """Cheapest cost from each stop in ``within`` to ``destination`` (reverse Dijkstra)"""
+        best = {destination: 0.0}
+        queue = [(0.0, destination)]
+        while queue:
+            cost, stop = heapq.heappop(queue)
+            if cost > best[stop]:
+                continue
+            for edge in self.incoming.get(stop, {}).values():
+                if edge.origin not in within:
+                    continue
+                candidate = cost + edge.weight(weight)
+                if candidate < best.get(edge.origin, float('inf')):
+                    best[edge.origin] = candidate
+                    heapq.heappush(queue, (candidate, edge.origin))
+        return best
+
+    def _hops_to(self, destination, limit):
+        """Fewest legs from each stop to ``destination``, up to ``limit``"""
+        hops = {destination: 0}
+        queue = deque([destination])
+        while queue:
+            stop = queue.popleft()
+            if hops[stop] == limit:
+                continue
+            for edge in self.incoming.get(stop, {}).values():
+                if edge.origin not in hops:
+                    hops[edge.origin] = hops[stop] + 1
+                    queue.append(edge.origin)
+        return hops
+
+
+ROUTE_FIELDS = (
+    'pk', 'name', 'start_point', 'end_point',
+    'estimated_duration_minutes', 'distance_km', 'standard_fare', 'is_active',
+)
+
+
+class GraphCache:
+    """The per-process graph plus the journal of routes changed since it was built"""
+
+    def __init__(self):
+        self.graph = None
+        self.version = None
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def get(self):
+        version = get_versions([SCOPE])[0]
+        if self.graph is not None and self.version == version:
+            return self.graph
+
+        with self.lock:
+            if self.graph is None or self.version != version:
+                changed = self.pending[:]
+                del self.pending[:len(changed)]
+                # Every local write bumps the version by one; if the version
+                # moved by anything else, some changes are not in the journal
+                if self.graph is not None and version - self.version == len(changed):
+                    self._apply(set(changed))
+                else:
+                    self.graph = self._build()
+                self.version = version
+        return self.graph
+
+    def note_change(self, route_id):
+        # Until a graph exists the next get() builds from scratch anyway
+        if self.graph is not None:
+            self.pending.append(route_id)
+
+    def _build(self):
+        from .models import Route
+
+        return RouteGraph(Route.objects.filter(is_active=True).values_list(*ROUTE_FIELDS))
+
+    def _apply(self, route_ids):
+        from .models import Route
+
+        rows = Route.objects.filter(pk__in=route_ids).values_list(*ROUTE_FIELDS)
+        for pk, *fields in rows:
+            self.graph.add_route(pk, *fields)
+            route_ids.discard(pk)
+        # Whatever is left was deleted
+        for pk in route_ids:
+            self.graph.remove_route(pk)
+
+
+_graph_cache = GraphCache()
+
+
+def get_graph():
+    return _graph_cache.get()
+
+
+def route_changed(route_id):
+    """Journal a Route write for the graph; called from signals.py"""
+    transaction.on_commit(lambda: _graph_cache.note_change(route_id))
+    bump(SCOPE)
+
+
+def resolve_stop(text, role):
+    """Stop name for free text: an exact stop, else the best suggestion"""
+    from .stops import get_stop_index
+
+    if normalise(text) in get_graph():
+        return text
+    suggestions = get_stop_index().suggest(text, role=role, limit=1)
+    return suggestions[0]['name'] if suggestions else None
+
+
+def plan(origin, destination, k=3, max_transfers=1, weight='time'):
+    """JSON-ready journeys from ``origin`` to ``destination``, cheapest first"""
+    graph = get_graph()
+    return [graph.describe(journey) for journey in graph.plan(origin, destination, k, max_transfers, weight)]
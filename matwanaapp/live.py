@@ -0,0 +1,282 @@
+"""Live updates pushed to open dashboards over Server-Sent Events.
+
+Writes publish small events (a booking changed, a trip moved to another
+status, a wallet balance, a new notification) to named channels once they
+commit. The /api/live/ stream (views.live_events, an async view served by
+matwana/asgi.py) subscribes to the channels of the signed-in user and
+forwards whatever arrives, so a tab with nothing happening costs no queries
+at all instead of a poll every 30 seconds.
+
+Channels:
+
+- ``user:<id>``: bookings, wallet, payments and explicit notifications for
+  one user
+- ``notifications:all``, ``notifications:<user_type>``,
+  ``notifications:sacco:<id>``: rule-based notifications (see notifications.py)
+- ``staff``: "the admin stats changed"
+
+The broker is in-process (LocalBroker). Anything with the same publish() and
+subscribe() can be swapped in through settings.LIVE_BROKER, e.g. a stand-in
+that relays between several server processes.
+"""
+import asyncio
+from collections import deque
+import itertools
+import json
+import threading
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from .models import Notification, PassengerTrip, User
+
+# Events kept per channel so a reconnecting client can catch up
+HISTORY = 50
+
+# Undelivered events per connection before it is told to resync instead
+QUEUE_SIZE = 100
+
+RESYNC = (None, 'resync', {})
+
+# Seconds between keep-alive comments on an idle stream
+KEEPALIVE = 25
+
+# How long EventSource waits before reconnecting
+RETRY_MS = 5000
+
+
+class Subscription:
+    """One connection's view of the broker; iterate it from async code"""
+
+    def __init__(self, broker, channels, loop):
+        self.broker = broker
+        self.channels = channels
+        self.loop = loop
+        self.queue = asyncio.Queue(QUEUE_SIZE)
+        self.overflowed = False
+
+    def deliver(self, message):
+        # Runs on the subscriber's event loop (see LocalBroker.publish)
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            # The client missed events; it reloads rather than guess
+            self.overflowed = True
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(RESYNC)
+
+    async def get(self, timeout=None):
+        """Next (id, event, data), or None after ``timeout`` seconds"""
+        try:
+            message = await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        if message is RESYNC:
+            self.overflowed = False
+        return message
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class LocalBroker:
+    """Publish/subscribe between threads of one process"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.subscribers = {}
+        self.history = {}
+        # Newest id per channel that has dropped out of the history
+        self.forgotten = {}
+
+    def publish(self, channel, event, data):
+        """Send an event to everyone on ``channel``; safe from any thread"""
+        with self.lock:
+            message = (next(self.ids), event, data)
+            history = self.history.setdefault(channel, deque(maxlen=HISTORY))
+            if len(history) == HISTORY:
+                self.forgotten[channel] = history[0][0]
+            history.append(message)
+            subscribers = list(self.subscribers.get(channel, ()))
+
+        for subscription in subscribers:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.deliver, message)
+            except RuntimeError:
+                # Its event loop is gone; the connection is dead
+                self.unsubscribe(subscription)
+        return message[0]
+
+    def subscribe(self, channels, last_event_id=None):
+        """Subscribe the running event loop to ``channels``.
+
+        With ``last_event_id`` the events published since are queued first,
+        or a resync if some of them have already dropped out of the history.
+        """
+        subscription = Subscription(self, tuple(channels), asyncio.get_running_loop())
+        with self.lock:
+            for channel in subscription.channels:
+                self.subscribers.setdefault(channel, set()).add(subscription)
+            if last_event_id is not None:
+                self._replay(subscription, last_event_id)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            for channel in subscription.channels:
+                subscribers = self.subscribers.get(channel)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self.subscribers[channel]
+
+    def _replay(self, subscription, last_event_id):
+        missed = []
+        complete = True
+        for channel in subscription.channels:
+            if self.forgotten.get(channel, 0) > last_event_id:
+                complete = False
+            missed.extend(message for message in self.history.get(channel, ()) if message[0] > last_event_id)
+
+        # Ids from before a restart are meaningless here
+        newest = max((history[-1][0] for history in self.history.values() if history), default=0)
+        if not complete or last_event_id > newest:
+            subscription.deliver(RESYNC)
+            return
+        for message in sorted(missed):
+            subscription.deliver(message)
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                _broker = import_string(settings.LIVE_BROKER)()
+    return _broker
+
+
+def publish(channel, event, data):
+    """Publish once the surrounding transaction commits"""
+    transaction.on_commit(lambda: get_broker().publish(channel, event, data))
+
+
+def user_channel(user_id):
+    return f'user:{user_id}'
+
+
+def channels_for(user, sacco_ids=()):
+    """Channels a dashboard for ``user`` listens on"""
+    channels = [
+        user_channel(user.pk),
+        'notifications:all',
+        f'notifications:{user.user_type}',
+    ]
+    channels += [f'notifications:sacco:{sacco_id}' for sacco_id in sacco_ids]
+    if user.user_type == 'super_admin':
+        channels.append('staff')
+    return channels
+
+
+def format_event(message):
+    """Server-Sent Events wire format for one (id, event, data) message"""
+    event_id, event, data = message
+    lines = [] if event_id is None else [f'id: {event_id}']
+    lines.append(f'event: {event}')
+    lines.append('data: ' + json.dumps(data, cls=DjangoJSONEncoder))
+    return '\n'.join(lines) + '\n\n'
+
+
+# What the rest of the app publishes
+
+def booking_changed(booking, deleted=False):
+    publish(user_channel(booking.passenger_id), 'booking', {
+        'id': booking.pk,
+        'trip_id': booking.trip_id,
+        'is_paid': booking.is_paid,
+        'boarded': booking.boarded_at is not None,
+        'alighted': booking.alighted_at is not None,
+        'cancelled': deleted,
+    })
+
+
+def wallet_changed(user_id, balance=None):
+    """Publish a new wallet balance; read after commit when not given"""
+    def send():
+        value = balance
+        if value is None:
+            value = User.objects.filter(pk=user_id).values_list('credits', flat=True).first()
+            if value is None:
+                return
+        get_broker().publish(user_channel(user_id), 'wallet', {'balance': float(value)})
+
+    transaction.on_commit(send)
+
+
+def payment_changed(user_id, transaction_id, status):
+    """A pending payment was settled by the gateway"""
+    publish(user_channel(user_id), 'payment', {'transaction_id': transaction_id, 'status': status})
+
+
+def trip_status_changed(trip_id, old_status, new_status):
+    """Tell every passenger booked on the trip"""
+    def send():
+        broker = get_broker()
+        data = {'trip_id': trip_id, 'old_status': old_status, 'status': new_status}
+        passenger_ids = PassengerTrip.objects.filter(trip_id=trip_id).values_list('passenger_id', flat=True)
+        for passenger_id in passenger_ids:
+            broker.publish(user_channel(passenger_id), 'trip', data)
+
+    transaction.on_commit(send)
+
+
+def stats_changed():
+    publish('staff', 'stats', {})
+
+
+def _notification_data(notification):
+    return {
+        'id': notification.pk,
+        'title': notification.title,
+        'message': notification.message,
+        'type': notification.notification_type,
+    }
+
+
+def notification_created(notification):
+    """Publish a new broadcast or user type notification"""
+    if notification.audience == 'all':
+        publish('notifications:all', 'notification', _notification_data(notification))
+    elif notification.audience == 'user_type':
+        publish(f'notifications:{notification.audience_user_type}', 'notification',
+                _notification_data(notification))
+
+
+def notification_sent_to_saccos(notification, sacco_ids):
+    data = _notification_data(notification)
+    for sacco_id in sacco_ids:
+        publish(f'notifications:sacco:{sacco_id}', 'notification', data)
+
+
+def notification_delivered(notification_id, user_ids):
+    """Publish an explicitly addressed notification to each recipient"""
+    def send():
+        notification = Notification.objects.filter(pk=notification_id, is_active=True).first()
+        if notification is None:
+            return
+        data = _notification_data(notification)
+        broker = get_broker()
+        for user_id in user_ids:
+            broker.publish(user_channel(user_id), 'notification', data)
+
+    transaction.on_commit(send)
@@ -0,0 +1,115 @@
+"""Signing in by email, phone number or ID number.
+
+classify() decides which of the three an identifier is, so a login looks
+the user up on one unique index instead of an OR across all three:
+
+- anything with an @ is an email (domain lowercased, as create_user stores it);
+- 8 or 9 digits is an ID number;
+- otherwise, a +254 / 254 / 07... number with at least 10 digits is a phone
+  number, normalised the way SignupForm stores it.
+
+A bare 9-digit mobile number (712345678) reads as an ID number; phones need
+their leading 0 or country code.
+
+last_login is not worth a full-row save on the login path. record_login()
+queues the time, and the queue is written by a background task as one
+single-column UPDATE for every login that arrived in the meantime.
+rehash_later() moves a password hashed with an older hasher or cost to the
+current one (see hashing.py), also in the background.
+"""
+import threading
+
+from django.db.models import Case, DateTimeField, Value, When
+from django.utils import timezone
+
+from . import hashing, tasks
+from .forms import normalise_phone
+from .models import User, UserManager
+
+# Columns the login view reads
+LOGIN_FIELDS = ('id', 'user_type', 'first_name', 'last_name', 'password')
+
+BATCH_SIZE = 500
+
+
+def classify(identifier):
+    """(field, value) to look ``identifier`` up by, or None if it is none of the three"""
+    identifier = (identifier or '').strip()
+    if '@' in identifier:
+        return 'email', UserManager.normalize_email(identifier)
+
+    if identifier.strip('+0123456789 -()'):
+        return None
+    digits = ''.join(filter(str.isdigit, identifier))
+    if 8 <= len(digits) <= 9 and not identifier.startswith('+'):
+        return 'id_number', digits
+    if len(digits) >= 10:
+        return 'phone_number', normalise_phone(identifier)
+    return None
+
+
+def find_user(identifier):
+    """The user signing in as ``identifier``; raises User.DoesNotExist"""
+    lookup = classify(identifier)
+    if lookup is None:
+        raise User.DoesNotExist
+    field, value = lookup
+    return User.objects.only(*LOGIN_FIELDS).get(**{field: value})
+
+
+class LoginTimes:
+    """Logins waiting for their last_login to be written"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.scheduled = False
+
+    def add(self, user_id, when):
+        """Queue a login; True if a flush needs scheduling"""
+        with self.lock:
+            self.pending[user_id] = when
+            if self.scheduled:
+                return False
+            self.scheduled = True
+            return True
+
+    def drain(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.scheduled = False
+        return pending
+
+
+_login_times = LoginTimes()
+
+
+def record_login(user_id, when=None):
+    """Stamp last_login for ``user_id``, written in the background"""
+    if _login_times.add(user_id, when or timezone.now()):
+        tasks.submit(flush_logins)
+
+
+def flush_logins():
+    """Background task: write the queued last_login times; returns how many"""
+    pending = list(_login_times.drain().items())
+    for start in range(0, len(pending), BATCH_SIZE):
+        chunk = pending[start:start + BATCH_SIZE]
+        # update() sends no signals: a login changes nothing cached
+        User.objects.filter(pk__in=[pk for pk, _ in chunk]).update(last_login=Case(
+            *[When(pk=pk, then=Value(when)) for pk, when in chunk],
+            output_field=DateTimeField(),
+        ))
+    return len(pending)
+
+
+def rehash_later(user_id, encoded, password):
+    """Replace ``encoded`` with a hash of ``password`` from the preferred hasher, in the background"""
+    tasks.submit(rehash, user_id, encoded, password)
+
+
+def rehash(user_id, encoded, password):
+    """Background task: True if the stored hash was replaced"""
+    new = hashing.make_password(password)
+    # Unless the password was changed in the meantime
+    return bool(User.objects.filter(pk=user_id, password=encoded).update(password=new))
@@ -0,0 +1,40 @@
+"""Shared helpers for the bench_* management commands.
+
+Benchmarks seed thousands of rows, so they run against a throwaway test
+database instead of the configured one.
+"""
+from contextlib import contextmanager
+import statistics
+import time
+
+from django.db import connections
+
+
+@contextmanager
+def scratch_database(alias='default'):
+    """Create a fresh test database, point the connection at it, then drop it"""
+    connection = connections[alias]
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        yield connection
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def time_calls(func, repeat):
+    """Call ``func`` ``repeat`` times; median and p95 latency in milliseconds"""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return {
+        'median': statistics.median(samples),
+        'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+    }
+
+
+def format_timing(label, timing):
+    return f'{label:<40} median {timing["median"]:8.2f} ms   p95 {timing["p95"]:8.2f} ms'
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from matwanaapp import stats
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the dashboard rollup tables from users, payments and trips'
+
+    def handle(self, *args, **options):
+        hours = stats.rebuild()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {hours} hourly rollup rows'))
@@ -0,0 +1,101 @@
+import csv
+from datetime import timedelta
+from decimal import Decimal
+import io
+import time
+import tracemalloc
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from matwanaapp import exports
+from matwanaapp.models import Payment, User
+
+from ._bench import scratch_database
+
+
+class Command(BaseCommand):
+    help = 'Export a million payments as CSV and XLSX and report rows/s and peak memory'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--payments', type=int, default=1000000)
+        parser.add_argument('--passengers', type=int, default=10000)
+        parser.add_argument('--formats', nargs='+', choices=['naive', 'csv', 'xlsx'], default=['naive', 'csv', 'xlsx'],
+                            help='naive builds the whole CSV from model instances in memory')
+
+    def handle(self, *args, **options):
+        with scratch_database() as connection:
+            self.stdout.write(f'Seeding {options["payments"]} payments on {connection.vendor}...')
+            self.seed(options['payments'], options['passengers'])
+            payments = Payment.objects.order_by('-created_at', '-pk')
+
+            for format in options['formats']:
+                if format == 'naive':
+                    export = lambda: [self.naive_csv(payments).encode()]
+                else:
+                    export = lambda: exports.streaming_response(
+                        format, 'payments', exports.PAYMENT_HEADER, exports.payment_rows(payments),
+                    ).streaming_content
+
+                # Timed untraced; tracemalloc slows allocation-heavy code down
+                start = time.perf_counter()
+                size = sum(len(chunk) for chunk in export())
+                elapsed = time.perf_counter() - start
+
+                tracemalloc.start()
+                for chunk in export():
+                    pass
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+
+                self.stdout.write(
+                    f'{format:<6} {elapsed:7.1f} s  {options["payments"] / elapsed:10,.0f} rows/s  '
+                    f'{size / 1024 / 1024:8.1f} MB out  peak Python memory {peak / 1024 / 1024:8.1f} MB'
+                )
+
+    def naive_csv(self, payments):
+        # An export the obvious way: every instance loaded, the file built in memory
+        file = io.StringIO()
+        writer = csv.writer(file)
+        writer.writerow(exports.PAYMENT_HEADER)
+        for payment in list(payments.select_related('passenger')):
+            writer.writerow([
+                payment.transaction_id, payment.created_at, payment.completed_at,
+                f'{payment.passenger.first_name} {payment.passenger.last_name}', payment.passenger.phone_number,
+                payment.get_payment_type_display(), payment.payment_method, payment.amount,
+                payment.get_status_display(), payment.gateway_reference,
+            ])
+        return file.getvalue()
+
+    def seed(self, count, passengers, batch_size=10000):
+        password = make_password(None)
+        User.objects.bulk_create([
+            User(
+                email=f'user{pk}@example.com', phone_number=f'+2547{pk:08d}', id_number=f'{10000000 + pk}',
+                first_name='Bench', last_name=f'User{pk}', password=password,
+            )
+            for pk in range(passengers)
+        ], batch_size=batch_size)
+        passenger_ids = list(User.objects.values_list('pk', flat=True))
+
+        now = timezone.now()
+        types = [value for value, _ in Payment.PAYMENT_TYPES]
+        statuses = [value for value, _ in Payment.STATUS_CHOICES]
+        for start in range(0, count, batch_size):
+            created = Payment.objects.bulk_create([
+                Payment(
+                    passenger_id=passenger_ids[n % len(passenger_ids)],
+                    payment_type=types[n % len(types)],
+                    amount=Decimal(50 + n % 200),
+                    transaction_id=f'BENCH{n:09d}',
+                    payment_method='mpesa',
+                    status=statuses[n % len(statuses)],
+                    gateway_reference=f'GW{n}',
+                )
+                for n in range(start, min(start + batch_size, count))
+            ])
+            # Spread them over a year rather than one instant
+            Payment.objects.filter(pk__in=[payment.pk for payment in created]).update(
+                created_at=now - timedelta(minutes=start // batch_size * 60)
+            )
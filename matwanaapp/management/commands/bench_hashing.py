@@ -0,0 +1,54 @@
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+from django.contrib.auth import hashers
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from matwanaapp import hashing
+
+
+class Command(BaseCommand):
+    help = 'Replay a burst of password checks through the hashing pool to size HASH_WORKERS'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--logins', type=int, default=200)
+        parser.add_argument('--clients', type=int, default=32, help='Request threads checking at once')
+        parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+        parser.add_argument('--queue-limit', type=int, default=64)
+        parser.add_argument('--iterations', type=int, default=None,
+                            help='PBKDF2 rounds (default: PASSWORD_HASH_ITERATIONS)')
+
+    def handle(self, *args, **options):
+        overrides = {'PASSWORD_HASH_ITERATIONS': options['iterations']} if options['iterations'] else {}
+        with override_settings(**overrides):
+            encoded = hashers.make_password('benchmark')
+            self.stdout.write(f'{options["logins"]} checks from {options["clients"]} request threads, hash {encoded.split("$")[1]} rounds')
+
+            # Every request thread hashing for itself
+            elapsed, _ = self.burst(options, lambda: hashers.check_password('benchmark', encoded))
+            self.stdout.write(f'{"Inline on request threads":<28} {options["logins"] / elapsed:8.1f} checks/s')
+
+            for workers in options['workers']:
+                pool = hashing.HashPool(workers, options['queue_limit'], timeout=30)
+                elapsed, rejected = self.burst(options, lambda: pool.run(hashers.check_password, 'benchmark', encoded))
+                pool.executor.shutdown()
+                metrics = pool.metrics()
+                self.stdout.write(
+                    f'{f"Pool of {workers}":<28} {options["logins"] / elapsed:8.1f} checks/s   '
+                    f'hash p50 {metrics["hash_ms"]["p50"]} ms p95 {metrics["hash_ms"]["p95"]} ms   '
+                    f'wait p95 {metrics["wait_ms"]["p95"]} ms   rejected {rejected}'
+                )
+
+    def burst(self, options, check):
+        def one(_):
+            try:
+                check()
+                return 0
+            except hashing.HashingBusy:
+                return 1
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['clients']) as clients:
+            rejected = sum(clients.map(one, range(options['logins'])))
+        return time.perf_counter() - start, rejected
@@ -0,0 +1,53 @@
+import multiprocessing
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from matwanaapp import ids
+
+
+def generate(args):
+    count, rate = args
+    made = []
+    start = time.perf_counter()
+    for n in range(count):
+        made.append(ids.new_id('PAY'))
+        if rate:
+            # Hold each process to its share of the target rate
+            delay = start + (n + 1) / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+    return made, time.perf_counter() - start
+
+
+class Command(BaseCommand):
+    help = 'Generate transaction ids in parallel processes and check none repeat'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=4)
+        parser.add_argument('--ids', type=int, default=250000, help='Ids per process')
+        parser.add_argument('--rate', type=int, default=0,
+                            help='Target ids per second across all processes (0 = flat out)')
+
+    def handle(self, *args, **options):
+        processes, count = options['processes'], options['ids']
+        rate = options['rate'] / processes if options['rate'] else 0
+
+        start = time.perf_counter()
+        with multiprocessing.get_context('fork').Pool(processes) as pool:
+            results = pool.map(generate, [(count, rate)] * processes)
+        elapsed = time.perf_counter() - start
+
+        total = processes * count
+        unique = len({value for made, _ in results for value in made})
+        for n, (made, seconds) in enumerate(results):
+            ordered = all(a < b for a, b in zip(made, made[1:]))
+            self.stdout.write(
+                f'Process {n}: {len(made)} ids in {seconds:.2f} s ({len(made) / seconds:,.0f}/s)'
+                f'{"" if ordered else "  NOT ORDERED"}'
+            )
+        self.stdout.write(f'{total} ids from {processes} processes in {elapsed:.2f} s ({total / elapsed:,.0f}/s)')
+
+        if unique != total:
+            raise CommandError(f'{total - unique} duplicate ids')
+        self.stdout.write(self.style.SUCCESS(f'All {total} ids unique'))
@@ -0,0 +1,76 @@
+import csv
+import os
+import tempfile
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+
+from matwanaapp import bulk_import
+from matwanaapp.models import Sacco
+
+from ._bench import scratch_database
+
+
+class Command(BaseCommand):
+    help = 'Import a generated file of matatus or users and report rows/s and peak memory'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100000)
+        parser.add_argument('--kind', choices=['matatus', 'users'], default='matatus')
+        parser.add_argument('--format', choices=['csv', 'xlsx'], default='csv')
+        parser.add_argument('--duplicates', type=float, default=0.01,
+                            help='Share of rows repeating an earlier key')
+        parser.add_argument('--chunk-size', type=int, default=bulk_import.CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, f'{options["kind"]}.{options["format"]}')
+            self.stdout.write(f'Writing {options["rows"]} {options["kind"]} to {options["format"]}...')
+            self.write(path, options)
+
+            with scratch_database() as connection:
+                Sacco.objects.create(
+                    name='Bench Sacco', registration_number='BENCH-1', contact_person='Bench',
+                    contact_phone='+254700000000', contact_email='bench@example.com', address='Nairobi',
+                )
+                tracemalloc.start()
+                start = time.perf_counter()
+                with open(path, 'rb') as file:
+                    report = bulk_import.run(options['kind'], file, path, chunk_size=options['chunk_size'])
+                elapsed = time.perf_counter() - start
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+
+                self.stdout.write(
+                    f'{report.created} imported, {report.error_count} rejected on {connection.vendor} in {elapsed:.1f} s '
+                    f'({report.rows / elapsed:,.0f} rows/s), peak Python memory {peak / 1024 / 1024:.1f} MB'
+                )
+
+    def rows(self, options):
+        every = int(1 / options['duplicates']) if options['duplicates'] else 0
+        for number in range(options['rows']):
+            # A repeat of an earlier row, which the import must reject
+            key = number - 1 if every and number and number % every == 0 else number
+            if options['kind'] == 'matatus':
+                yield [f'KBX {key:06d}', f'F{key}', 'BENCH-1', 'minibus', '14']
+            else:
+                yield ['passenger', 'Bench', f'User{key}', f'user{key}@example.com', f'07{key:08d}', f'{10000000 + key}']
+
+    def write(self, path, options):
+        importer = bulk_import.IMPORTERS[options['kind']]
+        if options['format'] == 'csv':
+            with open(path, 'w', newline='') as file:
+                writer = csv.writer(file)
+                writer.writerow(importer.columns)
+                writer.writerows(self.rows(options))
+            return
+
+        from openpyxl import Workbook
+
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        sheet.append(importer.columns)
+        for row in self.rows(options):
+            sheet.append(row)
+        workbook.save(path)
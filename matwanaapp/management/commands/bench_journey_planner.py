@@ -0,0 +1,73 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from matwanaapp.journeys import RouteGraph
+
+from ._bench import format_timing, time_calls
+
+
+class Command(BaseCommand):
+    help = 'Time graph build, incremental updates and k-shortest journey queries on a synthetic network'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stops', type=int, default=5000)
+        parser.add_argument('--routes-per-stop', type=int, default=4)
+        parser.add_argument('--queries', type=int, default=200)
+        parser.add_argument('--k', type=int, default=3)
+
+    def handle(self, *args, **options):
+        rng = random.Random(7)
+        rows = self.network(rng, options['stops'], options['routes_per_stop'])
+        self.stdout.write(f'{options["stops"]} stops, {len(rows)} routes')
+
+        start = time.perf_counter()
+        graph = RouteGraph(rows)
+        self.stdout.write(f'Full build: {(time.perf_counter() - start) * 1000:.1f} ms')
+
+        # Incremental update of one changed route, as after a Route save
+        changed = list(rows[rng.randrange(len(rows))])
+        changed[4] += 5
+        timing = time_calls(lambda: graph.add_route(*changed), 200)
+        self.stdout.write(format_timing('Incremental route update', timing))
+
+        # Half random pairs (mostly unconnected), half pairs a few hops apart
+        pairs = [tuple(rng.sample(range(options['stops']), 2)) for _ in range(options['queries'] // 2)]
+        pairs += [
+            (origin, (origin + rng.randint(10, 45)) % options['stops'])
+            for origin in rng.sample(range(options['stops']), options['queries'] - len(pairs))
+        ]
+        for weight in ('time', 'fare'):
+            for max_transfers in (0, 1, 2):
+                queries = iter(pairs)
+                found = []
+
+                def query():
+                    a, b = next(queries)
+                    found.append(bool(graph.plan(f'Stop {a}', f'Stop {b}', options['k'], max_transfers, weight)))
+
+                timing = time_calls(query, len(pairs))
+                share = sum(found) / len(found) * 100
+                self.stdout.write(format_timing(f'k={options["k"]} {weight}, <= {max_transfers} transfers', timing)
+                                  + f'   ({share:.0f}% connected)')
+
+    def network(self, rng, stops, routes_per_stop):
+        """Stops on a ring of neighbourhoods with a few long-distance trunk routes"""
+        rows = []
+        pk = 0
+        for origin in range(stops):
+            for _ in range(routes_per_stop):
+                if rng.random() < 0.1:
+                    destination = rng.randrange(stops)
+                else:
+                    destination = (origin + rng.randint(-30, 30)) % stops
+                if destination == origin:
+                    continue
+                pk += 1
+                km = round(rng.uniform(2, 60), 2)
+                rows.append((
+                    pk, f'Route {pk}', f'Stop {origin}', f'Stop {destination}',
+                    int(km * rng.uniform(2, 4)), km, round(50 + km * rng.uniform(3, 6)), True,
+                ))
+        return rows
@@ -0,0 +1,92 @@
+import random
+import time
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from django.test import override_settings
+from django.utils import timezone
+
+from matwanaapp import logins
+from matwanaapp.models import User
+
+from ._bench import format_timing, scratch_database, time_calls
+
+
+class Command(BaseCommand):
+    help = 'Compare the OR-across-three-columns login lookup and full-row save with the classified lookup'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100000)
+        parser.add_argument('--logins', type=int, default=5000)
+        parser.add_argument('--burst', type=int, default=100,
+                            help='Logins whose last_login is flushed together')
+
+    def handle(self, *args, **options):
+        rng = random.Random(5)
+        with scratch_database() as connection:
+            self.stdout.write(f'Seeding {options["users"]} users on {connection.vendor}...')
+            self.seed(options['users'])
+
+            # What people type: an email, a phone in some local format, or an ID
+            identifiers = []
+            for pk in rng.choices(range(options['users']), k=options['logins']):
+                kind = rng.randrange(3)
+                if kind == 0:
+                    identifiers.append(f'user{pk}@example.com')
+                elif kind == 1:
+                    identifiers.append(rng.choice(['0', '+254', '254']) + f'7{pk:08d}')
+                else:
+                    identifiers.append(f'{10000000 + pk}')
+
+            def old_lookup(identifier):
+                return User.objects.get(
+                    Q(id_number=identifier) | Q(email=identifier) | Q(phone_number=identifier)
+                )
+
+            # Lookups alone; the old query only finds phones typed as stored
+            for label, lookup, stored in (('OR across three columns', old_lookup, True),
+                                          ('Classified lookup', logins.find_user, False)):
+                queue = iter([self.as_stored(value) if stored else value for value in identifiers])
+                timing = time_calls(lambda: lookup(next(queue)), len(identifiers))
+                self.stdout.write(format_timing(label, timing))
+
+            # Lookup plus the last_login write, in bursts
+            def old_login(identifier):
+                user = old_lookup(self.as_stored(identifier))
+                user.last_login = timezone.now()
+                user.save()
+
+            def new_login(identifier):
+                logins.record_login(logins.find_user(identifier).id)
+
+            with override_settings(TASKS_ALWAYS_EAGER=True):
+                for label, login in (('OR lookup + full save', old_login), ('Classified + batched UPDATE', new_login)):
+                    start = time.perf_counter()
+                    for first in range(0, len(identifiers), options['burst']):
+                        with transaction.atomic():
+                            for identifier in identifiers[first:first + options['burst']]:
+                                login(identifier)
+                    elapsed = time.perf_counter() - start
+                    self.stdout.write(f'{label:<40} {len(identifiers) / elapsed:10,.0f} logins/s (password check excluded)')
+
+    def as_stored(self, identifier):
+        field, value = logins.classify(identifier)
+        return value if field == 'phone_number' else identifier
+
+    def seed(self, count, batch_size=5000):
+        # One hash for everyone; hashing is not what is measured here
+        password = make_password('benchmark')
+        for start in range(0, count, batch_size):
+            User.objects.bulk_create([
+                User(
+                    email=f'user{pk}@example.com',
+                    phone_number=f'+2547{pk:08d}',
+                    id_number=f'{10000000 + pk}',
+                    first_name='Bench',
+                    last_name=f'User{pk}',
+                    password=password,
+                )
+                for pk in range(start, min(start + batch_size, count))
+            ])
@@ -0,0 +1,109 @@
+from datetime import timedelta
+import random
+
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from django.utils import timezone
+
+from matwanaapp import nearby
+from matwanaapp.models import Matatu, Route, Sacco, Trip
+
+from ._bench import format_timing, scratch_database, time_calls
+
+# Roughly Nairobi
+CENTRE = (-1.286389, 36.817223)
+
+
+class Command(BaseCommand):
+    help = 'Time "matatus near me" lookups: grid index vs a full scan vs the database bounding box'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--vehicles', type=int, default=10000)
+        parser.add_argument('--routes', type=int, default=200)
+        parser.add_argument('--spread', type=float, default=0.25, help='Degrees around the centre')
+        parser.add_argument('--queries', type=int, default=1000)
+        parser.add_argument('--skip-database', action='store_true')
+
+    def handle(self, *args, **options):
+        rng = random.Random(11)
+        now = timezone.now()
+        rows = [
+            (pk, *self.point(rng, options['spread']), rng.randrange(options['routes']), now)
+            for pk in range(1, options['vehicles'] + 1)
+        ]
+        index = nearby.GridIndex(rows)
+        self.stdout.write(f'{len(index)} vehicles in {len(index.cells)} cells of {nearby.CELL_DEGREES} deg')
+
+        points = [self.point(rng, options['spread']) for _ in range(options['queries'])]
+        for radius, k, route in ((1, 10, None), (2, 10, None), (5, 10, None), (5, 50, None), (10, 10, 7)):
+            label = f'r={radius} km k={k}' + (' one route' if route is not None else '')
+            queries = iter(points)
+            timing = time_calls(lambda: index.nearest(*next(queries), radius, k, route), len(points))
+            self.stdout.write(format_timing(f'Grid      {label}', timing))
+
+            queries = iter(points)
+            timing = time_calls(lambda: self.scan(rows, *next(queries), radius, k, route), min(len(points), 200))
+            self.stdout.write(format_timing(f'Full scan {label}', timing))
+
+        # Cost of keeping the grid current: one moved vehicle
+        moves = iter([(pk, *self.point(rng, options['spread']), 0, now + timedelta(seconds=n))
+                      for n, pk in enumerate(rng.choices(range(1, options['vehicles'] + 1), k=10000))])
+        timing = time_calls(lambda: index.update(*next(moves)), 10000)
+        self.stdout.write(
+            f'{"Grid update (one fix)":<40} median {timing["median"] * 1000:8.1f} us'
+            f'   p95 {timing["p95"] * 1000:8.1f} us'
+        )
+
+        if not options['skip_database']:
+            self.database(options, rng, points)
+
+    def database(self, options, rng, points):
+        with scratch_database() as connection:
+            self.stdout.write(f'\nSeeding {options["vehicles"]} located trips on {connection.vendor}...')
+            self.seed(rng, options)
+            with override_settings(NEARBY_INDEX=False):
+                for radius in (1, 2, 5):
+                    queries = iter(points)
+                    timing = time_calls(lambda: nearby.find(*next(queries), radius, 10), min(len(points), 200))
+                    self.stdout.write(format_timing(f'Database bbox r={radius} km k=10', timing))
+
+    def point(self, rng, spread):
+        return (round(CENTRE[0] + rng.uniform(-spread, spread), 6),
+                round(CENTRE[1] + rng.uniform(-spread, spread), 6))
+
+    def scan(self, rows, lat, lng, radius, k, route):
+        found = []
+        for pk, trip_lat, trip_lng, route_id, _ in rows:
+            if route is not None and route_id != route:
+                continue
+            distance = nearby.distance_km(lat, lng, trip_lat, trip_lng)
+            if distance <= radius:
+                found.append((distance, pk))
+        found.sort()
+        return found[:k]
+
+    def seed(self, rng, options):
+        sacco = Sacco.objects.create(
+            name='Bench Sacco', registration_number='BENCH', contact_person='Bench',
+            contact_phone='+254700000000', contact_email='bench@example.com', address='Nairobi',
+        )
+        routes = Route.objects.bulk_create([
+            Route(name=f'Bench Route {n}', start_point='Town', end_point=f'Stage {n}', distance_km=10,
+                  estimated_duration_minutes=30, standard_fare=80, sacco=sacco)
+            for n in range(options['routes'])
+        ])
+        matatus = Matatu.objects.bulk_create([
+            Matatu(sacco=sacco, plate_number=f'KBN {n:05d}', fleet_number=f'B{n}', capacity=14,
+                   qr_code_data=f'BENCH:{n}')
+            for n in range(options['vehicles'])
+        ], batch_size=1000)
+        now = timezone.now()
+        trips = []
+        for matatu in matatus:
+            lat, lng = self.point(rng, options['spread'])
+            trips.append(Trip(
+                matatu=matatu, route=rng.choice(routes), status='active',
+                scheduled_departure=now, scheduled_arrival=now + timedelta(hours=1),
+                current_location_lat=lat, current_location_lng=lng, location_updated_at=now,
+            ))
+        Trip.objects.bulk_create(trips, batch_size=1000)
@@ -0,0 +1,111 @@
+import random
+import time
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from matwanaapp import route_search
+from matwanaapp.models import Route, Sacco
+from matwanaapp.stops import get_stop_index
+
+from ._bench import format_timing, scratch_database, time_calls
+
+PLACES = [
+    'Nairobi CBD', 'Westlands', 'Kikuyu', 'Thika', 'Ruiru', 'Juja', 'Kitengela', 'Rongai',
+    'Ngong', 'Karen', 'Kiambu', 'Limuru', 'Githurai', 'Kahawa', 'Embakasi', 'Utawala',
+    'Machakos', 'Athi River', 'Syokimau', 'Kasarani', 'Roysambu', 'Kangemi', 'Kawangware',
+    'Dagoretti', 'Nakuru', 'Naivasha', 'Nyeri', 'Murang\'a', 'Kerugoya', 'Embu', 'Meru',
+    'Eldoret', 'Kisumu', 'Kakamega', 'Bungoma', 'Kericho', 'Narok', 'Kajiado', 'Mombasa',
+    'Malindi', 'Voi', 'Makueni', 'Kitui', 'Nanyuki', 'Isiolo', 'Gilgil', 'Molo', 'Njoro',
+]
+
+QUERIES = ['ny', 'nyeri', 'kar', 'west', 'thika road', 'obi', 'kaw', 'athi', 'm', 'eldoret kis']
+
+
+class Command(BaseCommand):
+    help = 'Time route search (icontains vs the search index) and stop autocomplete on a scratch database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--routes', type=int, default=10000)
+        parser.add_argument('--repeat', type=int, default=50)
+
+    def handle(self, *args, **options):
+        with scratch_database() as connection:
+            self.stdout.write(f'Seeding {options["routes"]} routes on {connection.vendor}...')
+            self.seed(options['routes'])
+
+            cache.clear()
+            start = time.perf_counter()
+            route_search.search('warm up')
+            self.stdout.write(f'Index build / first search: {(time.perf_counter() - start) * 1000:.1f} ms\n')
+
+            for query in QUERIES:
+                # The old query stops at the first 10 hits in table order;
+                # ordering it is the fair comparison for a ranked search
+                legacy = time_calls(lambda: self.legacy_search(query), options['repeat'])
+                ordered = time_calls(lambda: self.legacy_search(query, 'name'), options['repeat'])
+                ranked = time_calls(lambda: route_search.search(query), options['repeat'])
+                self.stdout.write(format_timing(f'[{query}] icontains, unordered', legacy))
+                self.stdout.write(format_timing(f'[{query}] icontains, by name', ordered))
+                self.stdout.write(format_timing(f'[{query}] search index, ranked', ranked))
+
+            routes = Route.objects.filter(is_active=True)
+            legacy = time_calls(
+                lambda: list(routes.filter(start_point__icontains='kar').order_by('name')[:25]),
+                options['repeat'],
+            )
+            indexed = time_calls(
+                lambda: list(route_search.filter_routes(routes, 'kar', fields=['start']).order_by('name')[:25]),
+                options['repeat'],
+            )
+            self.stdout.write(format_timing('routes_list start_point icontains', legacy))
+            self.stdout.write(format_timing('routes_list start_point index', indexed))
+
+            # Stop autocomplete (/api/stops/suggest/) against the warm dictionary
+            stops = get_stop_index()
+            for prefix in ['k', 'kar', 'nairobi', 'cbd']:
+                timing = time_calls(lambda: stops.suggest(prefix, role='start'), options['repeat'])
+                self.stdout.write(
+                    f'{"[" + prefix + "] stop suggest":<40} median {timing["median"] * 1000:8.1f} us'
+                    f'   p95 {timing["p95"] * 1000:8.1f} us'
+                )
+
+    def seed(self, count):
+        rng = random.Random(42)
+        saccos = Sacco.objects.bulk_create([
+            Sacco(
+                name=f'Bench Sacco {n}',
+                registration_number=f'BENCH{n}',
+                contact_person='Bench',
+                contact_phone='+254700000000',
+                contact_email=f'bench{n}@example.com',
+                address='Nairobi',
+            )
+            for n in range(50)
+        ])
+
+        routes = []
+        for n in range(count):
+            start, end = rng.sample(PLACES, 2)
+            route = Route(
+                name=f'{start} - {end} {n}',
+                start_point=start,
+                end_point=end,
+                distance_km=rng.randint(5, 400),
+                estimated_duration_minutes=rng.randint(20, 480),
+                standard_fare=rng.randint(50, 1500),
+                sacco=rng.choice(saccos),
+            )
+            route.search_text = route_search.search_document(route)
+            routes.append(route)
+        Route.objects.bulk_create(routes, batch_size=1000)
+
+    def legacy_search(self, query, *ordering):
+        return list(Route.objects.filter(
+            Q(name__icontains=query) |
+            Q(start_point__icontains=query) |
+            Q(end_point__icontains=query) |
+            Q(sacco__name__icontains=query),
+            is_active=True
+        ).select_related('sacco').order_by(*ordering)[:10])
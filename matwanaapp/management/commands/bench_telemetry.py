@@ -0,0 +1,131 @@
+from datetime import timedelta
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from matwanaapp import telemetry
+from matwanaapp.models import Matatu, Route, Sacco, Trip, TripPosition
+
+from ._bench import format_timing, scratch_database, time_calls
+
+# Roughly Nairobi
+CENTRE = (-1.286389, 36.817223)
+
+
+class Command(BaseCommand):
+    help = 'Load-test GPS ingestion (row-by-row Trip updates vs the batched pipeline) on a scratch database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--vehicles', type=int, default=5000)
+        parser.add_argument('--seconds', type=int, default=60, help='Simulated time to replay')
+        parser.add_argument('--fix-every', type=int, default=1, help='Seconds between fixes on a device')
+        parser.add_argument('--batch-every', type=int, default=5, help='Seconds between batches a device sends')
+
+    def handle(self, *args, **options):
+        vehicles = options['vehicles']
+        with scratch_database() as connection:
+            self.stdout.write(f'Seeding {vehicles} active trips on {connection.vendor}...')
+            trip_ids = self.seed(vehicles)
+            rng = random.Random(3)
+            start_time = timezone.now().timestamp() - options['seconds']
+            positions = {pk: [CENTRE[0] + rng.uniform(-0.2, 0.2), CENTRE[1] + rng.uniform(-0.2, 0.2)]
+                         for pk in trip_ids}
+
+            # The naive approach: one UPDATE per fix as it arrives
+            sample = trip_ids[:min(vehicles, 1000)]
+            started = time.perf_counter()
+            for pk in sample:
+                lat, lng = positions[pk]
+                Trip.objects.filter(pk=pk).update(current_location_lat=round(lat, 6), current_location_lng=round(lng, 6))
+            per_fix = (time.perf_counter() - started) / len(sample)
+            self.stdout.write(
+                f'Row-by-row Trip UPDATE: {per_fix * 1000:.2f} ms per fix, '
+                f'{1 / per_fix:,.0f} fixes/s at most, '
+                f'{vehicles / options["fix_every"]:,.0f} fixes/s needed'
+            )
+
+            # The pipeline: every device sends its last batch_every fixes at once
+            fixes_per_batch = options['batch_every'] // options['fix_every']
+            ticks = options['seconds'] // options['batch_every']
+            batches = []
+            for tick in range(ticks):
+                for pk in trip_ids:
+                    rows = []
+                    for n in range(fixes_per_batch):
+                        position = positions[pk]
+                        position[0] += rng.uniform(-0.0005, 0.0005)
+                        position[1] += rng.uniform(-0.0005, 0.0005)
+                        timestamp = start_time + tick * options['batch_every'] + n * options['fix_every']
+                        rows.append([pk, timestamp, round(position[0], 6), round(position[1], 6), rng.randint(0, 80)])
+                    batches.append(rows)
+            self.stdout.write(f'Replaying {len(batches):,} batches of {fixes_per_batch} fixes ({ticks} ticks)\n')
+
+            batch_iter = iter(batches)
+            now = timezone.now()
+            buffer = telemetry.PositionBuffer()
+
+            def receive():
+                buffer.add([telemetry.parse_fix(row, now) for row in next(batch_iter)])
+
+            # What a request does (parse and buffer) is timed apart from the
+            # flush, which runs on the flusher thread in production
+            request_timings = []
+            flushes = []
+            total_fixes = 0
+            for tick in range(ticks):
+                request_timings.append(time_calls(receive, vehicles))
+                history, latest = buffer.drain()
+                total_fixes += len(history)
+                started = time.perf_counter()
+                moved = telemetry.write(history, latest)
+                flushes.append((time.perf_counter() - started, len(history), moved))
+
+            medians = sorted(timing['median'] for timing in request_timings)
+            p95s = sorted(timing['p95'] for timing in request_timings)
+            self.stdout.write(format_timing('Parse + buffer one batch', {
+                'median': medians[len(medians) // 2], 'p95': p95s[int(len(p95s) * 0.95)],
+            }))
+
+            flush_ms = sorted(seconds * 1000 for seconds, _, _ in flushes)
+            self.stdout.write(
+                f'{"Flush per tick":<40} median {flush_ms[len(flush_ms) // 2]:8.2f} ms   max {flush_ms[-1]:8.2f} ms'
+                f'   ({flushes[0][1]:,} history rows, {flushes[0][2]:,} trip rows)'
+            )
+
+            flush_seconds = sum(seconds for seconds, _, _ in flushes)
+            self.stdout.write(
+                f'Write throughput: {total_fixes / flush_seconds:,.0f} fixes/s '
+                f'({total_fixes:,} fixes in {flush_seconds:.2f} s of flushing for {options["seconds"]} s of traffic)'
+            )
+            self.stdout.write(
+                f'Trip row writes: {sum(moved for _, _, moved in flushes):,} '
+                f'instead of {total_fixes:,} row-by-row'
+            )
+
+            stored = TripPosition.objects.count()
+            located = Trip.objects.filter(location_updated_at__isnull=False).count()
+            self.stdout.write(f'Stored {stored:,} positions; {located:,} trips have a current location')
+
+    def seed(self, count):
+        sacco = Sacco.objects.create(
+            name='Bench Sacco', registration_number='BENCH', contact_person='Bench',
+            contact_phone='+254700000000', contact_email='bench@example.com', address='Nairobi',
+        )
+        route = Route.objects.create(
+            name='Bench Route', start_point='Town', end_point='Thika', distance_km=45,
+            estimated_duration_minutes=60, standard_fare=150, sacco=sacco,
+        )
+        matatus = Matatu.objects.bulk_create([
+            Matatu(sacco=sacco, plate_number=f'KBN {n:04d}', fleet_number=f'B{n}', capacity=14,
+                   qr_code_data=f'BENCH:{n}')
+            for n in range(count)
+        ], batch_size=1000)
+        now = timezone.now()
+        trips = Trip.objects.bulk_create([
+            Trip(matatu=matatu, route=route, status='active', scheduled_departure=now,
+                 scheduled_arrival=now + timedelta(hours=1))
+            for matatu in matatus
+        ], batch_size=1000)
+        return [trip.pk for trip in trips]
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from matwanaapp import bulk_import
+
+
+class Command(BaseCommand):
+    help = 'Import users, matatus or routes from a CSV or XLSX file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=sorted(bulk_import.IMPORTERS))
+        parser.add_argument('path')
+        parser.add_argument('--dry-run', action='store_true', help='Check every row without importing any')
+        parser.add_argument('--chunk-size', type=int, default=bulk_import.CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        try:
+            with open(options['path'], 'rb') as file:
+                report = bulk_import.run(
+                    options['kind'], file, options['path'],
+                    dry_run=options['dry_run'], chunk_size=options['chunk_size'],
+                )
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
+        except bulk_import.ImportStopped as e:
+            self.write_report(e.report, options)
+            raise CommandError(str(e))
+
+        self.write_report(report, options)
+
+    def write_report(self, report, options):
+        for line, message in report.errors:
+            self.stdout.write(f'Line {line}: {message}')
+        if report.error_count > len(report.errors):
+            self.stdout.write(f'... and {report.error_count - len(report.errors)} more')
+
+        verb = 'would be imported' if options['dry_run'] else 'imported'
+        style = self.style.WARNING if report.error_count else self.style.SUCCESS
+        self.stdout.write(style(f'{report.created} of {report.rows} {options["kind"]} {verb}, {report.error_count} rejected'))
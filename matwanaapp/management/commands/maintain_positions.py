@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from matwanaapp.telemetry import ensure_partitions, prune_positions
+
+
+class Command(BaseCommand):
+    help = 'Create upcoming monthly TripPosition partitions and drop GPS history past retention'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months-ahead', type=int, default=2, help='Partitions to keep ready (PostgreSQL)')
+        parser.add_argument('--keep-days', type=int, default=90, help='Days of GPS history to keep')
+
+    def handle(self, *args, **options):
+        for name in ensure_partitions(options['months_ahead']):
+            self.stdout.write(f'Created partition {name}')
+
+        pruned = prune_positions(options['keep_days'])
+        if connection.vendor == 'postgresql':
+            for name in pruned:
+                self.stdout.write(f'Dropped partition {name}')
+        else:
+            self.stdout.write(f'Deleted {pruned} position(s)')
+
+        self.stdout.write(self.style.SUCCESS('GPS history is up to date'))
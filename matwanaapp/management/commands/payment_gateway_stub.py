@@ -0,0 +1,25 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from matwanaapp.payment_stub import StubGateway
+
+
+class Command(BaseCommand):
+    help = 'Run a local stand-in payment gateway for PAYMENT_GATEWAY=matwanaapp.payments.HttpGateway'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--delay', type=float, default=1.0, help='Seconds before acknowledging a payment')
+        parser.add_argument('--batch-seconds', type=float, default=2.0, help='Seconds between result callbacks')
+        parser.add_argument('--fail-rate', type=float, default=0.0, help='Share of payments that fail')
+
+    def handle(self, *args, **options):
+        if not settings.PAYMENT_CALLBACK_SECRET:
+            raise CommandError('Set PAYMENT_CALLBACK_SECRET to the secret the app checks callbacks with')
+        gateway = StubGateway(
+            settings.PAYMENT_CALLBACK_SECRET, host=options['host'], port=options['port'],
+            delay=options['delay'], batch_seconds=options['batch_seconds'], fail_rate=options['fail_rate'],
+        )
+        self.stdout.write(f'Stub gateway on {gateway.url}; results go to each payment\'s callback_url')
+        gateway.serve_forever()
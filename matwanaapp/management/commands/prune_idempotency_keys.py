@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from matwanaapp.idempotency import prune
+
+
+class Command(BaseCommand):
+    help = 'Delete stored responses for idempotency keys past their TTL'
+
+    def handle(self, *args, **options):
+        deleted = prune()
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} expired idempotency key(s)'))
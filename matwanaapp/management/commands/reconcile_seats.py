@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from matwanaapp.booking import repair_seat_counts
+from matwanaapp.models import Trip
+
+
+class Command(BaseCommand):
+    help = 'Find trips whose booked_seats counter drifted from their bookings and repair them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Report drift without repairing it')
+        parser.add_argument('--trip', type=int, action='append', help='Only check these trip ids')
+
+    def handle(self, *args, **options):
+        trips = Trip.objects.all()
+        if options['trip']:
+            trips = trips.filter(pk__in=options['trip'])
+
+        if options['dry_run']:
+            drifted = list(trips.with_seat_drift().values_list('pk', 'booked_seats', 'actual_seats'))
+        else:
+            drifted = repair_seat_counts(trips)
+
+        for pk, counter, actual in drifted:
+            self.stdout.write(f'Trip {pk}: booked_seats={counter}, bookings={actual}')
+
+        if not drifted:
+            self.stdout.write(self.style.SUCCESS('All seat counters match their bookings'))
+        elif options['dry_run']:
+            self.stdout.write(self.style.WARNING(f'{len(drifted)} trip(s) drifted'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Repaired {len(drifted)} trip(s)'))
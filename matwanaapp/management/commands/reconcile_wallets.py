@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from matwanaapp.models import User
+from matwanaapp.wallet import drifted_wallets, repair_wallets
+
+
+class Command(BaseCommand):
+    help = 'Check every wallet balance against the sum of its ledger and repair any that drifted'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Report drift without repairing it')
+        parser.add_argument('--user', type=int, action='append', help='Only check these user ids')
+
+    def handle(self, *args, **options):
+        users = User.objects.all()
+        if options['user']:
+            users = users.filter(pk__in=options['user'])
+
+        if options['dry_run']:
+            drifted = drifted_wallets(users)
+        else:
+            drifted = repair_wallets(users)
+
+        for pk, balance, ledger in drifted:
+            self.stdout.write(f'User {pk}: credits={balance:.2f}, ledger={ledger:.2f}')
+
+        if not drifted:
+            self.stdout.write(self.style.SUCCESS('All wallet balances match their ledgers'))
+        elif options['dry_run']:
+            self.stdout.write(self.style.WARNING(f'{len(drifted)} wallet(s) drifted'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Repaired {len(drifted)} wallet(s)'))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from matwanaapp import eta
+
+
+class Command(BaseCommand):
+    help = 'Fold newly completed trips into the route duration percentile tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true', help='Recompute the tables from all completed trips')
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            trips = eta.rebuild()
+            self.stdout.write(self.style.SUCCESS(f'Rebuilt ETA tables from {trips} trip(s)'))
+        else:
+            trips = eta.refresh()
+            self.stdout.write(self.style.SUCCESS(f'Added {trips} trip(s) to the ETA tables'))
@@ -0,0 +1,23 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from matwanaapp.payments import sweep_pending
+
+
+class Command(BaseCommand):
+    help = 'Resubmit top-ups that never reached the gateway and fail those left pending too long'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--minutes', type=int, default=10,
+                            help='Resubmit pending payments older than this that have no gateway reference')
+        parser.add_argument('--expire-minutes', type=int, default=24 * 60,
+                            help='Fail pending payments older than this')
+
+    def handle(self, *args, **options):
+        resubmitted, expired = sweep_pending(
+            timedelta(minutes=options['minutes']), timedelta(minutes=options['expire_minutes']),
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f'Resubmitted {resubmitted} and failed {expired} pending payment(s)'
+        ))
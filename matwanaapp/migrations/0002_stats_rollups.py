@@ -0,0 +1,40 @@
+# Generated by Django 5.2.6 on 2026-10-17 03:19
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matwanaapp', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatsRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField(unique=True)),
+                ('registrations', models.IntegerField(default=0)),
+                ('completed_payments', models.IntegerField(default=0)),
+                ('completed_amount', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+            ],
+            options={
+                'ordering': ['hour'],
+            },
+        ),
+        migrations.CreateModel(
+            name='TripStatusCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('scheduled', 'Scheduled'), ('active', 'Active'), ('completed', 'Completed'), ('cancelled', 'Cancelled')], max_length=20, unique=True)),
+                ('count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='user',
+            name='phone_number',
+            field=models.CharField(max_length=15, unique=True, validators=[django.core.validators.RegexValidator('^\\+254\\d{9}$', 'Phone must be in the format +254XXXXXXXXX')]),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.6 on 2026-10-17 03:21
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def count_existing_bookings(apps, schema_editor):
+    Trip = apps.get_model('matwanaapp', 'Trip')
+    PassengerTrip = apps.get_model('matwanaapp', 'PassengerTrip')
+
+    bookings = PassengerTrip.objects.filter(trip=OuterRef('pk')).order_by() \
+        .values('trip').annotate(n=Count('pk')).values('n')
+    Trip.objects.update(
+        booked_seats=Coalesce(Subquery(bookings, output_field=IntegerField()), Value(0))
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matwanaapp', '0002_stats_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trip',
+            name='booked_seats',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_existing_bookings, migrations.RunPython.noop),
+    ]
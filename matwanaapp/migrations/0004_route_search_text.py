@@ -0,0 +1,69 @@
+# Generated by Django 5.2.6 on 2026-10-17 03:25
+
+import re
+import unicodedata
+
+from django.db import migrations, models
+
+# Expressions match the SQL Django emits for search_text__contains and
+# start_point/end_point__icontains, so the planner can use these indexes
+TRIGRAM_INDEXES = [
+    ('matwanaapp_route_search_text_trgm', 'search_text'),
+    ('matwanaapp_route_start_point_trgm', 'UPPER(start_point::text)'),
+    ('matwanaapp_route_end_point_trgm', 'UPPER(end_point::text)'),
+]
+
+_NON_WORD = re.compile(r'[\W_]+')
+
+
+def normalise(value):
+    """Frozen copy of route_search.normalise as it was when this migration was written"""
+    value = unicodedata.normalize('NFKD', value or '')
+    value = ''.join(c for c in value if not unicodedata.combining(c))
+    return ' '.join(_NON_WORD.sub(' ', value.lower()).split())
+
+
+def fill_search_text(apps, schema_editor):
+    Route = apps.get_model('matwanaapp', 'Route')
+
+    routes = list(Route.objects.select_related('sacco'))
+    for route in routes:
+        route.search_text = normalise(' '.join([
+            route.name, route.start_point, route.end_point, route.sacco.name,
+        ]))
+    Route.objects.bulk_update(routes, ['search_text'], batch_size=500)
+
+
+def create_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for name, expression in TRIGRAM_INDEXES:
+        schema_editor.execute(
+            f'CREATE INDEX IF NOT EXISTS {name} ON matwanaapp_route '
+            f'USING gin (({expression}) gin_trgm_ops)'
+        )
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name, expression in TRIGRAM_INDEXES:
+        schema_editor.execute(f'DROP INDEX IF EXISTS {name}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matwanaapp', '0003_trip_booked_seats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='route',
+            name='search_text',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.RunPython(fill_search_text, migrations.RunPython.noop),
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 5.2.6 on 2026-10-17 03:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('matwanaapp', '0004_route_search_text'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='matatu',
+            index=models.Index(fields=['-registration_date'], name='matatu_registered_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='passengertrip',
+            index=models.Index(fields=['passenger', '-transaction_time'], name='ptrip_passenger_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['status', 'created_at'], name='payment_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['-created_at'], name='payment_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(condition=models.Q(('status', 'pending')), fields=['created_at'], name='payment_pending_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trip',
+            index=models.Index(fields=['route', 'status', 'scheduled_departure'], name='trip_route_status_dep_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trip',
+            index=models.Index(fields=['driver', 'status', 'scheduled_departure'], name='trip_driver_status_dep_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trip',
+            index=models.Index(fields=['conductor', 'status', 'scheduled_departure'], name='trip_cond_status_dep_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trip',
+            index=models.Index(fields=['-scheduled_departure'], name='trip_departure_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['user_type', '-date_joined'], name='user_type_joined_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['-date_joined'], name='user_joined_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.6 on 2026-10-17 03:33
+
+from django.db import migrations, models
+
+
+def classify_existing(apps, schema_editor):
+    # Before audiences, a notification without recipients went to everyone
+    Notification = apps.get_model('matwanaapp', 'Notification')
+    Notification.objects.filter(recipients__isnull=False).update(audience='explicit')
+    Notification.objects.filter(recipients__isnull=True, saccos__isnull=False).update(audience='saccos')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matwanaapp', '0005_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='audience',
+            field=models.CharField(choices=[('all', 'All Users'), ('user_type', 'One User Type'), ('saccos', 'SACCO Members'), ('explicit', 'Selected Users')], default='all', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='audience_user_type',
+            field=models.CharField(blank=True, choices=[('passenger', 'Passenger'), ('conductor', 'Conductor'), ('driver', 'Driver'), ('sacco_admin', 'Sacco Admin'), ('super_admin', 'Super Admin')], max_length=20),
+        ),
+        migrations.RunPython(classify_existing, migrations.RunPython.noop),
+    ]
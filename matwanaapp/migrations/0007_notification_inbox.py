@@ -0,0 +1,48 @@
+# Generated by Django 5.2.6 on 2026-10-17 03:34
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matwanaapp', '0006_notification_audience'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InboxState',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='inbox_state', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('read_through_id', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='NotificationRead',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('read_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['is_active', '-created_at'], name='notification_inbox_idx'),
+        ),
+        migrations.AddField(
+            model_name='notificationread',
+            name='notification',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reads', to='matwanaapp.notification'),
+        ),
+        migrations.AddField(
+            model_name='notificationread',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='notification_reads', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterUniqueTogether(
+            name='notificationread',
+            unique_together={('user', 'notification')},
+        ),
+    ]
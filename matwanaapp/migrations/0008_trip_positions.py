@@ -0,0 +1,58 @@
+# Generated by Django 5.2.6 on 2026-10-17 03:41
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+# On PostgreSQL the history table is range-partitioned by month so old
+# months can be dropped whole; the DEFAULT partition catches anything
+# ``manage.py maintain_positions`` has not made a partition for yet.
+PARTITIONED_TABLE = [
+    'DROP TABLE matwanaapp_tripposition',
+    """
+    CREATE TABLE matwanaapp_tripposition (
+        trip_id bigint NOT NULL
+            REFERENCES matwanaapp_trip (id) DEFERRABLE INITIALLY DEFERRED,
+        recorded_at timestamp with time zone NOT NULL,
+        lat numeric(9, 6) NOT NULL,
+        lng numeric(9, 6) NOT NULL,
+        speed_kmh smallint NULL CHECK (speed_kmh >= 0),
+        PRIMARY KEY (trip_id, recorded_at)
+    ) PARTITION BY RANGE (recorded_at)
+    """,
+    'CREATE TABLE matwanaapp_tripposition_default PARTITION OF matwanaapp_tripposition DEFAULT',
+]
+
+
+def partition_positions(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for statement in PARTITIONED_TABLE:
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matwanaapp', '0007_notification_inbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trip',
+            name='location_updated_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='TripPosition',
+            fields=[
+                ('pk', models.CompositePrimaryKey('trip', 'recorded_at', blank=True, editable=False, primary_key=True, serialize=False)),
+                ('recorded_at', models.DateTimeField()),
+                ('lat', models.DecimalField(decimal_places=6, max_digits=9)),
+                ('lng', models.DecimalField(decimal_places=6, max_digits=9)),
+                ('speed_kmh', models.PositiveSmallIntegerField(blank=True, null=True)),
+                ('trip', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='positions', to='matwanaapp.trip')),
+            ],
+        ),
+        # Dropping the model drops the partitions with it
+        migrations.RunPython(partition_positions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.6 on 2026-10-17 03:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matwanaapp', '0008_trip_positions'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='trip',
+            index=models.Index(fields=['status', 'location_updated_at'], name='trip_status_located_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trip',
+            index=models.Index(condition=models.Q(('status', 'active')), fields=['current_location_lat', 'current_location_lng'], name='trip_active_location_idx'),
+        ),
+    ]
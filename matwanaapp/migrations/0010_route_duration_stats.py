@@ -0,0 +1,48 @@
+# Generated by Django 5.2.6 on 2026-10-17 03:49
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matwanaapp', '0009_nearby_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DurationStatsCursor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('processed_through', models.DateTimeField(null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RouteDurationStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour_of_week', models.PositiveSmallIntegerField()),
+                ('samples', models.IntegerField(default=0)),
+                ('p50_minutes', models.FloatField(null=True)),
+                ('p80_minutes', models.FloatField(null=True)),
+                ('p95_minutes', models.FloatField(null=True)),
+                ('histogram', models.BinaryField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='trip',
+            index=models.Index(fields=['status', 'actual_arrival'], name='trip_status_arrival_idx'),
+        ),
+        migrations.AddField(
+            model_name='routedurationstats',
+            name='route',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='duration_stats', to='matwanaapp.route'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='routedurationstats',
+            unique_together={('route', 'hour_of_week')},
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.2.6 on 2026-10-17 03:51
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def open_existing_wallets(apps, schema_editor):
+    User = apps.get_model('matwanaapp', 'User')
+    WalletEntry = apps.get_model('matwanaapp', 'WalletEntry')
+
+    # Balances from before the ledger become its first entry
+    entries = [
+        WalletEntry(user_id=pk, kind='opening', amount=credits, balance_after=credits)
+        for pk, credits in User.objects.exclude(credits=0).values_list('pk', 'credits').iterator()
+    ]
+    WalletEntry.objects.bulk_create(entries, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matwanaapp', '0010_route_duration_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WalletEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('opening', 'Opening Balance'), ('topup', 'Top-up'), ('trip', 'Trip Payment'), ('refund', 'Refund'), ('adjustment', 'Adjustment')], max_length=20)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('balance_after', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('description', models.CharField(blank=True, max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('payment', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='wallet_entries', to='matwanaapp.payment')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='wallet_entries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', '-id'], name='wallet_user_idx')],
+            },
+        ),
+        migrations.RunPython(open_existing_wallets, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-17 03:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matwanaapp', '0012_idempotency_records'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='gateway_reference',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+    ]
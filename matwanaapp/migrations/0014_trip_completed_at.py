@@ -0,0 +1,37 @@
+# Generated by Django 5.2.6 on 2026-10-17 04:41
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+def stamp_completed_trips(apps, schema_editor):
+    # Best guess for trips completed before the column existed; the ETA
+    # cursor has read these up to their arrival already
+    Trip = apps.get_model('matwanaapp', 'Trip')
+    Trip.objects.filter(status='completed').update(
+        completed_at=Coalesce('actual_arrival', 'scheduled_arrival')
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matwanaapp', '0013_payment_gateway_reference'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='trip',
+            name='trip_status_arrival_idx',
+        ),
+        migrations.AddField(
+            model_name='trip',
+            name='completed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(stamp_completed_trips, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='trip',
+            index=models.Index(fields=['status', 'completed_at'], name='trip_status_completed_idx'),
+        ),
+    ]
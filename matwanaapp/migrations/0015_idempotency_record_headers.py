@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-17 05:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matwanaapp', '0014_trip_completed_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='idempotencyrecord',
+            name='headers',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
@@ -1,17 +1,22 @@
 # models.py
 from django.db import models
+from django.db.models import Q
 from django.core.validators import RegexValidator
 from django.contrib.auth.hashers import check_password
 from django.utils import timezone
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
 
+from . import hashing
+from .querysets import SaccoQuerySet, RouteQuerySet, TripQuerySet
+from .route_search import search_document
+
 class UserManager(BaseUserManager):
     def create_user(self, email, password=None, **extra_fields):
         if not email:
             raise ValueError('The Email field must be set')
         email = self.normalize_email(email)
         user = self.model(email=email, **extra_fields)
-        user.set_password(password)
+        user.password = hashing.make_password(password)
         user.save(using=self._db)
         return user
 
@@ -66,9 +71,17 @@ class User(AbstractBaseUser, PermissionsMixin):
     
     class Meta:
         ordering = ['-date_joined']
+        indexes = [
+            # Per-role counts and the manage users listing, filtered or not
+            models.Index(fields=['user_type', '-date_joined'], name='user_type_joined_idx'),
+            models.Index(fields=['-date_joined'], name='user_joined_idx'),
+        ]
     
     def __str__(self):
         return f"{self.first_name} {self.last_name}"
+
+    def get_full_name(self):
+        return f"{self.first_name} {self.last_name}"
     
     def check_password(self, raw_password):
         return check_password(raw_password, self.password)
@@ -84,6 +97,8 @@ class Sacco(models.Model):
     is_active = models.BooleanField(default=True)
     date_registered = models.DateTimeField(auto_now_add=True)
     admin = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, limit_choices_to={'user_type': 'sacco_admin'})
+
+    objects = SaccoQuerySet.as_manager()
     
     def __str__(self):
         return self.name
@@ -120,6 +135,12 @@ class Matatu(models.Model):
         limit_choices_to={'user_type': 'conductor'}, 
         related_name='assigned_matatu_as_conductor'  # Added unique related_name
     )
+
+    class Meta:
+        indexes = [
+            # The manage matatus keyset pages
+            models.Index(fields=['-registration_date'], name='matatu_registered_idx'),
+        ]
     
     def __str__(self):
         return f"{self.plate_number} - {self.fleet_number}"
@@ -133,6 +154,10 @@ class Route(models.Model):
     standard_fare = models.DecimalField(max_digits=6, decimal_places=2)
     sacco = models.ForeignKey(Sacco, on_delete=models.CASCADE, related_name='routes')
     is_active = models.BooleanField(default=True)
+    # Normalised name/end points/sacco name, see route_search.py
+    search_text = models.TextField(blank=True, default='', editable=False)
+
+    objects = RouteQuerySet.as_manager()
     
     class Meta:
         unique_together = ['sacco', 'name']
@@ -140,6 +165,12 @@ class Route(models.Model):
     def __str__(self):
         return f"{self.name} ({self.start_point} to {self.end_point})"
 
+    def save(self, *args, **kwargs):
+        self.search_text = search_document(self)
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'search_text'}
+        super().save(*args, **kwargs)
+
 class Trip(models.Model):
     TRIP_STATUS = [
         ('scheduled', 'Scheduled'),
@@ -171,11 +202,71 @@ class Trip(models.Model):
     status = models.CharField(max_length=20, choices=TRIP_STATUS, default='scheduled')
     current_location_lat = models.DecimalField(max_digits=9, decimal_places=6, null=True, blank=True)
     current_location_lng = models.DecimalField(max_digits=9, decimal_places=6, null=True, blank=True)
+    # When the current location was recorded; set by telemetry.py
+    location_updated_at = models.DateTimeField(null=True, blank=True)
+    # Seats taken by bookings; maintained by booking.py, never set directly
+    booked_seats = models.PositiveIntegerField(default=0)
+    # When the status was set to completed; eta.refresh() reads trips by it
+    completed_at = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = TripQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Upcoming trips on a route (route details, routes list counts)
+            models.Index(fields=['route', 'status', 'scheduled_departure'], name='trip_route_status_dep_idx'),
+            # Current trip and counts on the driver and conductor dashboards
+            models.Index(fields=['driver', 'status', 'scheduled_departure'], name='trip_driver_status_dep_idx'),
+            models.Index(fields=['conductor', 'status', 'scheduled_departure'], name='trip_cond_status_dep_idx'),
+            # Departure date ranges and the manage trips keyset pages
+            models.Index(fields=['-scheduled_departure'], name='trip_departure_idx'),
+            # Positions written since the last look (nearby.py)
+            models.Index(fields=['status', 'location_updated_at'], name='trip_status_located_idx'),
+            # Newly completed trips for the ETA tables (eta.refresh)
+            models.Index(fields=['status', 'completed_at'], name='trip_status_completed_idx'),
+            # Bounding-box lookups of active vehicles (nearby.find_in_database)
+            models.Index(
+                fields=['current_location_lat', 'current_location_lng'],
+                name='trip_active_location_idx',
+                condition=Q(status='active'),
+            ),
+        ]
     
     def __str__(self):
         return f"{self.matatu.plate_number} - {self.route.name} ({self.scheduled_departure.date()})"
 
+    def save(self, *args, **kwargs):
+        completed_at = self.completed_at
+        if self.status != 'completed':
+            self.completed_at = None
+        elif self.completed_at is None:
+            self.completed_at = timezone.now()
+        if self.completed_at != completed_at and kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'completed_at'}
+        super().save(*args, **kwargs)
+
+    @property
+    def seats_available(self):
+        return max(self.matatu.capacity - self.booked_seats, 0)
+
+class TripPosition(models.Model):
+    """Append-only GPS history of a trip, written in batches by telemetry.py.
+
+    On PostgreSQL the table is partitioned by month on recorded_at (see
+    migration 0008 and ``manage.py maintain_positions``), which is why the
+    primary key includes it.
+    """
+    pk = models.CompositePrimaryKey('trip', 'recorded_at')
+    trip = models.ForeignKey(Trip, on_delete=models.CASCADE, related_name='positions')
+    recorded_at = models.DateTimeField()
+    lat = models.DecimalField(max_digits=9, decimal_places=6)
+    lng = models.DecimalField(max_digits=9, decimal_places=6)
+    speed_kmh = models.PositiveSmallIntegerField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Trip {self.trip_id} at {self.recorded_at}: {self.lat}, {self.lng}"
+
 class PassengerTrip(models.Model):
     PAYMENT_METHODS = [
         ('credits', 'Credits'),
@@ -200,6 +291,10 @@ class PassengerTrip(models.Model):
     
     class Meta:
         unique_together = ['passenger', 'trip']
+        indexes = [
+            # A passenger's trip history, newest first
+            models.Index(fields=['passenger', '-transaction_time'], name='ptrip_passenger_time_idx'),
+        ]
     
     def __str__(self):
         return f"{self.passenger} - {self.trip}"
@@ -224,13 +319,76 @@ class Payment(models.Model):
     transaction_id = models.CharField(max_length=255, unique=True)
     payment_method = models.CharField(max_length=20)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    # The gateway's own id for the payment (see payments.py)
+    gateway_reference = models.CharField(max_length=100, blank=True)
     description = models.TextField(blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     completed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Listings and totals filtered by status over a date range
+            models.Index(fields=['status', 'created_at'], name='payment_status_created_idx'),
+            models.Index(fields=['-created_at'], name='payment_created_idx'),
+            # Payments still waiting on the gateway, oldest first
+            models.Index(fields=['created_at'], condition=Q(status='pending'), name='payment_pending_idx'),
+        ]
     
     def __str__(self):
         return f"{self.passenger} - {self.amount} - {self.status}"
 
+class WalletEntry(models.Model):
+    """One change to a passenger's wallet; User.credits is the running total.
+
+    Append-only and written only by wallet.py, in the same transaction as
+    the balance update. ``manage.py reconcile_wallets`` checks the two agree.
+    """
+    KINDS = [
+        ('opening', 'Opening Balance'),
+        ('topup', 'Top-up'),
+        ('trip', 'Trip Payment'),
+        ('refund', 'Refund'),
+        ('adjustment', 'Adjustment'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='wallet_entries')
+    kind = models.CharField(max_length=20, choices=KINDS)
+    # Positive for credits, negative for debits
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    balance_after = models.DecimalField(max_digits=10, decimal_places=2)
+    payment = models.ForeignKey(Payment, on_delete=models.SET_NULL, null=True, blank=True, related_name='wallet_entries')
+    description = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # A wallet statement, newest first
+            models.Index(fields=['user', '-id'], name='wallet_user_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id}: {self.amount} ({self.kind})"
+
+class IdempotencyRecord(models.Model):
+    """A POST made with an Idempotency-Key header and the response it got.
+
+    ``key`` hashes the user with the client's key and ``fingerprint`` the
+    request itself, so rows stay small whatever clients send. While the
+    request runs status_code is null. ``headers`` holds the response's
+    other headers and cookies as [name, value] pairs. See idempotency.py.
+    """
+    key = models.CharField(max_length=64, unique=True)
+    fingerprint = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField(null=True)
+    content_type = models.CharField(max_length=100, blank=True)
+    headers = models.JSONField(default=list, blank=True)
+    body = models.BinaryField(null=True)
+    created_at = models.DateTimeField()
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"{self.key[:12]} ({self.status_code or 'in progress'})"
+
 class Notification(models.Model):
     NOTIFICATION_TYPES = [
         ('price_change', 'Price Change'),
@@ -238,6 +396,14 @@ class Notification(models.Model):
         ('promotion', 'Promotion'),
         ('trip_update', 'Trip Update'),
     ]
+
+    # Who sees it; resolved at read time, see notifications.py
+    AUDIENCES = [
+        ('all', 'All Users'),
+        ('user_type', 'One User Type'),
+        ('saccos', 'SACCO Members'),
+        ('explicit', 'Selected Users'),
+    ]
     
     title = models.CharField(max_length=255)
     message = models.TextField()
@@ -245,10 +411,97 @@ class Notification(models.Model):
     created_by = models.ForeignKey(User, on_delete=models.CASCADE, limit_choices_to={'user_type__in': ['super_admin', 'sacco_admin']})
     created_at = models.DateTimeField(auto_now_add=True)
     is_active = models.BooleanField(default=True)
+    audience = models.CharField(max_length=20, choices=AUDIENCES, default='all')
+    audience_user_type = models.CharField(max_length=20, choices=User.USER_TYPES, blank=True)
     
     # Many-to-many for targeted notifications
-    recipients = models.ManyToManyField(User, related_name='notifications', blank=True)
-    saccos = models.ManyToManyField(Sacco, blank=True)
+    recipients = models.ManyToManyField(User, related_name='notifications', blank=True)  # 'explicit' only
+    saccos = models.ManyToManyField(Sacco, blank=True)  # 'saccos' only
+
+    class Meta:
+        indexes = [
+            # Inbox pages, newest first
+            models.Index(fields=['is_active', '-created_at'], name='notification_inbox_idx'),
+        ]
     
     def __str__(self):
-        return self.title
\ No newline at end of file
+        return self.title
+
+class InboxState(models.Model):
+    """Per-user read cursor: every notification up to read_through_id is read"""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='inbox_state')
+    read_through_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.user} read through {self.read_through_id}"
+
+class NotificationRead(models.Model):
+    """A notification opened individually, above the user's read cursor"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='notification_reads')
+    notification = models.ForeignKey(Notification, on_delete=models.CASCADE, related_name='reads')
+    read_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ['user', 'notification']
+
+    def __str__(self):
+        return f"{self.user} read {self.notification}"
+
+class StatsRollup(models.Model):
+    """Hourly counters behind the admin dashboard charts.
+
+    Kept up to date on write by the receivers in signals.py; rebuild from the
+    source tables with `manage.py backfill_stats`.
+    """
+    hour = models.DateTimeField(unique=True)  # start of the hour, UTC
+    registrations = models.IntegerField(default=0)
+    completed_payments = models.IntegerField(default=0)
+    completed_amount = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        ordering = ['hour']
+
+    def __str__(self):
+        return f"{self.hour:%Y-%m-%d %H:00}"
+
+
+class TripStatusCount(models.Model):
+    """Running number of trips in each status"""
+    status = models.CharField(max_length=20, choices=Trip.TRIP_STATUS, unique=True)
+    count = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.status}: {self.count}"
+
+
+class RouteDurationStats(models.Model):
+    """Percentiles of actual trip durations per route and hour of the week.
+
+    hour_of_week is 0 for Monday 00:00-01:00 local time up to 167; ANY_HOUR
+    holds the route's figures across all hours. Maintained by eta.py from a
+    histogram of one-minute bins; rebuild with `manage.py refresh_eta --rebuild`.
+    """
+    ANY_HOUR = 168
+
+    route = models.ForeignKey(Route, on_delete=models.CASCADE, related_name='duration_stats')
+    hour_of_week = models.PositiveSmallIntegerField()
+    samples = models.IntegerField(default=0)
+    p50_minutes = models.FloatField(null=True)
+    p80_minutes = models.FloatField(null=True)
+    p95_minutes = models.FloatField(null=True)
+    histogram = models.BinaryField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ['route', 'hour_of_week']
+
+    def __str__(self):
+        return f"{self.route_id} @ {self.hour_of_week}: p50 {self.p50_minutes}"
+
+
+class DurationStatsCursor(models.Model):
+    """How far eta.refresh() has read completed trips (a single row)"""
+    processed_through = models.DateTimeField(null=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
@@ -0,0 +1,268 @@
+"""Active matatus around a point ("matatus near me").
+
+Each process keeps the latest position of every active trip in a uniform
+grid of CELL_DEGREES cells. A lookup only visits the cells around the point,
+ring by ring, and stops once the k nearest are known, so it costs the same
+with 10 or 10 000 vehicles on the road.
+
+The grid follows position writes: a telemetry flush hands its fixes to
+note_positions(), and positions written by other processes are picked up by
+a query for recently updated trips, at most every REFRESH_SECONDS. Only a
+trip starting, ending or changing route (the 'trip-assignment' cache scope)
+rebuilds it; bookings and seat counts, which bump 'trips', do not.
+
+With settings.NEARBY_INDEX off every lookup goes to the database instead,
+as a bounding-box query on the trip location index.
+"""
+import heapq
+import math
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Trip
+from .response_cache import get_versions
+
+# About 1.1 km on a side near the equator
+CELL_DEGREES = 0.01
+
+KM_PER_DEGREE = 111.32
+
+# Positions older than this are not shown (device off, trip abandoned)
+MAX_AGE = timedelta(minutes=5)
+
+REFRESH_SECONDS = 1.0
+
+# Fixes can be written a little after they were recorded; re-read this far
+# back so a late flush from another process is not missed
+REFRESH_LAG = timedelta(seconds=30)
+
+MAX_RADIUS_KM = 50
+MAX_RESULTS = 50
+
+
+def distance_km(lat1, lng1, lat2, lng2):
+    """Great-circle distance (haversine)"""
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * 6371.0 * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _cell(lat, lng):
+    return int(math.floor(lat / CELL_DEGREES)), int(math.floor(lng / CELL_DEGREES))
+
+
+class GridIndex:
+    def __init__(self, rows=()):
+        self.positions = {}
+        self.cells = {}
+        self.lock = threading.Lock()
+        for row in rows:
+            self.update(*row)
+
+    def update(self, trip_id, lat, lng, route_id, recorded_at):
+        """Move a trip to a new position (older fixes are ignored)"""
+        lat, lng = float(lat), float(lng)
+        with self.lock:
+            current = self.positions.get(trip_id)
+            if current is not None:
+                if recorded_at <= current[3]:
+                    return
+                self._unlink(trip_id, current)
+            self.positions[trip_id] = (lat, lng, route_id, recorded_at)
+            self.cells.setdefault(_cell(lat, lng), set()).add(trip_id)
+
+    def remove(self, trip_id):
+        with self.lock:
+            current = self.positions.pop(trip_id, None)
+            if current is not None:
+                self._unlink(trip_id, current)
+
+    def _unlink(self, trip_id, position):
+        key = _cell(position[0], position[1])
+        members = self.cells[key]
+        members.discard(trip_id)
+        if not members:
+            del self.cells[key]
+
+    def __len__(self):
+        return len(self.positions)
+
+    def nearest(self, lat, lng, radius_km, k=10, route_id=None, since=None):
+        """Up to ``k`` (distance_km, trip_id, position) within ``radius_km``, nearest first"""
+        lat, lng = float(lat), float(lng)
+        centre_row, centre_col = _cell(lat, lng)
+
+        # Smallest width of a cell in km anywhere within the radius; rings of
+        # cells further out than this bound cannot hold anything closer
+        widest_lat = min(90.0, abs(lat) + radius_km / KM_PER_DEGREE)
+        cell_km = CELL_DEGREES * KM_PER_DEGREE * max(math.cos(math.radians(widest_lat)), 0.01)
+        max_ring = int(radius_km / cell_km) + 1
+
+        # Sparse grid: scanning every occupied cell beats walking empty rings
+        sparse = (2 * max_ring + 1) ** 2 > len(self.cells)
+
+        def cell_groups():
+            if sparse:
+                yield 0, self.cells.values()
+                return
+            for ring in range(max_ring + 1):
+                yield ring, (self.cells.get(key) for key in _ring(centre_row, centre_col, ring))
+
+        best = []
+        with self.lock:
+            for ring, cells in cell_groups():
+                # Everything in this ring is at least (ring - 1) cells away
+                if len(best) == k and (ring - 1) * cell_km > -best[0][0]:
+                    break
+                for members in cells:
+                    if not members:
+                        continue
+                    for trip_id in members:
+                        position = self.positions[trip_id]
+                        if route_id is not None and position[2] != route_id:
+                            continue
+                        if since is not None and position[3] < since:
+                            continue
+                        distance = distance_km(lat, lng, position[0], position[1])
+                        if distance > radius_km:
+                            continue
+                        # Max-heap of the k nearest so far
+                        item = (-distance, trip_id, position)
+                        if len(best) < k:
+                            heapq.heappush(best, item)
+                        elif item > best[0]:
+                            heapq.heapreplace(best, item)
+
+        return sorted((-distance, trip_id, position) for distance, trip_id, position in best)
+
+
+def _ring(row, col, ring):
+    """Cell keys at Chebyshev distance ``ring`` from (row, col)"""
+    if ring == 0:
+        yield row, col
+        return
+    for c in range(col - ring, col + ring + 1):
+        yield row - ring, c
+        yield row + ring, c
+    for r in range(row - ring + 1, row + ring):
+        yield r, col - ring
+        yield r, col + ring
+
+
+LOCATED_FIELDS = ('pk', 'current_location_lat', 'current_location_lng', 'route_id', 'location_updated_at')
+
+
+def located_trips():
+    return Trip.objects.filter(
+        status='active', current_location_lat__isnull=False, location_updated_at__isnull=False,
+    )
+
+
+class IndexCache:
+    """The per-process grid, rebuilt when trips are assigned and topped up from recent writes"""
+
+    def __init__(self):
+        self.index = None
+        self.version = None
+        self.refreshed = 0.0
+        self.seen_through = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        version = get_versions(['trip-assignment'])[0]
+        if self.index is None or self.version != version:
+            with self.lock:
+                if self.index is None or self.version != version:
+                    self._rebuild()
+                    self.version = version
+        elif time.monotonic() - self.refreshed > REFRESH_SECONDS:
+            with self.lock:
+                if time.monotonic() - self.refreshed > REFRESH_SECONDS:
+                    self._refresh()
+        return self.index
+
+    def note_positions(self, fixes):
+        index = self.index
+        if index is None:
+            return
+        for fix in fixes:
+            # Only trips already known to be active; the next refresh adds new ones
+            current = index.positions.get(fix.trip_id)
+            if current is not None:
+                index.update(fix.trip_id, fix.lat, fix.lng, current[2], fix.recorded_at)
+
+    def _rebuild(self):
+        rows = list(located_trips().filter(
+            location_updated_at__gte=timezone.now() - MAX_AGE
+        ).values_list(*LOCATED_FIELDS))
+        self.index = GridIndex(rows)
+        self._mark(rows)
+
+    def _refresh(self):
+        since = (self.seen_through or timezone.now()) - REFRESH_LAG
+        rows = list(located_trips().filter(location_updated_at__gt=since).values_list(*LOCATED_FIELDS))
+        for row in rows:
+            self.index.update(*row)
+        self._mark(rows)
+
+    def _mark(self, rows):
+        self.refreshed = time.monotonic()
+        newest = max((row[4] for row in rows), default=None)
+        if newest is not None and (self.seen_through is None or newest > self.seen_through):
+            self.seen_through = newest
+
+
+_index_cache = IndexCache()
+
+
+def get_index():
+    return _index_cache.get()
+
+
+def note_positions(fixes):
+    """Called by telemetry.write() with each trip's newest fix"""
+    transaction.on_commit(lambda: _index_cache.note_positions(fixes))
+
+
+def find(lat, lng, radius_km=2, k=10, route_id=None):
+    """Up to ``k`` active trips within ``radius_km`` of a point, nearest first.
+
+    Returns (distance_km, trip_id, lat, lng, updated_at) tuples.
+    """
+    since = timezone.now() - MAX_AGE
+    if not settings.NEARBY_INDEX:
+        return find_in_database(lat, lng, radius_km, k, route_id, since)
+
+    return [
+        (distance, trip_id, position[0], position[1], position[3])
+        for distance, trip_id, position in get_index().nearest(lat, lng, radius_km, k, route_id, since)
+    ]
+
+
+def find_in_database(lat, lng, radius_km=2, k=10, route_id=None, since=None):
+    """find() without the grid: a bounding box on the location index, then exact distances"""
+    lat, lng = float(lat), float(lng)
+    lat_delta = radius_km / KM_PER_DEGREE
+    lng_delta = radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(min(89.0, abs(lat) + lat_delta))), 0.01))
+
+    trips = located_trips().filter(
+        current_location_lat__range=(round(lat - lat_delta, 6), round(lat + lat_delta, 6)),
+        current_location_lng__range=(round(lng - lng_delta, 6), round(lng + lng_delta, 6)),
+    )
+    if route_id is not None:
+        trips = trips.filter(route_id=route_id)
+    if since is not None:
+        trips = trips.filter(location_updated_at__gte=since)
+
+    found = []
+    for trip_id, trip_lat, trip_lng, _, updated_at in trips.values_list(*LOCATED_FIELDS):
+        distance = distance_km(lat, lng, float(trip_lat), float(trip_lng))
+        if distance <= radius_km:
+            found.append((distance, trip_id, float(trip_lat), float(trip_lng), updated_at))
+    return heapq.nsmallest(k, found)
@@ -0,0 +1,184 @@
+"""Notification audiences and fan-out.
+
+Broadcasts and segments (everyone, one user type, members of some SACCOs)
+are stored as a rule on the Notification and matched against the reader
+when notifications are fetched, so sending one costs a single row however
+many users it reaches. Only explicit recipient lists are written out to the
+recipients join table, in chunks, and lists too long for a request are
+written by a background task (tasks.py).
+"""
+from django.db.models import Count, Q
+
+from . import live, tasks
+from .models import Notification, Sacco, User
+from .response_cache import bump
+
+CHUNK_SIZE = 1000
+
+# Explicit lists longer than this are written by a background task
+BACKGROUND_THRESHOLD = 2000
+
+# send_to values posted by the add notification form -> user type segment
+USER_TYPE_SEGMENTS = {
+    'passengers': 'passenger',
+    'drivers': 'driver',
+    'conductors': 'conductor',
+    'sacco_admins': 'sacco_admin',
+}
+
+# The other send_to values -> audience ('specific' is the old form's name
+# for a hand-picked list)
+AUDIENCE_CHOICES = {
+    'all': 'all',
+    'specific_sacco': 'saccos',
+    'saccos': 'saccos',
+    'custom': 'explicit',
+    'specific': 'explicit',
+}
+
+
+def member_sacco_ids(user):
+    """Subquery of the SACCOs ``user`` belongs to (admin, driver or conductor)"""
+    return Sacco.objects.filter(
+        Q(admin_id=user.id) |
+        Q(matatus__current_driver_id=user.id) |
+        Q(matatus__current_conductor_id=user.id)
+    ).values('pk')
+
+
+def visible_to(user):
+    """Active notifications whose audience includes ``user``.
+
+    ``user`` is a User or a principal.Principal; only id and user_type are
+    read. The M2M parts are IN (subquery) rather than joins, so a
+    notification is never repeated and there is nothing to de-duplicate.
+    """
+    explicit = Notification.recipients.through.objects.filter(user_id=user.id).values('notification_id')
+    by_sacco = Notification.saccos.through.objects.filter(
+        sacco__in=member_sacco_ids(user)
+    ).values('notification_id')
+
+    return Notification.objects.filter(is_active=True).filter(
+        Q(audience='all') |
+        Q(audience='user_type', audience_user_type=user.user_type) |
+        Q(audience='saccos', pk__in=by_sacco) |
+        Q(audience='explicit', pk__in=explicit)
+    )
+
+
+def create(created_by, title, message, notification_type, audience='all',
+           user_type='', sacco_ids=(), recipient_ids=()):
+    """Create a notification for an audience.
+
+    ``created_by`` is a User or a user id. Rules are saved as-is; explicit
+    recipients are written in chunks, in the background when there are many
+    of them.
+    """
+    if audience == 'user_type' and not user_type:
+        raise ValueError('Pick a user type')
+    if audience == 'saccos' and not sacco_ids:
+        raise ValueError('Pick at least one SACCO')
+    if audience == 'explicit' and not recipient_ids:
+        raise ValueError('Pick at least one recipient')
+
+    notification = Notification.objects.create(
+        title=title,
+        message=message,
+        notification_type=notification_type,
+        created_by_id=getattr(created_by, 'pk', created_by),
+        audience=audience,
+        audience_user_type=user_type if audience == 'user_type' else '',
+    )
+
+    if audience == 'saccos':
+        notification.saccos.set(Sacco.objects.filter(id__in=sacco_ids))
+    elif audience == 'explicit':
+        recipient_ids = list(recipient_ids)
+        if len(recipient_ids) > BACKGROUND_THRESHOLD:
+            tasks.submit(add_recipients, notification.pk, recipient_ids)
+        else:
+            add_recipients(notification.pk, recipient_ids)
+
+    return notification
+
+
+def add_recipients(notification_id, user_ids, chunk_size=CHUNK_SIZE):
+    """Write recipient rows for active users among ``user_ids``, chunk by chunk"""
+    Recipient = Notification.recipients.through
+    user_ids = list(dict.fromkeys(user_ids))
+    added = []
+
+    for start in range(0, len(user_ids), chunk_size):
+        chunk = user_ids[start:start + chunk_size]
+        active = list(User.objects.filter(id__in=chunk, is_active=True).values_list('id', flat=True))
+        rows = [Recipient(notification_id=notification_id, user_id=user_id) for user_id in active]
+        Recipient.objects.bulk_create(rows, ignore_conflicts=True)
+        added += active
+
+    # bulk_create sends no m2m_changed, so invalidate unread counts and
+    # tell open dashboards here
+    bump('notifications')
+    live.notification_delivered(notification_id, added)
+    return len(added)
+
+
+def audience_size(notification):
+    """How many active users ``notification`` reaches right now"""
+    return audience_sizes([notification])[notification.pk]
+
+
+def audience_sizes(notifications):
+    """{pk: audience size} for ``notifications``, a fixed few queries however many"""
+    notifications = list(notifications)
+    by_audience = {}
+    for notification in notifications:
+        by_audience.setdefault(notification.audience, []).append(notification.pk)
+    active = User.objects.filter(is_active=True)
+    sizes = {}
+
+    if 'all' in by_audience:
+        everyone = active.count()
+        sizes.update((pk, everyone) for pk in by_audience['all'])
+
+    if 'user_type' in by_audience:
+        per_type = dict(active.values_list('user_type').annotate(count=Count('pk')).order_by())
+        for notification in notifications:
+            if notification.audience == 'user_type':
+                sizes[notification.pk] = per_type.get(notification.audience_user_type, 0)
+
+    if 'saccos' in by_audience:
+        # Members of every SACCO involved, once, then a union per notification
+        saccos_of = {}
+        for notification_id, sacco_id in Notification.saccos.through.objects.filter(
+            notification_id__in=by_audience['saccos']
+        ).values_list('notification_id', 'sacco_id'):
+            saccos_of.setdefault(notification_id, set()).add(sacco_id)
+        sacco_ids = set().union(*saccos_of.values())
+        members = {}
+        rows = active.filter(
+            Q(sacco__in=sacco_ids) |
+            Q(assigned_matatu_as_driver__sacco__in=sacco_ids) |
+            Q(assigned_matatu_as_conductor__sacco__in=sacco_ids)
+        ).values_list('pk', 'sacco', 'assigned_matatu_as_driver__sacco', 'assigned_matatu_as_conductor__sacco')
+        for user_id, *user_saccos in rows:
+            for sacco_id in user_saccos:
+                if sacco_id in sacco_ids:
+                    members.setdefault(sacco_id, set()).add(user_id)
+        for pk in by_audience['saccos']:
+            sizes[pk] = len(set().union(*(members.get(sacco_id, ()) for sacco_id in saccos_of.get(pk, ()))))
+
+    if 'explicit' in by_audience:
+        sizes.update(Notification.recipients.through.objects.filter(
+            notification_id__in=by_audience['explicit'], user__is_active=True,
+        ).values_list('notification_id').annotate(count=Count('user_id')).order_by())
+
+    return {notification.pk: sizes.get(notification.pk, 0) for notification in notifications}
+
+
+def lookup_user_ids(identifiers):
+    """User ids for a list of emails and phone numbers"""
+    emails = [value for value in identifiers if '@' in value]
+    phones = [value for value in identifiers if '@' not in value]
+    return list(User.objects.filter(
+        Q(email__in=emails) | Q(phone_number__in=phones)
+    ).values_list('id', flat=True))
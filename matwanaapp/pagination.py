@@ -0,0 +1,152 @@
+"""Keyset (cursor) pagination for the large listing pages.
+
+Offset pagination gets slower the deeper you page because the database still
+has to walk every skipped row. Here a page is fetched by seeking past the
+last row seen, using the listing's ordering column with the primary key as a
+tie-breaker, so every page costs one index range read.
+"""
+import base64
+import hashlib
+import json
+
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet
+from django.db import connections
+from django.db.models import Q
+
+DEFAULT_PER_PAGE = 25
+
+
+class KeysetPage:
+    def __init__(self, object_list, next_cursor, previous_cursor, approximate_total=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        self.approximate_total = approximate_total
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+class KeysetPaginator:
+    """Paginate a queryset on a single non-null ordering column plus pk.
+
+    ``ordering`` follows the usual order_by() syntax, e.g. '-created_at'.
+    """
+
+    def __init__(self, queryset, ordering, per_page=DEFAULT_PER_PAGE):
+        self.queryset = queryset
+        self.descending = ordering.startswith('-')
+        self.field_name = ordering.lstrip('-')
+        self.field = queryset.model._meta.get_field(self.field_name)
+        self.per_page = per_page
+
+    def page(self, cursor=None, with_total=False):
+        position = self._decode(cursor) if cursor else None
+        backwards = position is not None and position['d'] == 'p'
+
+        queryset = self.queryset
+        if position is not None:
+            queryset = queryset.filter(self._seek(position['v'], position['pk'], backwards))
+        queryset = queryset.order_by(*self._ordering(backwards))
+
+        rows = list(queryset[:self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if backwards:
+            rows.reverse()
+
+        # Walking forwards there is a previous page whenever we came from a
+        # cursor; walking backwards there is always a next page.
+        if backwards:
+            has_next, has_previous = True, has_more
+        else:
+            has_next, has_previous = has_more, position is not None
+
+        next_cursor = self._encode(rows[-1], 'n') if rows and has_next else None
+        previous_cursor = self._encode(rows[0], 'p') if rows and has_previous else None
+
+        total = approximate_count(self.queryset) if with_total else None
+        return KeysetPage(rows, next_cursor, previous_cursor, total)
+
+    def _ordering(self, backwards):
+        # Walking backwards flips the ordering; the page is reversed afterwards
+        descending = self.descending != backwards
+        prefix = '-' if descending else ''
+        return [prefix + self.field_name, prefix + 'pk']
+
+    def _seek(self, value, pk, backwards):
+        descending = self.descending != backwards
+        op = 'lt' if descending else 'gt'
+        return (
+            Q(**{f'{self.field_name}__{op}': value}) |
+            Q(**{self.field_name: value, f'pk__{op}': pk})
+        )
+
+    def _encode(self, obj, direction):
+        value = self.field.value_to_string(obj)
+        payload = json.dumps({'v': value, 'pk': obj.pk, 'd': direction}, separators=(',', ':'))
+        return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+    def _decode(self, cursor):
+        """Decode a cursor; a malformed one just means the first page"""
+        try:
+            padded = cursor + '=' * (-len(cursor) % 4)
+            position = json.loads(base64.urlsafe_b64decode(padded.encode()))
+            position['v'] = self.field.to_python(position['v'])
+            position['pk'] = int(position['pk'])
+            if position['d'] not in ('n', 'p') or position['v'] is None:
+                return None
+        except Exception:
+            return None
+        return position
+
+
+def approximate_count(queryset, timeout=300):
+    """Row count for "about N results" labels, served from the cache.
+
+    Unfiltered tables on PostgreSQL use the planner's row estimate; anything
+    else runs a real COUNT at most once per ``timeout`` seconds per filter set.
+    """
+    try:
+        sql = str(queryset.query)
+    except EmptyResultSet:
+        return 0
+
+    key = 'approx-count:' + hashlib.md5(sql.encode()).hexdigest()
+    count = cache.get(key)
+    if count is None:
+        count = _estimated_rows(queryset)
+        if count is None:
+            count = queryset.count()
+        cache.set(key, count, timeout)
+    return count
+
+
+def _estimated_rows(queryset):
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql' or queryset.query.where:
+        return None
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass',
+            [queryset.model._meta.db_table],
+        )
+        row = cursor.fetchone()
+
+    # reltuples is -1 (or 0) until the table has been analyzed
+    if not row or row[0] <= 0:
+        return None
+    return row[0]
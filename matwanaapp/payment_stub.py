@@ -0,0 +1,145 @@
+"""A local stand-in for a payment gateway, speaking HttpGateway's protocol.
+
+POST /payments with {transaction_id, amount, method, phone_number,
+callback_url} answers {"reference": ...} after ``delay`` seconds, the way an
+STK push is acknowledged before the customer has done anything. Outcomes are
+posted back to each payment's callback_url every ``batch_seconds`` as one
+signed {"results": [...]} body per URL, so the app sees results in batches.
+
+Payments are approved, except a share ``fail_rate`` of them and any amount
+ending in .99, which fail. Used by the tests and by ``manage.py
+payment_gateway_stub``.
+"""
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
+import json
+import logging
+import random
+import threading
+import time
+from urllib.error import URLError
+from urllib.request import Request, urlopen
+
+from .payments import SIGNATURE_HEADER, sign
+
+logger = logging.getLogger(__name__)
+
+
+class StubGateway:
+    def __init__(self, secret, host='127.0.0.1', port=0, delay=0.0, batch_seconds=0.2, fail_rate=0.0, seed=None):
+        self.secret = secret
+        self.delay = delay
+        self.batch_seconds = batch_seconds
+        self.fail_rate = fail_rate
+        self.random = random.Random(seed)
+        self.references = itertools.count(1)
+        self.lock = threading.Lock()
+        self.queued = defaultdict(list)
+        self.received = []
+        self.stopped = threading.Event()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.threads = []
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self.threads = [
+            threading.Thread(target=self.server.serve_forever, name='stub-gateway', daemon=True),
+            threading.Thread(target=self._settle_loop, name='stub-gateway-callbacks', daemon=True),
+        ]
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.server.shutdown()
+        self.server.server_close()
+        for thread in self.threads:
+            thread.join()
+        self._settle()
+
+    def serve_forever(self):
+        """Run in the foreground until interrupted"""
+        self.start()
+        try:
+            while not self.stopped.wait(1):
+                pass
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def decide(self, payment):
+        if str(payment['amount']).endswith('.99') or self.random.random() < self.fail_rate:
+            return 'failed'
+        return 'completed'
+
+    def accept(self, payment):
+        """Queue the outcome of a payment request; returns its reference"""
+        reference = f'STUB{next(self.references):08d}'
+        with self.lock:
+            self.received.append(payment)
+            self.queued[payment['callback_url']].append({
+                'transaction_id': payment['transaction_id'],
+                'status': self.decide(payment),
+                'reference': reference,
+            })
+        return reference
+
+    def _settle_loop(self):
+        while not self.stopped.wait(self.batch_seconds):
+            self._settle()
+
+    def _settle(self):
+        with self.lock:
+            queued, self.queued = self.queued, defaultdict(list)
+        for callback_url, results in queued.items():
+            body = json.dumps({'results': results}).encode()
+            request = Request(callback_url, data=body, headers={
+                'Content-Type': 'application/json',
+                SIGNATURE_HEADER: sign(body, self.secret),
+            })
+            try:
+                with urlopen(request, timeout=10) as response:
+                    response.read()
+            except (URLError, OSError):
+                logger.warning('Callback to %s failed; retrying with the next batch', callback_url)
+                with self.lock:
+                    self.queued[callback_url][:0] = results
+
+    def _handler(self):
+        gateway = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path.rstrip('/') != '/payments':
+                    return self.reply(404, {'error': 'Not found'})
+                try:
+                    payment = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                    missing = {'transaction_id', 'amount', 'callback_url'} - set(payment)
+                except ValueError:
+                    missing = True
+                if missing:
+                    return self.reply(400, {'error': 'Bad request'})
+                if gateway.delay:
+                    time.sleep(gateway.delay)
+                self.reply(200, {'reference': gateway.accept(payment)})
+
+            def reply(self, status, data):
+                body = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        return Handler
@@ -0,0 +1,216 @@
+"""Wallet top-ups through a payment gateway, off the request path.
+
+A top-up request only writes a pending Payment and queues it for the worker
+pool (tasks.submit), so it answers in the same time however slow the
+gateway is. The worker hands the payment to the adapter named by
+settings.PAYMENT_GATEWAY, and the gateway reports the outcome later, in
+batches, to api/payments/callback/ (views.payment_callback_api). The
+callback body is signed with PAYMENT_CALLBACK_SECRET, a secret of its own
+that HttpGateway refuses to run without.
+
+apply_results() settles a batch in one transaction: the pending payments
+in it move to completed or failed with one UPDATE each, and completed
+top-ups are credited to their wallets. A payment that is no longer pending
+is skipped, so gateways may repeat a callback safely.
+
+Adapters have one method, request_payment(payment), which returns the
+gateway's reference or raises GatewayError:
+
+- SimulatedGateway (the default) approves every payment at once, in
+  process, for development without a gateway;
+- HttpGateway posts JSON to PAYMENT_GATEWAY_URL. payment_stub.py is a local
+  server speaking the same protocol (``manage.py payment_gateway_stub``).
+
+The worker pool lives in the web process, so a restart can drop a payment
+before it reaches the gateway. sweep_pending() (``manage.py
+sweep_pending_payments``, run from cron) resubmits those and fails the
+ones the gateway has not settled in time.
+"""
+from collections import defaultdict
+from datetime import timedelta
+import hashlib
+import hmac
+import json
+from urllib.error import URLError
+from urllib.request import Request, urlopen
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from . import ids, live, stats, tasks, wallet
+from .models import Payment
+from .response_cache import bump, passenger_scope
+
+SIGNATURE_HEADER = 'X-Matwana-Signature'
+
+RESULT_STATUSES = ('completed', 'failed')
+
+
+class GatewayError(Exception):
+    """The gateway refused the payment or could not be reached"""
+
+
+class SimulatedGateway:
+    def request_payment(self, payment):
+        reference = f'SIM{payment.pk}'
+        apply_results([{'transaction_id': payment.transaction_id, 'status': 'completed', 'reference': reference}])
+        return reference
+
+
+class HttpGateway:
+    def __init__(self, url=None, timeout=None):
+        if not settings.PAYMENT_CALLBACK_SECRET:
+            raise ImproperlyConfigured('PAYMENT_CALLBACK_SECRET must be set to use HttpGateway')
+        self.url = (url or settings.PAYMENT_GATEWAY_URL).rstrip('/')
+        self.timeout = timeout or settings.PAYMENT_GATEWAY_TIMEOUT
+
+    def request_payment(self, payment):
+        body = json.dumps({
+            'transaction_id': payment.transaction_id,
+            'amount': str(payment.amount),
+            'method': payment.payment_method,
+            'phone_number': payment.passenger.phone_number,
+            'callback_url': settings.PAYMENT_CALLBACK_URL,
+        }).encode()
+        request = Request(f'{self.url}/payments', data=body, headers={'Content-Type': 'application/json'})
+        try:
+            with urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read())['reference']
+        except (URLError, OSError, ValueError, KeyError) as e:
+            raise GatewayError(str(e))
+
+
+def get_gateway():
+    return import_string(settings.PAYMENT_GATEWAY)()
+
+
+def sign(body, secret=None):
+    secret = secret or settings.PAYMENT_CALLBACK_SECRET
+    if not secret:
+        raise ImproperlyConfigured('PAYMENT_CALLBACK_SECRET is not set')
+    return hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+def valid_signature(body, signature):
+    # Without a secret anyone could sign, so nothing is valid
+    if not settings.PAYMENT_CALLBACK_SECRET or not signature:
+        return False
+    return hmac.compare_digest(sign(body), signature)
+
+
+def start_top_up(user_id, amount, payment_method):
+    """Write a pending top-up and queue it for the gateway; returns the Payment"""
+    with transaction.atomic():
+        payment = Payment.objects.create(
+            passenger_id=user_id,
+            payment_type='credit_topup',
+            amount=amount,
+            transaction_id=ids.transaction_id('credit_topup'),
+            payment_method=payment_method or '',
+            status='pending',
+            description=f'Wallet top-up of KES {amount}',
+        )
+        tasks.submit(send_to_gateway, payment.pk)
+    return payment
+
+
+def send_to_gateway(payment_id):
+    """Background task: hand a pending payment to the gateway"""
+    payment = Payment.objects.select_related('passenger').filter(pk=payment_id, status='pending').first()
+    if payment is None:
+        return
+
+    try:
+        reference = get_gateway().request_payment(payment)
+    except GatewayError as e:
+        apply_results([{'transaction_id': payment.transaction_id, 'status': 'failed', 'message': str(e)}])
+        return
+
+    # The result may already be in; only fill the reference in
+    Payment.objects.filter(pk=payment.pk, gateway_reference='').update(gateway_reference=reference[:100])
+
+
+def sweep_pending(resubmit_after=timedelta(minutes=10), expire_after=timedelta(days=1)):
+    """Resubmit or fail payments left pending; returns (resubmitted, expired)
+
+    Pending payments older than resubmit_after that never got a gateway
+    reference are sent again under the same transaction_id, so a gateway
+    that did receive one sees a repeat. Any older than expire_after are
+    failed, so the passenger can try again.
+    """
+    now = timezone.now()
+    # Served by payment_pending_idx
+    stale = Payment.objects.filter(status='pending', created_at__lt=now - resubmit_after).order_by('created_at')
+
+    expired = list(stale.filter(created_at__lt=now - expire_after).values_list('transaction_id', flat=True))
+    if expired:
+        apply_results([
+            {'transaction_id': transaction_id, 'status': 'failed', 'message': 'No result from the gateway'}
+            for transaction_id in expired
+        ])
+
+    resubmit = list(stale.filter(gateway_reference='').values_list('pk', flat=True))
+    for payment_id in resubmit:
+        send_to_gateway(payment_id)
+    return len(resubmit), len(expired)
+
+
+def apply_results(results):
+    """Settle gateway results ({transaction_id, status, reference?}); returns (completed, failed)"""
+    outcomes = {
+        result['transaction_id']: result for result in results
+        if isinstance(result, dict) and result.get('status') in RESULT_STATUSES and result.get('transaction_id')
+    }
+    if not outcomes:
+        return 0, 0
+
+    with transaction.atomic():
+        pending = list(Payment.objects.select_for_update().filter(
+            transaction_id__in=list(outcomes), status='pending'
+        ))
+        completed = [p for p in pending if outcomes[p.transaction_id]['status'] == 'completed']
+        failed = [p for p in pending if outcomes[p.transaction_id]['status'] == 'failed']
+
+        now = timezone.now()
+        if completed:
+            Payment.objects.filter(pk__in=[p.pk for p in completed]).update(status='completed', completed_at=now)
+        if failed:
+            Payment.objects.filter(pk__in=[p.pk for p in failed]).update(status='failed')
+        for payment in pending:
+            reference = str(outcomes[payment.transaction_id].get('reference') or '')[:100]
+            if reference and not payment.gateway_reference:
+                Payment.objects.filter(pk=payment.pk).update(gateway_reference=reference)
+
+        for payment in completed:
+            if payment.payment_type == 'credit_topup':
+                wallet.credit(payment.passenger_id, payment.amount, 'topup', payment, payment.description)
+
+        _settled(completed, failed)
+
+    return len(completed), len(failed)
+
+
+def _settled(completed, failed):
+    """What the Payment signals would have done for the rows update() moved"""
+    hours = defaultdict(lambda: [None, 0, 0])
+    for payment in completed:
+        totals = hours[stats.hour_bucket(payment.created_at)]
+        totals[0] = payment.created_at
+        totals[1] += 1
+        totals[2] += payment.amount
+    for created_at, count, amount in hours.values():
+        stats.record_payment(created_at, count=count, amount=amount)
+
+    passenger_ids = {payment.passenger_id for payment in completed + failed}
+    if passenger_ids:
+        # 'stats' also covers the payment listing's totals, which failures move
+        bump(*[passenger_scope(pk) for pk in passenger_ids], 'stats')
+    if completed:
+        live.stats_changed()
+    for payment in completed:
+        live.payment_changed(payment.passenger_id, payment.transaction_id, 'completed')
+    for payment in failed:
+        live.payment_changed(payment.passenger_id, payment.transaction_id, 'failed')
@@ -0,0 +1,234 @@
+"""Who is signed in, without a User query on every request.
+
+The login view puts user_id and user_type in the session. get_principal()
+turns that into a compact Principal (id, user_type, sacco_id, name) for the
+session's user, or None when nobody is signed in or the user is gone. It is
+looked up in a process-local LRU, then in a copy kept in the session, and
+only then in the database (one query); each copy is trusted for TTL seconds.
+
+role_required() gates a view on the principal's user_type and leaves it on
+``request.principal``. Views that need the full User row load it themselves.
+
+Editing or deleting a user, or a SACCO or matatu (which can move sacco_id),
+forgets the affected principals when the write commits, including the
+copies held in sessions. The time of the forget is also written to the
+shared cache (settings.CACHES), and every lookup reads it back with one
+cache round trip, so other processes drop their copies on their next
+request instead of serving a deleted user or an old role until TTL runs out.
+"""
+from collections import OrderedDict
+from functools import wraps
+import threading
+import time
+
+from django.contrib import messages
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.http import JsonResponse
+from django.shortcuts import redirect
+
+from .models import Matatu, Sacco, User
+
+SESSION_KEY = 'principal'
+
+MAX_ENTRIES = 10_000
+TTL = 60
+
+# Shared-cache keys holding when principals were last forgotten
+FORGOTTEN_PREFIX = 'principal-forgotten:'
+CLEARED_KEY = 'principal-cleared'
+
+
+class Principal:
+    __slots__ = ('id', 'user_type', 'sacco_id', 'name')
+
+    def __init__(self, id, user_type, sacco_id, name):
+        self.id = id
+        self.user_type = user_type
+        self.sacco_id = sacco_id
+        self.name = name
+
+    def as_list(self):
+        return [self.id, self.user_type, self.sacco_id, self.name]
+
+
+class PrincipalCache:
+    """Process-local LRU of principals, and when each was last forgotten"""
+
+    def __init__(self, max_entries=MAX_ENTRIES, ttl=TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.forgotten = OrderedDict()
+        self.cleared = 0.0
+
+    def get(self, user_id, now, forgotten_at=0.0):
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None:
+                return None
+            principal, loaded_at = entry
+            if loaded_at <= now - self.ttl or loaded_at <= forgotten_at:
+                del self.entries[user_id]
+                return None
+            self.entries.move_to_end(user_id)
+            return principal
+
+    def put(self, principal, loaded_at, now):
+        with self.lock:
+            # A copy read before the last forget() is already out of date
+            if self._stale(principal.id, loaded_at, now):
+                return False
+            self.entries[principal.id] = (principal, loaded_at)
+            self.entries.move_to_end(principal.id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            return True
+
+    def is_stale(self, user_id, loaded_at, now, forgotten_at=0.0):
+        with self.lock:
+            return loaded_at <= forgotten_at or self._stale(user_id, loaded_at, now)
+
+    def _stale(self, user_id, loaded_at, now):
+        return (
+            loaded_at <= now - self.ttl or
+            loaded_at <= self.cleared or
+            loaded_at <= self.forgotten.get(user_id, 0.0)
+        )
+
+    def forget(self, user_id):
+        now = time.time()
+        with self.lock:
+            self.entries.pop(user_id, None)
+            self.forgotten[user_id] = now
+            self.forgotten.move_to_end(user_id)
+            # Anything older than the TTL is stale anyway
+            while self.forgotten:
+                forgotten_at = next(iter(self.forgotten.values()))
+                if forgotten_at > now - self.ttl and len(self.forgotten) <= self.max_entries:
+                    break
+                self.forgotten.popitem(last=False)
+                self.cleared = max(self.cleared, forgotten_at)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.forgotten.clear()
+            self.cleared = time.time()
+
+
+_cache = PrincipalCache()
+
+
+def load(user_id):
+    """The Principal for ``user_id`` from the database, or None"""
+    def sacco_of(queryset, column):
+        return Subquery(queryset.order_by('pk').values(column)[:1])
+
+    sacco_id = Coalesce(
+        sacco_of(Sacco.objects.filter(admin=OuterRef('pk')), 'pk'),
+        sacco_of(Matatu.objects.filter(current_driver=OuterRef('pk')), 'sacco_id'),
+        sacco_of(Matatu.objects.filter(current_conductor=OuterRef('pk')), 'sacco_id'),
+        output_field=IntegerField(),
+    )
+    row = User.objects.filter(pk=user_id).annotate(member_sacco_id=sacco_id).values_list(
+        'pk', 'user_type', 'member_sacco_id', 'first_name', 'last_name'
+    ).first()
+    if row is None:
+        return None
+    pk, user_type, member_sacco_id, first_name, last_name = row
+    return Principal(pk, user_type, member_sacco_id, f'{first_name} {last_name}')
+
+
+def get_principal(request):
+    """The Principal signed in on ``request``, or None"""
+    if hasattr(request, 'principal'):
+        return request.principal
+
+    user_id = request.session.get('user_id')
+    principal = None
+    if user_id is not None:
+        now = time.time()
+        forgotten_at = _forgotten_at(user_id)
+        principal = _cache.get(user_id, now, forgotten_at)
+        if principal is None:
+            principal = _from_session(request.session, user_id, now, forgotten_at)
+        if principal is None:
+            principal = load(user_id)
+            if principal is None:
+                request.session.pop(SESSION_KEY, None)
+            else:
+                _cache.put(principal, now, now)
+                request.session[SESSION_KEY] = principal.as_list() + [now]
+
+    request.principal = principal
+    return principal
+
+
+def _forgotten_at(user_id):
+    """When any process last forgot ``user_id`` (or everyone), per the shared cache"""
+    marks = cache.get_many([CLEARED_KEY, f'{FORGOTTEN_PREFIX}{user_id}'])
+    return max(marks.values(), default=0.0)
+
+
+def _from_session(session, user_id, now, forgotten_at):
+    saved = session.get(SESSION_KEY)
+    if not saved or saved[0] != user_id:
+        return None
+    loaded_at = saved[4]
+    if _cache.is_stale(user_id, loaded_at, now, forgotten_at):
+        return None
+    principal = Principal(*saved[:4])
+    _cache.put(principal, loaded_at, now)
+    return principal
+
+
+def forget(user_id):
+    """Drop the cached principal of ``user_id`` in every process once the transaction commits"""
+    def apply():
+        _cache.forget(user_id)
+        # Older copies are stale anyway once TTL has passed
+        cache.set(f'{FORGOTTEN_PREFIX}{user_id}', time.time(), TTL)
+    transaction.on_commit(apply)
+
+
+def forget_all():
+    """Drop every cached principal in every process once the transaction commits"""
+    def apply():
+        clear()
+        cache.set(CLEARED_KEY, time.time(), TTL)
+    transaction.on_commit(apply)
+
+
+def clear():
+    """Drop every principal cached in this process now"""
+    _cache.clear()
+
+
+def role_required(*user_types, api=False, login_message='Please login', denied_message='Access denied'):
+    """Let a view run only for a signed-in user of one of ``user_types`` (any, if none).
+
+    Others are sent to the login page with a message, or get a JSON error
+    when ``api`` is set.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if 'user_id' not in request.session:
+                return _refuse(request, api, 'Not authenticated' if api else login_message)
+            principal = get_principal(request)
+            if principal is None or (user_types and principal.user_type not in user_types):
+                return _refuse(request, api, denied_message)
+            return view(request, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _refuse(request, api, message):
+    if api:
+        return JsonResponse({'success': False, 'message': message})
+    messages.error(request, message)
+    return redirect('login')
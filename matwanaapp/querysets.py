@@ -0,0 +1,81 @@
+from django.db import models
+from django.db.models import Count, F, Func, IntegerField, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+
+def count_subquery(queryset, field='pk', distinct=False):
+    """Scalar COUNT(...) subquery over a queryset filtered on OuterRef.
+
+    Unlike Count() over a join, several of these can be annotated on the same
+    row without the joins multiplying each other.
+    """
+    if distinct:
+        template = '%(function)s(DISTINCT %(expressions)s)'
+    else:
+        template = '%(function)s(%(expressions)s)'
+
+    counted = queryset.order_by().annotate(
+        _count=Func(F(field), function='COUNT', template=template, output_field=IntegerField())
+    ).values('_count')
+
+    return Coalesce(Subquery(counted, output_field=IntegerField()), Value(0))
+
+
+class SaccoQuerySet(models.QuerySet):
+    def with_stats(self):
+        """Annotate matatu_count, route_count and driver_count"""
+        from .models import Matatu, Route
+
+        return self.annotate(
+            matatu_count=count_subquery(Matatu.objects.filter(sacco=OuterRef('pk'))),
+            route_count=count_subquery(Route.objects.filter(sacco=OuterRef('pk'))),
+            driver_count=count_subquery(
+                Matatu.objects.filter(
+                    sacco=OuterRef('pk'),
+                    current_driver__user_type='driver',
+                ),
+                field='current_driver',
+                distinct=True,
+            ),
+        )
+
+
+class RouteQuerySet(models.QuerySet):
+    def with_trip_stats(self):
+        """Annotate trip_count and active_trips (trips currently on the road)"""
+        # Trips are the only to-many join here, so conditional aggregates are safe
+        return self.annotate(
+            trip_count=Count('trips'),
+            active_trips=Count('trips', filter=Q(trips__status='active')),
+        )
+
+    def with_upcoming_trip_count(self):
+        """Annotate upcoming_trips_count (scheduled trips not yet departed)"""
+        from .models import Trip
+
+        return self.annotate(
+            upcoming_trips_count=count_subquery(Trip.objects.filter(
+                route=OuterRef('pk'),
+                status='scheduled',
+                scheduled_departure__gte=timezone.now(),
+            ))
+        )
+
+
+class TripQuerySet(models.QuerySet):
+    def with_passenger_count(self):
+        """Annotate passenger_count (bookings on the trip)"""
+        from .models import PassengerTrip
+
+        return self.annotate(
+            passenger_count=count_subquery(PassengerTrip.objects.filter(trip=OuterRef('pk')))
+        )
+
+    def with_seat_drift(self):
+        """Trips whose booked_seats counter disagrees with their bookings"""
+        from .models import PassengerTrip
+
+        return self.annotate(
+            actual_seats=count_subquery(PassengerTrip.objects.filter(trip=OuterRef('pk')))
+        ).exclude(booked_seats=F('actual_seats'))
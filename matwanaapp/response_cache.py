@@ -0,0 +1,110 @@
+"""Versioned cache for the JSON endpoints the dashboards poll.
+
+Each cached response is keyed by the versions of the data scopes it was built
+from (a passenger's own rows, all trips, the admin stats). Writes bump those
+versions after commit (see signals.py), which orphans every stale entry at
+once instead of deleting keys one by one. The same key doubles as the ETag,
+so a poll whose data has not changed gets a 304 from the session and a few
+cache reads, without running the view.
+"""
+from functools import wraps
+import hashlib
+import json
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags
+
+VERSION_PREFIX = 'resp-version:'
+RESPONSE_PREFIX = 'resp:'
+
+
+def _version_key(scope):
+    return VERSION_PREFIX + scope
+
+
+def _fresh_version():
+    # A lost version must never come back as a value that was used before
+    return time.time_ns()
+
+
+def get_versions(scopes):
+    keys = [_version_key(scope) for scope in scopes]
+    found = cache.get_many(keys)
+    for key in keys:
+        if key not in found:
+            cache.add(key, _fresh_version(), None)
+            found[key] = cache.get(key)
+    return [found[key] for key in keys]
+
+
+def bump(*scopes):
+    """Invalidate everything cached from ``scopes`` once the write commits"""
+    def apply():
+        for scope in scopes:
+            key = _version_key(scope)
+            try:
+                cache.incr(key)
+            except ValueError:
+                cache.set(key, _fresh_version(), None)
+
+    transaction.on_commit(apply)
+
+
+def passenger_scope(user_id):
+    return f'passenger:{user_id}'
+
+
+def cached_json(user_type, scopes, per_user=True, max_age=300):
+    """Cache a session-authenticated JSON GET view.
+
+    ``scopes`` maps the user id to the data scopes the response is built
+    from. ``per_user=False`` shares one entry between everyone with
+    ``user_type``. Entries also roll over every ``max_age`` seconds so
+    time-relative filters ("departing from now") do not go stale forever.
+
+    The role is checked against the principal, not the session, so a user
+    who was demoted or deleted stops getting cached responses at once.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            # principal imports the models, which import this module
+            from .principal import get_principal
+
+            # Anything that is not a signed-in GET for this role goes straight through
+            if request.method != 'GET' or 'user_id' not in request.session:
+                return view(request, *args, **kwargs)
+            principal = get_principal(request)
+            if principal is None or principal.user_type != user_type:
+                return view(request, *args, **kwargs)
+
+            user_id = principal.id
+            parts = [view.__name__, user_type, str(user_id if per_user else '*')]
+            parts += [str(arg) for arg in args]
+            parts += [str(v) for v in get_versions(scopes(user_id))]
+            parts.append(str(int(time.time() // max_age)))
+
+            digest = hashlib.md5(':'.join(parts).encode()).hexdigest()
+            etag = f'"{digest}"'
+
+            if etag in parse_etags(request.headers.get('If-None-Match', '')):
+                response = HttpResponseNotModified()
+            else:
+                content = cache.get(RESPONSE_PREFIX + digest)
+                if content is not None:
+                    response = HttpResponse(content, content_type='application/json')
+                else:
+                    response = view(request, *args, **kwargs)
+                    if response.status_code != 200 or not json.loads(response.content).get('success'):
+                        return response
+                    cache.set(RESPONSE_PREFIX + digest, response.content, max_age)
+
+            response['ETag'] = etag
+            patch_cache_control(response, private=True, no_cache=True)
+            return response
+        return wrapper
+    return decorator
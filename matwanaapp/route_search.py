@@ -0,0 +1,241 @@
+"""Route search for the dashboard search box, the routes list and quick book.
+
+Every Route carries ``search_text``: its name, end points and sacco name,
+lower-cased with accents and punctuation stripped. On PostgreSQL that column
+(and the start/end point columns) have trigram GIN indexes, so substring
+matches are index scans instead of a sequential scan per keystroke. Other
+backends (SQLite in development) search an in-process index of word
+suffixes instead, rebuilt whenever a route or sacco changes.
+
+Results are ranked: a word that starts with the search term beats one that
+only contains it, then routes are ordered by name.
+"""
+from bisect import bisect_left
+import heapq
+import re
+import threading
+import unicodedata
+
+from django.db import connections
+from django.db.models import Case, IntegerField, Q, Value, When
+
+from .response_cache import get_versions
+
+# Search field -> Route lookup path
+FIELDS = {
+    'name': 'name',
+    'start': 'start_point',
+    'end': 'end_point',
+    'sacco': 'sacco__name',
+}
+ALL_FIELDS = tuple(FIELDS)
+
+PREFIX, SUBSTRING = 0, 1
+
+_NON_WORD = re.compile(r'[\W_]+')
+
+
+def normalise(value):
+    """Lower-case, strip accents and punctuation, collapse whitespace"""
+    value = unicodedata.normalize('NFKD', value or '')
+    value = ''.join(c for c in value if not unicodedata.combining(c))
+    return ' '.join(_NON_WORD.sub(' ', value.lower()).split())
+
+
+def search_document(route, sacco_name=None):
+    """The search_text value for ``route``"""
+    if sacco_name is None:
+        sacco_name = route.sacco.name
+    return normalise(' '.join([route.name, route.start_point, route.end_point, sacco_name]))
+
+
+def refresh_search_text(routes):
+    """Recompute search_text for ``routes`` (e.g. after a sacco rename)"""
+    from .models import Route
+
+    routes = list(routes.select_related('sacco'))
+    for route in routes:
+        route.search_text = search_document(route)
+    Route.objects.bulk_update(routes, ['search_text'], batch_size=500)
+    return len(routes)
+
+
+def search(query, limit=10, fields=ALL_FIELDS):
+    """Active routes matching every word of ``query``, best matches first"""
+    from .models import Route
+
+    terms = normalise(query).split()
+    routes = Route.objects.filter(is_active=True).select_related('sacco')
+    if not terms:
+        return list(routes.order_by('name', 'pk')[:limit])
+
+    if _uses_trigram_index():
+        ranked = _filter_in_database(routes, terms, fields).annotate(
+            search_rank=Case(
+                When(_terms_q(terms, fields, word_prefix=True), then=Value(PREFIX)),
+                default=Value(SUBSTRING),
+                output_field=IntegerField(),
+            )
+        ).order_by('search_rank', 'name', 'pk')
+        return list(ranked[:limit])
+
+    ids = get_index().search(terms, fields, limit=limit, active_only=True)
+    found = routes.in_bulk(ids)
+    return [found[pk] for pk in ids if pk in found]
+
+
+def filter_routes(queryset, query, fields=ALL_FIELDS):
+    """Narrow a Route queryset to rows matching every word of ``query``"""
+    terms = normalise(query).split()
+    if not terms:
+        return queryset
+    if _uses_trigram_index(queryset.db):
+        return _filter_in_database(queryset, terms, fields)
+    prefix, substring = get_index().matching(terms, fields)
+    return queryset.filter(pk__in=prefix | substring)
+
+
+def _uses_trigram_index(alias='default'):
+    return connections[alias].vendor == 'postgresql'
+
+
+def _filter_in_database(queryset, terms, fields):
+    return queryset.filter(_terms_q(terms, fields))
+
+
+def _terms_q(terms, fields, word_prefix=False):
+    """Every term matches one of ``fields``; anywhere, or at a word start"""
+    condition = Q()
+    for term in terms:
+        condition &= _term_q(term, fields, word_prefix)
+    return condition
+
+
+def _term_q(term, fields, word_prefix):
+    # search_text is already normalised, so plain LIKE works and hits its index
+    if set(fields) == set(ALL_FIELDS):
+        if word_prefix:
+            return Q(search_text__startswith=term) | Q(search_text__contains=' ' + term)
+        return Q(search_text__contains=term)
+
+    condition = Q()
+    for field in fields:
+        lookup = FIELDS[field]
+        if word_prefix:
+            condition |= Q(**{f'{lookup}__istartswith': term}) | Q(**{f'{lookup}__icontains': ' ' + term})
+        else:
+            condition |= Q(**{f'{lookup}__icontains': term})
+    return condition
+
+
+class RouteIndex:
+    """Word-suffix index over every route, for backends without trigram indexes.
+
+    Every suffix of every word is kept in one sorted list, so both "starts a
+    word" and "inside a word" matches are a binary search plus a short scan.
+    """
+
+    def __init__(self, rows):
+        # rows: (pk, is_active, name, start_point, end_point, sacco_name)
+        rows = sorted(rows, key=lambda row: (normalise(row[2]), row[0]))
+        # Position in name order, so ranking sorts on plain ints
+        self.order = {row[0]: position for position, row in enumerate(rows)}
+        self.active = {row[0] for row in rows if row[1]}
+        self.postings = {}
+
+        for pk, is_active, *values in rows:
+            for field, value in zip(ALL_FIELDS, values):
+                for word in normalise(value).split():
+                    self.postings.setdefault(word, {}).setdefault(field, set()).add(pk)
+
+        self.suffixes = sorted(
+            (word[offset:], offset, word)
+            for word in self.postings
+            for offset in range(len(word))
+        )
+
+    def matching(self, terms, fields=ALL_FIELDS, active_only=False):
+        """(prefix, substring) id sets for routes matching every term.
+
+        A route is in ``prefix`` when every term starts one of its words.
+        """
+        prefix = matched = None
+        for term in terms:
+            term_prefix, term_any = self._match(term, fields)
+            if prefix is None:
+                prefix, matched = term_prefix, term_any
+            else:
+                prefix &= term_prefix
+                matched &= term_any
+        if active_only:
+            prefix &= self.active
+            matched &= self.active
+        return prefix, matched - prefix
+
+    def search(self, terms, fields=ALL_FIELDS, limit=None, active_only=False):
+        """Ids matching every term, prefix matches first, then by name"""
+        ranked = []
+        for ids in self.matching(terms, fields, active_only):
+            wanted = None if limit is None else limit - len(ranked)
+            if wanted is None:
+                ranked += sorted(ids, key=self.order.__getitem__)
+            elif wanted > 0:
+                ranked += heapq.nsmallest(wanted, ids, key=self.order.__getitem__)
+        return ranked
+
+    def _match(self, term, fields):
+        prefix, found = set(), set()
+        position = bisect_left(self.suffixes, (term,))
+        while position < len(self.suffixes):
+            suffix, offset, word = self.suffixes[position]
+            if not suffix.startswith(term):
+                break
+            postings = self.postings[word]
+            for field in fields:
+                ids = postings.get(field)
+                if ids:
+                    found |= ids
+                    if offset == 0:
+                        prefix |= ids
+            position += 1
+        return prefix, found
+
+
+class ProcessIndex:
+    """An index built once per process from ``build()``.
+
+    It is rebuilt on first use after the ``scope`` cache version moves, which
+    the Route and Sacco signal receivers bump on every write (signals.py).
+    """
+
+    def __init__(self, scope, build):
+        self.scope = scope
+        self.build = build
+        self.index = None
+        self.version = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        version = get_versions([self.scope])[0]
+        if self.index is None or self.version != version:
+            with self.lock:
+                if self.index is None or self.version != version:
+                    self.index = self.build()
+                    self.version = version
+        return self.index
+
+
+def _build_route_index():
+    from .models import Route
+
+    return RouteIndex(Route.objects.values_list(
+        'pk', 'is_active', 'name', 'start_point', 'end_point', 'sacco__name'
+    ))
+
+
+_route_index = ProcessIndex('routes', _build_route_index)
+
+
+def get_index():
+    """The in-process route index (non-PostgreSQL backends)"""
+    return _route_index.get()
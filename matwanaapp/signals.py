@@ -0,0 +1,214 @@
+"""Model signal receivers that keep derived data in step with writes.
+
+Connected from MatwanaappConfig.ready().
+"""
+from decimal import Decimal
+
+from django.db.models.signals import m2m_changed, post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from . import journeys, live, principal, stats, wallet
+from .models import User, Sacco, Matatu, Route, Trip, PassengerTrip, Payment, Notification
+from .route_search import refresh_search_text
+from .inbox import inbox_scope
+from .response_cache import bump, passenger_scope
+
+
+# post_init snapshots let post_save see what a row looked like before the write
+
+def trip_assignment(trip):
+    # Read from __dict__ so a deferred column (only()) is not fetched
+    return tuple(trip.__dict__.get(field) for field in ('status', 'route_id', 'driver_id', 'conductor_id'))
+
+
+@receiver(post_init, sender=Trip)
+def remember_trip_status(sender, instance, **kwargs):
+    instance._saved_status = instance.status if instance.pk else None
+    instance._saved_assignment = trip_assignment(instance) if instance.pk else None
+
+
+@receiver(post_init, sender=Sacco)
+def remember_sacco_name(sender, instance, **kwargs):
+    instance._saved_name = instance.name if instance.pk else None
+
+
+@receiver(post_init, sender=User)
+def remember_user_credits(sender, instance, **kwargs):
+    # Read from __dict__ so a deferred column (only()) is not fetched
+    instance._saved_credits = instance.__dict__.get('credits') if instance.pk else None
+
+
+@receiver(post_init, sender=Payment)
+def remember_payment_state(sender, instance, **kwargs):
+    if instance.pk:
+        instance._saved_completed = instance.status == 'completed'
+        instance._saved_amount = instance.amount
+    else:
+        instance._saved_completed = False
+        instance._saved_amount = Decimal('0')
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        stats.record_registration(instance)
+        wallet.open_wallet(instance)
+    elif not raw and instance._saved_credits is not None and instance.credits != instance._saved_credits:
+        live.wallet_changed(instance.pk, instance.credits)
+    instance._saved_credits = instance.credits
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    stats.record_registration(instance, delta=-1)
+
+
+@receiver(post_save, sender=Trip)
+def trip_saved(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    stats.record_trip_status(None if created else instance._saved_status, instance.status)
+    if not created and instance.status != instance._saved_status:
+        live.trip_status_changed(instance.pk, instance._saved_status, instance.status)
+    # Which trips are running, where and with whom; unlike 'trips', seat
+    # counts and positions leave it alone
+    if trip_assignment(instance) != instance._saved_assignment:
+        bump('trip-assignment')
+    instance._saved_status = instance.status
+    instance._saved_assignment = trip_assignment(instance)
+
+
+@receiver(post_delete, sender=Trip)
+def trip_deleted(sender, instance, **kwargs):
+    stats.record_trip_status(instance._saved_status, None)
+    bump('trip-assignment')
+
+
+@receiver(post_save, sender=Payment)
+def payment_saved(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    was_completed = not created and instance._saved_completed
+    is_completed = instance.status == 'completed'
+    amount = Decimal(str(instance.amount))
+
+    if is_completed and not was_completed:
+        stats.record_payment(instance.created_at, count=1, amount=amount)
+    elif was_completed and not is_completed:
+        stats.record_payment(instance.created_at, count=-1, amount=-instance._saved_amount)
+    elif is_completed and amount != instance._saved_amount:
+        stats.record_payment(instance.created_at, amount=amount - instance._saved_amount)
+
+    instance._saved_completed = is_completed
+    instance._saved_amount = amount
+
+
+@receiver(post_delete, sender=Payment)
+def payment_deleted(sender, instance, **kwargs):
+    if instance._saved_completed:
+        stats.record_payment(instance.created_at, count=-1, amount=-instance._saved_amount)
+
+
+@receiver(post_save, sender=Sacco)
+def sacco_saved(sender, instance, created, raw=False, **kwargs):
+    # Routes carry the sacco name in their search_text
+    if not raw and not created and instance.name != instance._saved_name:
+        refresh_search_text(instance.routes.all())
+    instance._saved_name = instance.name
+
+
+# Response cache invalidation (see response_cache.py)
+
+@receiver([post_save, post_delete], sender=User)
+def user_changed(sender, instance, raw=False, **kwargs):
+    if not raw:
+        bump(passenger_scope(instance.pk), inbox_scope(instance.pk), 'stats')
+        live.stats_changed()
+
+
+@receiver([post_save, post_delete], sender=Trip)
+def trip_changed(sender, instance, raw=False, **kwargs):
+    if not raw:
+        bump('trips', 'stats')
+        live.stats_changed()
+
+
+@receiver([post_save, post_delete], sender=PassengerTrip)
+def booking_changed(sender, instance, signal, raw=False, **kwargs):
+    if not raw:
+        bump(passenger_scope(instance.passenger_id))
+        live.booking_changed(instance, deleted=signal is post_delete)
+
+
+@receiver([post_save, post_delete], sender=Payment)
+def payment_changed(sender, instance, raw=False, **kwargs):
+    if not raw:
+        bump(passenger_scope(instance.passenger_id), 'stats')
+        live.stats_changed()
+
+
+@receiver([post_save, post_delete], sender=Route)
+@receiver([post_save, post_delete], sender=Sacco)
+def route_changed(sender, instance, raw=False, **kwargs):
+    if not raw:
+        bump('routes')
+
+
+@receiver([post_save, post_delete], sender=Route)
+def route_graph_changed(sender, instance, raw=False, **kwargs):
+    if not raw:
+        journeys.route_changed(instance.pk)
+
+
+# Anything that can change who sees which notification invalidates the
+# cached unread counts (see inbox.py)
+
+@receiver([post_save, post_delete], sender=Notification)
+@receiver([post_save, post_delete], sender=Matatu)
+@receiver([post_save, post_delete], sender=Sacco)
+def audience_changed(sender, instance, raw=False, **kwargs):
+    if not raw:
+        bump('notifications')
+
+
+@receiver(m2m_changed, sender=Notification.recipients.through)
+@receiver(m2m_changed, sender=Notification.saccos.through)
+def audience_members_changed(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        bump('notifications')
+
+
+# Cached session principals (see principal.py)
+
+@receiver([post_save, post_delete], sender=User)
+def user_principal_changed(sender, instance, raw=False, created=False, **kwargs):
+    if not raw and not created:
+        principal.forget(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=Matatu)
+@receiver([post_save, post_delete], sender=Sacco)
+def membership_changed(sender, instance, raw=False, **kwargs):
+    # Who belongs to which SACCO may have moved; rare enough to drop them all
+    if not raw:
+        principal.forget_all()
+
+
+# Live updates for open dashboards (see live.py)
+
+@receiver(post_save, sender=Notification)
+def notification_saved(sender, instance, created, raw=False, **kwargs):
+    if created and not raw and instance.is_active:
+        live.notification_created(instance)
+
+
+@receiver(m2m_changed, sender=Notification.saccos.through)
+def notification_saccos_added(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'post_add' and not reverse and instance.is_active:
+        live.notification_sent_to_saccos(instance, pk_set)
+
+
+@receiver(m2m_changed, sender=Notification.recipients.through)
+def notification_recipients_added(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'post_add' and not reverse:
+        live.notification_delivered(instance.pk, pk_set)
@@ -0,0 +1,144 @@
+"""Incrementally maintained dashboard statistics.
+
+Every registration, completed payment and trip status change adjusts a small
+rollup row, so the dashboard endpoint reads a week of history with one
+indexed range scan instead of grouping the raw tables on every poll.
+
+The payment listing's totals depend on its filters, which the rollups do
+not carry, so payment_totals() caches them per filter set until a payment
+changes (the 'stats' response cache scope).
+"""
+from collections import defaultdict
+from datetime import datetime, time, timedelta, timezone as dt_timezone
+from decimal import Decimal
+import hashlib
+
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import TruncHour
+from django.utils import timezone
+
+from .models import User, Trip, Payment, StatsRollup, TripStatusCount
+from .response_cache import get_versions
+
+TOTALS_TIMEOUT = 300
+
+
+def hour_bucket(value):
+    """Start of the UTC hour containing ``value``"""
+    return value.astimezone(dt_timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+
+def _bump(model, lookup, **deltas):
+    """Add ``deltas`` to the row matching ``lookup``, creating it if needed"""
+    changes = {field: F(field) + delta for field, delta in deltas.items() if delta}
+    if not changes:
+        return
+
+    if model.objects.filter(**lookup).update(**changes):
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(**lookup, **deltas)
+    except IntegrityError:
+        # Someone else created the row first
+        model.objects.filter(**lookup).update(**changes)
+
+
+def record_registration(user, delta=1):
+    _bump(StatsRollup, {'hour': hour_bucket(user.date_joined)}, registrations=delta)
+
+
+def record_payment(created_at, count=0, amount=Decimal('0')):
+    _bump(
+        StatsRollup, {'hour': hour_bucket(created_at)},
+        completed_payments=count, completed_amount=amount,
+    )
+
+
+def record_trip_status(old_status, new_status):
+    if old_status == new_status:
+        return
+    if old_status:
+        _bump(TripStatusCount, {'status': old_status}, count=-1)
+    if new_status:
+        _bump(TripStatusCount, {'status': new_status}, count=1)
+
+
+def daily_series(start_date, days):
+    """Per-day registrations and completed payments, in local dates"""
+    tz = timezone.get_current_timezone()
+    start = timezone.make_aware(datetime.combine(start_date, time.min), tz)
+    end = start + timedelta(days=days)
+
+    totals = defaultdict(lambda: {'registrations': 0, 'count': 0, 'total': Decimal('0')})
+    rows = StatsRollup.objects.filter(hour__gte=start, hour__lt=end).values_list(
+        'hour', 'registrations', 'completed_payments', 'completed_amount'
+    )
+    for hour, registrations, count, amount in rows:
+        day = timezone.localtime(hour, tz).date()
+        totals[day]['registrations'] += registrations
+        totals[day]['count'] += count
+        totals[day]['total'] += amount
+
+    return [(start_date + timedelta(days=i), totals[start_date + timedelta(days=i)]) for i in range(days)]
+
+
+def payment_totals(payments):
+    """(total, completed) amount of a filtered Payment queryset, cached until payments change"""
+    try:
+        sql = str(payments.order_by().query)
+    except EmptyResultSet:
+        return Decimal('0'), Decimal('0')
+
+    version = get_versions(['stats'])[0]
+    key = f'payment-totals:{version}:' + hashlib.md5(sql.encode()).hexdigest()
+    totals = cache.get(key)
+    if totals is None:
+        # One scan for both sums
+        row = payments.order_by().aggregate(
+            total=Sum('amount'), completed=Sum('amount', filter=Q(status='completed')),
+        )
+        totals = (row['total'] or Decimal('0'), row['completed'] or Decimal('0'))
+        cache.set(key, totals, TOTALS_TIMEOUT)
+    return totals
+
+
+def trip_status_counts():
+    counts = dict(TripStatusCount.objects.values_list('status', 'count'))
+    return {status: counts.get(status, 0) for status, _ in Trip.TRIP_STATUS}
+
+
+@transaction.atomic
+def rebuild():
+    """Recompute every rollup row from the source tables"""
+    utc = dt_timezone.utc
+    rollups = defaultdict(dict)
+
+    registrations = User.objects.annotate(bucket=TruncHour('date_joined', tzinfo=utc)) \
+        .values('bucket').annotate(n=Count('id')).order_by()
+    for row in registrations:
+        rollups[row['bucket']]['registrations'] = row['n']
+
+    payments = Payment.objects.filter(status='completed') \
+        .annotate(bucket=TruncHour('created_at', tzinfo=utc)) \
+        .values('bucket').annotate(n=Count('id'), total=Sum('amount')).order_by()
+    for row in payments:
+        rollups[row['bucket']]['completed_payments'] = row['n']
+        rollups[row['bucket']]['completed_amount'] = row['total']
+
+    StatsRollup.objects.all().delete()
+    StatsRollup.objects.bulk_create(
+        [StatsRollup(hour=hour, **fields) for hour, fields in rollups.items()],
+        batch_size=1000,
+    )
+
+    TripStatusCount.objects.all().delete()
+    statuses = Trip.objects.values('status').annotate(n=Count('id')).order_by()
+    TripStatusCount.objects.bulk_create(
+        [TripStatusCount(status=row['status'], count=row['n']) for row in statuses]
+    )
+
+    return len(rollups)
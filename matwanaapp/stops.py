@@ -0,0 +1,103 @@
+"""Stop-name dictionary behind the routes list filters and /api/stops/suggest/.
+
+Stops are the distinct start and end points of active routes. They are
+collected once per process into a sorted array keyed by normalised name
+(see route_search.normalise), so a prefix lookup is a binary search rather
+than two DISTINCT queries per page view. Each word of a stop name is also a
+way in, so "cbd" finds "Nairobi CBD". The dictionary rebuilds after any
+Route or Sacco write, like the route search index.
+"""
+from bisect import bisect_left
+from collections import Counter
+
+from .route_search import ProcessIndex, normalise
+
+ROLES = ('start', 'end')
+
+
+class StopIndex:
+    def __init__(self, rows):
+        # rows: (route pk, start_point, end_point) for active routes
+        spellings = {}
+        self.route_ids = {}
+        for pk, *points in rows:
+            for role, point in zip(ROLES, points):
+                key = normalise(point)
+                if not key:
+                    continue
+                spellings.setdefault(key, Counter())[point.strip()] += 1
+                self.route_ids.setdefault(key, {'start': set(), 'end': set()})[role].add(pk)
+
+        # Frozen as sorted tuples so suggestions do not sort on every call
+        for key, ids in self.route_ids.items():
+            ids['any'] = tuple(sorted(ids['start'] | ids['end']))
+            ids['start'] = tuple(sorted(ids['start']))
+            ids['end'] = tuple(sorted(ids['end']))
+
+        # Show each stop the way most routes spell it
+        self.names = {key: counter.most_common(1)[0][0] for key, counter in spellings.items()}
+        self.by_role = {
+            role: sorted((key for key, ids in self.route_ids.items() if ids[role]), key=self.names.get)
+            for role in ROLES
+        }
+
+        # (text from a word start, offset, key); offset 0 is the whole name
+        entries = []
+        for key in self.names:
+            offset = 0
+            for word in key.split(' '):
+                entries.append((key[offset:], offset, key))
+                offset += len(word) + 1
+        entries.sort()
+        self.entries = entries
+
+    def __len__(self):
+        return len(self.names)
+
+    def count(self, role):
+        return len(self.by_role[role])
+
+    def stop_names(self, role, limit=None):
+        """Display names of stops used as ``role``, alphabetically"""
+        keys = self.by_role[role] if limit is None else self.by_role[role][:limit]
+        return [self.names[key] for key in keys]
+
+    def suggest(self, query, role=None, limit=10):
+        """Stops whose name, or a word in it, starts with ``query``.
+
+        Whole-name matches come first, then alphabetical order.
+        """
+        prefix = normalise(query)
+        if not prefix:
+            return []
+
+        best = {}
+        position = bisect_left(self.entries, (prefix,))
+        while position < len(self.entries):
+            text, offset, key = self.entries[position]
+            if not text.startswith(prefix):
+                break
+            if role is None or self.route_ids[key][role]:
+                rank = 0 if offset == 0 else 1
+                if best.get(key, 2) > rank:
+                    best[key] = rank
+            position += 1
+
+        keys = sorted(best, key=lambda key: (best[key], key))[:limit]
+        return [self.describe(key, role) for key in keys]
+
+    def describe(self, key, role=None):
+        return {'name': self.names[key], 'route_ids': list(self.route_ids[key][role or 'any'])}
+
+
+def _build_stop_index():
+    from .models import Route
+
+    return StopIndex(Route.objects.filter(is_active=True).values_list('pk', 'start_point', 'end_point'))
+
+
+_stop_index = ProcessIndex('routes', _build_stop_index)
+
+
+def get_stop_index():
+    return _stop_index.get()
@@ -0,0 +1,55 @@
+"""In-process background work.
+
+Anything too slow for a request (large notification fan-outs, ...) is handed
+to submit(). Jobs start once the surrounding transaction commits, so they
+never see rows that might still roll back, and run on a small thread pool
+sized by settings.TASK_WORKERS. Each worker thread has its own database
+connection, closed after every job.
+
+With settings.TASKS_ALWAYS_EAGER the job runs inline at commit instead,
+which is what the tests use.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connections, transaction
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=settings.TASK_WORKERS, thread_name_prefix='matwana-task'
+                )
+    return _executor
+
+
+def _run(func, args, kwargs, eager=False):
+    try:
+        return func(*args, **kwargs)
+    except Exception:
+        logger.exception('Background task %s failed', getattr(func, '__name__', func))
+    finally:
+        # Worker threads keep no connection between jobs
+        if not eager:
+            connections.close_all()
+
+
+def submit(func, *args, **kwargs):
+    """Run ``func(*args, **kwargs)`` in the background after commit"""
+    def start():
+        if settings.TASKS_ALWAYS_EAGER:
+            _run(func, args, kwargs, eager=True)
+        else:
+            _get_executor().submit(_run, func, args, kwargs)
+
+    transaction.on_commit(start)
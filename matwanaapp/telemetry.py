@@ -0,0 +1,361 @@
+"""GPS telemetry from driver devices.
+
+Devices post batches of fixes (api/telemetry/positions/). Fixes are buffered
+in memory and written in bulk every FLUSH_SECONDS, or sooner once FLUSH_SIZE
+are waiting:
+
+- every fix is appended to TripPosition, the history table, with one
+  INSERT ... SELECT per BATCH_SIZE fixes (from unnest() arrays on
+  PostgreSQL). Fixes for a trip deleted while they sat in the buffer are
+  left out rather than failing the whole flush on its foreign key;
+- each trip's newest fix is copied onto its Trip row, so the hot table sees
+  one write per trip per flush however often the device reports. A fix
+  older than the one already stored (late or out-of-order batches) never
+  overwrites it.
+
+A crash loses at most the fixes of the last few seconds, which the next
+batch from the device supersedes anyway. The flush runs on a daemon thread
+with its own database connection; with settings.TASKS_ALWAYS_EAGER (tests)
+every batch is flushed inline instead.
+
+On PostgreSQL TripPosition is partitioned by month; ``manage.py
+maintain_positions`` creates partitions ahead and drops expired ones
+(prune_positions below).
+"""
+import atexit
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal, InvalidOperation
+import logging
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import nearby
+from .models import Trip, TripPosition
+from .response_cache import get_versions
+
+logger = logging.getLogger(__name__)
+
+FLUSH_SECONDS = 2.0
+FLUSH_SIZE = 20000
+
+# Largest batch one request may post
+MAX_BATCH = 1000
+
+# Rows per INSERT/UPDATE statement in a flush
+BATCH_SIZE = 1000
+
+# Fixes further in the future than this (clock skew) or older than
+# MAX_AGE are refused
+MAX_SKEW = timedelta(seconds=60)
+MAX_AGE = timedelta(hours=24)
+
+SIX_PLACES = Decimal('0.000001')
+
+
+class Fix:
+    __slots__ = ('trip_id', 'recorded_at', 'lat', 'lng', 'speed_kmh')
+
+    def __init__(self, trip_id, recorded_at, lat, lng, speed_kmh=None):
+        self.trip_id = trip_id
+        self.recorded_at = recorded_at
+        self.lat = lat
+        self.lng = lng
+        self.speed_kmh = speed_kmh
+
+
+def parse_fix(row, now=None):
+    """A Fix from one compact ``[trip_id, epoch_seconds, lat, lng, speed_kmh?]`` row.
+
+    Raises ValueError for anything malformed or out of range.
+    """
+    if not isinstance(row, (list, tuple)) or len(row) not in (4, 5):
+        raise ValueError('Expected [trip_id, timestamp, lat, lng, speed]')
+
+    trip_id, timestamp, lat, lng = row[:4]
+    speed = row[4] if len(row) == 5 else None
+    if not isinstance(trip_id, int) or isinstance(trip_id, bool):
+        raise ValueError('Bad trip id')
+
+    try:
+        recorded_at = datetime.fromtimestamp(float(timestamp), tz=dt_timezone.utc)
+        lat = Decimal(str(lat)).quantize(SIX_PLACES)
+        lng = Decimal(str(lng)).quantize(SIX_PLACES)
+    except (TypeError, ValueError, OverflowError, OSError, InvalidOperation):
+        raise ValueError('Bad timestamp or coordinates')
+
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        raise ValueError('Coordinates out of range')
+
+    now = now or timezone.now()
+    if recorded_at > now + MAX_SKEW or recorded_at < now - MAX_AGE:
+        raise ValueError('Timestamp out of range')
+
+    if speed is not None:
+        if not isinstance(speed, (int, float)) or isinstance(speed, bool) or not 0 <= speed < 1000:
+            raise ValueError('Bad speed')
+        speed = round(speed)
+
+    return Fix(trip_id, recorded_at, lat, lng, speed)
+
+
+class PositionBuffer:
+    """Fixes waiting to be written, plus the newest fix per trip"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.history = []
+        self.latest = {}
+
+    def add(self, fixes):
+        """Buffer ``fixes``; True once a flush is due by size"""
+        with self.lock:
+            self.history.extend(fixes)
+            for fix in fixes:
+                current = self.latest.get(fix.trip_id)
+                if current is None or fix.recorded_at > current.recorded_at:
+                    self.latest[fix.trip_id] = fix
+            return len(self.history) >= FLUSH_SIZE
+
+    def drain(self):
+        with self.lock:
+            history, latest = self.history, self.latest
+            self.history, self.latest = [], {}
+        return history, latest
+
+    def __len__(self):
+        return len(self.history)
+
+
+# ON CONFLICT: a device resending a batch it got no answer for. (SQLite
+# needs the WHERE to parse an upsert after a SELECT.)
+INSERT_POSITIONS = """
+INSERT INTO matwanaapp_tripposition (trip_id, recorded_at, lat, lng, speed_kmh)
+SELECT fixes.id, fixes.recorded_at, fixes.lat, fixes.lng, fixes.speed_kmh
+FROM {fixes}
+WHERE fixes.id IN (SELECT id FROM matwanaapp_trip)
+ON CONFLICT DO NOTHING
+"""
+
+# Moves each trip to its newest fix, unless the row already holds a newer
+# one (late batches, or another process flushing the same trip)
+UPDATE_TRIPS = """
+UPDATE matwanaapp_trip
+SET current_location_lat = fixes.lat,
+    current_location_lng = fixes.lng,
+    location_updated_at = fixes.recorded_at
+FROM {fixes}
+WHERE matwanaapp_trip.id = fixes.id
+  AND (matwanaapp_trip.location_updated_at IS NULL
+       OR matwanaapp_trip.location_updated_at < fixes.recorded_at)
+"""
+
+FIX_COLUMNS = [('id', 'bigint'), ('recorded_at', 'timestamptz'), ('lat', 'numeric'), ('lng', 'numeric')]
+
+
+def _fixes(rows, columns):
+    """SQL for a ``fixes`` table over ``rows`` of (name, type) ``columns``, and its params"""
+    names = ', '.join(name for name, _ in columns)
+    if connection.vendor == 'postgresql':
+        # One typed array per column instead of thousands of parameters
+        arrays = ', '.join(f'%s::{type}[]' for _, type in columns)
+        return f'unnest({arrays}) AS fixes ({names})', [list(column) for column in zip(*rows)]
+    aliases = ', '.join(f'column{n} AS {name}' for n, (name, _) in enumerate(columns, start=1))
+    values = ', '.join(['(' + ', '.join(['%s'] * len(columns)) + ')'] * len(rows))
+    return f'(SELECT {aliases} FROM (VALUES {values})) AS fixes', [value for row in rows for value in row]
+
+
+def write(history, latest, batch_size=BATCH_SIZE):
+    """Append ``history`` to TripPosition and move trips to their ``latest`` fix.
+
+    Plain SQL rather than bulk_create/bulk_update: building thousands of
+    model instances and CASE expressions cost far more than the writes. No
+    signals are sent, so positions never invalidate the response cache.
+    Returns the number of Trip rows moved.
+    """
+    ops = connection.ops
+
+    def adapt(fix):
+        return (
+            fix.trip_id,
+            ops.adapt_datetimefield_value(fix.recorded_at),
+            ops.adapt_decimalfield_value(fix.lat, 9, 6),
+            ops.adapt_decimalfield_value(fix.lng, 9, 6),
+        )
+
+    moved = 0
+    with transaction.atomic(), connection.cursor() as cursor:
+        rows = [adapt(fix) + (fix.speed_kmh,) for fix in history]
+        for start in range(0, len(rows), batch_size):
+            fixes, params = _fixes(rows[start:start + batch_size], FIX_COLUMNS + [('speed_kmh', 'smallint')])
+            cursor.execute(INSERT_POSITIONS.format(fixes=fixes), params)
+
+        newest = [adapt(fix) for fix in latest.values()]
+        for start in range(0, len(newest), batch_size):
+            fixes, params = _fixes(newest[start:start + batch_size], FIX_COLUMNS)
+            cursor.execute(UPDATE_TRIPS.format(fixes=fixes), params)
+            moved += cursor.rowcount
+
+    nearby.note_positions(list(latest.values()))
+    return moved
+
+
+class Flusher:
+    """Writes the buffer out every FLUSH_SECONDS, or when woken early"""
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.wake = threading.Event()
+        self.lock = threading.Lock()
+        self.start_lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            with self.start_lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run, name='matwana-telemetry', daemon=True)
+                    self.thread.start()
+                    atexit.register(self.flush)
+
+    def run(self):
+        while True:
+            self.wake.wait(FLUSH_SECONDS)
+            self.wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Telemetry flush failed')
+            finally:
+                connections.close_all()
+
+    def flush(self):
+        # One flush at a time, so an older batch can never land after a newer one
+        with self.lock:
+            history, latest = self.buffer.drain()
+            if history:
+                write(history, latest)
+            return len(history)
+
+
+_buffer = PositionBuffer()
+_flusher = Flusher(_buffer)
+
+
+def ingest(fixes):
+    """Queue fixes for writing"""
+    if not fixes:
+        return
+    due = _buffer.add(fixes)
+    if settings.TASKS_ALWAYS_EAGER:
+        _flusher.flush()
+        return
+    _flusher.start()
+    if due:
+        _flusher.wake.set()
+
+
+def flush():
+    """Write out whatever is buffered now; returns the number of fixes"""
+    return _flusher.flush()
+
+
+def reporting_trip_ids(user_id):
+    """Active trips ``user_id`` may report positions for, cached until trip
+    assignments change (bookings and seat counts leave it alone)"""
+    version = get_versions(['trip-assignment'])[0]
+    key = f'telemetry-trips:{user_id}:{version}'
+    trip_ids = cache.get(key)
+    if trip_ids is None:
+        trip_ids = set(Trip.objects.filter(status='active').filter(
+            Q(driver_id=user_id) | Q(conductor_id=user_id)
+        ).values_list('pk', flat=True))
+        cache.set(key, trip_ids, 300)
+    return trip_ids
+
+
+# Partition maintenance (PostgreSQL)
+
+TABLE = 'matwanaapp_tripposition'
+
+
+def _month_start(value, offset=0):
+    month = value.year * 12 + value.month - 1 + offset
+    return datetime(month // 12, month % 12 + 1, 1, tzinfo=dt_timezone.utc)
+
+
+def partition_name(month_start):
+    return f'{TABLE}_p{month_start:%Y%m}'
+
+
+def ensure_partitions(months_ahead=2, now=None):
+    """Create monthly partitions from this month to ``months_ahead``; returns new names.
+
+    Rows that already landed in the DEFAULT partition for a month are moved
+    into the new partition, since PostgreSQL refuses to attach it otherwise.
+    """
+    if connection.vendor != 'postgresql':
+        return []
+
+    now = now or timezone.now()
+    existing = _partitions()
+    created = []
+    for offset in range(months_ahead + 1):
+        start, end = _month_start(now, offset), _month_start(now, offset + 1)
+        name = partition_name(start)
+        if name in existing:
+            continue
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f'CREATE TABLE {name} (LIKE {TABLE} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)')
+            cursor.execute(
+                f'WITH moved AS (DELETE FROM {TABLE}_default WHERE recorded_at >= %s AND recorded_at < %s '
+                f'RETURNING *) INSERT INTO {name} SELECT * FROM moved',
+                [start, end],
+            )
+            cursor.execute(
+                f'ALTER TABLE {TABLE} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)',
+                [start, end],
+            )
+        created.append(name)
+    return created
+
+
+def prune_positions(keep_days, now=None):
+    """Drop history older than ``keep_days``.
+
+    On PostgreSQL whole months are detached and dropped once every fix in
+    them has expired; elsewhere old rows are deleted. Returns what went.
+    """
+    now = now or timezone.now()
+    cutoff = now - timedelta(days=keep_days)
+
+    if connection.vendor != 'postgresql':
+        deleted, _ = TripPosition.objects.filter(recorded_at__lt=cutoff).delete()
+        return deleted
+
+    dropped = []
+    for name in sorted(_partitions()):
+        month_start = datetime.strptime(name[-6:], '%Y%m').replace(tzinfo=dt_timezone.utc)
+        if _month_start(month_start, 1) > cutoff:
+            continue
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f'ALTER TABLE {TABLE} DETACH PARTITION {name}')
+            cursor.execute(f'DROP TABLE {name}')
+        dropped.append(name)
+    return dropped
+
+
+def _partitions():
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT child.relname FROM pg_inherits '
+            'JOIN pg_class parent ON parent.oid = pg_inherits.inhparent '
+            'JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+            'WHERE parent.relname = %s AND child.relname <> %s',
+            [TABLE, f'{TABLE}_default'],
+        )
+        return {row[0] for row in cursor.fetchall()}
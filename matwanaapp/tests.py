@@ -1,3 +1,2489 @@
-from django.test import TestCase
+import csv
+from datetime import timedelta
+from decimal import Decimal
+from io import BytesIO, StringIO
+import itertools
+import json
+import random
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.core.cache import cache, caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, connections
+from django.db.models import Q, Sum
+from django.http import HttpResponse, HttpResponseRedirect
+from django.shortcuts import get_object_or_404
+from django.test import LiveServerTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import (
+    User, Sacco, Matatu, Route, Trip, PassengerTrip, Payment, StatsRollup, TripStatusCount, Notification,
+    InboxState, NotificationRead, TripPosition, RouteDurationStats, WalletEntry,
+    IdempotencyRecord,
+)
+from .booking import BookingError, book_trip, cancel_booking, repair_seat_counts
+from . import idempotency
+from .pagination import KeysetPaginator
+from .response_cache import bump, get_versions
+from .payment_stub import StubGateway
+from . import bulk_import, eta, hashing, ids, inbox, journeys, live, logins, nearby, notifications, payments, principal, route_search, stats, telemetry, wallet
+from .stops import StopIndex
+
+_seq = itertools.count(1)
+
+
+def make_user(user_type='passenger', password=None, **extra):
+    n = next(_seq)
+    fields = {
+        'first_name': 'Test',
+        'last_name': f'User{n}',
+        'id_number': f'{10000000 + n}',
+        'phone_number': f'+254700{n:06d}',
+        'user_type': user_type,
+    }
+    fields.update(extra)
+    return User.objects.create_user(f'user{n}@example.com', password, **fields)
+
+
+def make_sacco(**extra):
+    n = next(_seq)
+    fields = {
+        'name': f'Sacco {n}',
+        'registration_number': f'REG{n}',
+        'contact_person': 'Contact',
+        'contact_phone': '+254700000000',
+        'contact_email': f'sacco{n}@example.com',
+        'address': 'Nairobi',
+    }
+    fields.update(extra)
+    return Sacco.objects.create(**fields)
+
+
+def make_matatu(sacco, **extra):
+    n = next(_seq)
+    fields = {
+        'plate_number': f'KDA {n:03d}A',
+        'fleet_number': f'F{n}',
+        'capacity': 14,
+        'qr_code_data': f'MATATU:{n}',
+    }
+    fields.update(extra)
+    return Matatu.objects.create(sacco=sacco, **fields)
+
+
+def make_route(sacco, **extra):
+    n = next(_seq)
+    fields = {
+        'name': f'Route {n}',
+        'start_point': 'Town',
+        'end_point': 'Westlands',
+        'distance_km': Decimal('5.00'),
+        'estimated_duration_minutes': 30,
+        'standard_fare': Decimal('80.00'),
+    }
+    fields.update(extra)
+    return Route.objects.create(sacco=sacco, **fields)
+
+
+def make_trip(matatu, route, **extra):
+    departure = timezone.now() + timedelta(hours=2)
+    fields = {
+        'scheduled_departure': departure,
+        'scheduled_arrival': departure + timedelta(minutes=route.estimated_duration_minutes),
+    }
+    fields.update(extra)
+    return Trip.objects.create(matatu=matatu, route=route, **fields)
+
+
+def make_booking(passenger, trip, **extra):
+    fields = {
+        'boarding_stop': trip.route.start_point,
+        'alighting_stop': trip.route.end_point,
+        'fare_paid': trip.route.standard_fare,
+        'payment_method': 'credits',
+        'is_paid': True,
+    }
+    fields.update(extra)
+    return PassengerTrip.objects.create(passenger=passenger, trip=trip, **fields)
+
+
+class SessionLoginMixin:
+    def login_as(self, user):
+        # Test databases hand out the ids of rolled back users again
+        principal.clear()
+        session = self.client.session
+        session['user_id'] = user.id
+        session['user_type'] = user.user_type
+        session['user_name'] = f'{user.first_name} {user.last_name}'
+        session.save()
+
+
+class AnnotatedListingTests(SessionLoginMixin, TestCase):
+    """Listing pages must cost a fixed number of queries"""
+
+    def add_fleet(self):
+        sacco = make_sacco(admin=make_user('sacco_admin'))
+        route = make_route(sacco)
+        for _ in range(2):
+            matatu = make_matatu(sacco, current_driver=make_user('driver'))
+            trip = make_trip(matatu, route, status='active')
+            make_booking(make_user(), trip)
+        return sacco
+
+    def count_queries(self, func):
+        with CaptureQueriesContext(connection) as ctx:
+            func()
+        return len(ctx.captured_queries)
+
+    def test_manage_saccos_query_count_is_constant(self):
+        self.login_as(make_user('super_admin'))
+        url = reverse('admin_manage_saccos')
+
+        def get_page():
+            self.assertEqual(self.client.get(url).status_code, 200)
+
+        self.add_fleet()
+        get_page()  # resolves the session principal
+        small = self.count_queries(get_page)
+        for _ in range(5):
+            self.add_fleet()
+        large = self.count_queries(get_page)
+
+        self.assertEqual(small, large)
+
+    def test_listing_querysets_query_count_is_constant(self):
+        listings = [
+            lambda: list(Sacco.objects.select_related('admin').with_stats()),
+            lambda: list(Route.objects.select_related('sacco').with_trip_stats()),
+            lambda: list(Trip.objects.select_related(
+                'matatu', 'matatu__sacco', 'route', 'driver', 'conductor'
+            ).with_passenger_count()),
+        ]
+
+        self.add_fleet()
+        small = [self.count_queries(listing) for listing in listings]
+        for _ in range(5):
+            self.add_fleet()
+        large = [self.count_queries(listing) for listing in listings]
+
+        self.assertEqual(small, [1, 1, 1])
+        self.assertEqual(small, large)
+
+    def test_annotated_counts(self):
+        sacco = self.add_fleet()
+        # Same driver on a second matatu must only be counted once
+        make_matatu(sacco, current_driver=sacco.matatus.first().current_driver)
+        route = sacco.routes.get()
+        make_trip(sacco.matatus.first(), route, status='scheduled')
+
+        annotated = Sacco.objects.with_stats().get(pk=sacco.pk)
+        self.assertEqual(annotated.matatu_count, 3)
+        self.assertEqual(annotated.route_count, 1)
+        self.assertEqual(annotated.driver_count, 2)
+
+        annotated = Route.objects.with_trip_stats().get(pk=route.pk)
+        self.assertEqual(annotated.trip_count, 3)
+        self.assertEqual(annotated.active_trips, 2)
+
+        counts = sorted(Trip.objects.filter(route=route).with_passenger_count()
+                        .values_list('passenger_count', flat=True))
+        self.assertEqual(counts, [0, 1, 1])
+
+
+class KeysetPaginationTests(SessionLoginMixin, TestCase):
+    def setUp(self):
+        passenger = make_user()
+        created = timezone.now()
+        for n in range(10):
+            Payment.objects.create(
+                passenger=passenger, payment_type='trip', amount=Decimal('50.00'),
+                transaction_id=f'TX{n}', payment_method='credits', status='completed',
+            )
+        # Ties on the ordering column must be broken by pk
+        Payment.objects.filter(transaction_id__in=['TX3', 'TX4', 'TX5', 'TX6']).update(created_at=created)
+
+    def walk(self, paginator):
+        pages = []
+        page = paginator.page()
+        pages.append([p.transaction_id for p in page])
+        while page.has_next:
+            page = paginator.page(page.next_cursor)
+            pages.append([p.transaction_id for p in page])
+        return pages, page
+
+    def test_forward_walk_visits_every_row_once_in_order(self):
+        paginator = KeysetPaginator(Payment.objects.all(), '-created_at', per_page=3)
+        pages, _ = self.walk(paginator)
+
+        expected = list(Payment.objects.order_by('-created_at', '-pk').values_list('transaction_id', flat=True))
+        self.assertEqual([tx for page in pages for tx in page], expected)
+        self.assertEqual([len(page) for page in pages], [3, 3, 3, 1])
+
+    def test_previous_cursor_returns_the_same_pages(self):
+        paginator = KeysetPaginator(Payment.objects.all(), '-created_at', per_page=3)
+        pages, page = self.walk(paginator)
+
+        backwards = [[p.transaction_id for p in page]]
+        while page.has_previous:
+            page = paginator.page(page.previous_cursor)
+            backwards.append([p.transaction_id for p in page])
+
+        self.assertEqual(backwards[::-1], pages)
+        self.assertFalse(page.has_previous)
+
+    def test_malformed_cursor_falls_back_to_first_page(self):
+        paginator = KeysetPaginator(Payment.objects.all(), '-created_at', per_page=3)
+        first = [p.pk for p in paginator.page()]
+        self.assertEqual([p.pk for p in paginator.page('not-a-cursor')], first)
+
+    def test_manage_users_renders_one_page(self):
+        self.login_as(make_user('super_admin'))
+        for _ in range(30):
+            make_user()
+
+        response = self.client.get(reverse('admin_manage_users'), {'user_type': 'passenger'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['users']), 25)
+        self.assertTrue(response.context['page'].has_next)
+        self.assertEqual(response.context['page'].approximate_total, 31)
+
+        response = self.client.get(reverse('admin_manage_users'), {
+            'user_type': 'passenger', 'cursor': response.context['page'].next_cursor,
+        })
+        self.assertEqual(len(response.context['users']), 6)
+        self.assertContains(response, 'user_type=passenger')
+
+
+class StatsRollupTests(SessionLoginMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.passenger = make_user()
+        sacco = make_sacco()
+        self.matatu = make_matatu(sacco)
+        self.route = make_route(sacco)
+
+    def make_payment(self, status='completed', amount='100.00', **extra):
+        return Payment.objects.create(
+            passenger=self.passenger, payment_type='credit_topup', amount=Decimal(amount),
+            transaction_id=f'TX{next(_seq)}', payment_method='mpesa', status=status, **extra
+        )
+
+    def snapshot(self):
+        rollups = list(StatsRollup.objects.filter(
+            Q(registrations__gt=0) | Q(completed_payments__gt=0)
+        ).values_list('hour', 'registrations', 'completed_payments', 'completed_amount'))
+        statuses = dict(TripStatusCount.objects.filter(count__gt=0).values_list('status', 'count'))
+        return rollups, statuses
+
+    def test_rollups_track_writes(self):
+        pending = self.make_payment(status='pending', amount='70.00')
+        self.make_payment(amount='100.00')
+        self.make_payment(amount='50.00').delete()
+        pending.status = 'completed'
+        pending.save()
+
+        trip = make_trip(self.matatu, self.route)
+        make_trip(self.matatu, self.route)
+        trip.status = 'active'
+        trip.save()
+
+        hour = StatsRollup.objects.get()
+        self.assertEqual(hour.registrations, 1)
+        self.assertEqual(hour.completed_payments, 2)
+        self.assertEqual(hour.completed_amount, Decimal('170.00'))
+        self.assertEqual(dict(TripStatusCount.objects.values_list('status', 'count')),
+                         {'scheduled': 1, 'active': 1})
+
+    def test_payment_listing_totals_are_cached_until_payments_change(self):
+        self.make_payment()
+        self.make_payment(status='failed', amount='40.00')
+        pending = self.make_payment(status='pending', amount='25.00')
+        self.login_as(make_user('super_admin'))
+        url = reverse('admin_manage_payments')
+
+        def totals(**params):
+            with mock.patch('matwanaapp.views.render', return_value=HttpResponse()) as render, \
+                    CaptureQueriesContext(connection) as queries:
+                self.client.get(url, params)
+            context = render.call_args.args[2]
+            sums = [q for q in queries if 'SUM(' in q['sql']]
+            return (context['total_amount'], context['completed_amount']), len(sums)
+
+        self.assertEqual(totals(), ((Decimal('165.00'), Decimal('100.00')), 1))
+        self.assertEqual(totals(), ((Decimal('165.00'), Decimal('100.00')), 0))
+        self.assertEqual(totals(status='failed'), ((Decimal('40.00'), Decimal('0')), 1))
+
+        # Settling a payment moves the totals
+        with self.captureOnCommitCallbacks(execute=True):
+            payments.apply_results([{'transaction_id': pending.transaction_id, 'status': 'failed'}])
+        self.assertEqual(totals(status='failed'), ((Decimal('65.00'), Decimal('0')), 1))
+
+    def test_backfill_matches_incremental_rollups(self):
+        self.make_payment()
+        self.make_payment(status='failed')
+        trip = make_trip(self.matatu, self.route)
+        trip.status = 'completed'
+        trip.save()
+        incremental = self.snapshot()
+
+        call_command('backfill_stats', stdout=StringIO())
+        self.assertEqual(self.snapshot(), incremental)
+
+    def test_dashboard_stats_reads_rollups(self):
+        self.login_as(make_user('super_admin'))
+        self.make_payment(amount='80.00')
+        make_trip(self.matatu, self.route, status='active')
+
+        # Today's activity is outside the 7 day window; move it back a day
+        yesterday = timezone.now() - timedelta(days=1)
+        StatsRollup.objects.update(hour=stats.hour_bucket(yesterday))
+
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('admin_dashboard_stats'))
+        data = response.json()
+
+        self.assertTrue(data['success'])
+        self.assertEqual(data['user_registrations'][-1]['count'], 2)
+        self.assertEqual(data['payment_stats'][-1], {
+            'date': timezone.localdate(yesterday).strftime('%Y-%m-%d'), 'total': 80.0, 'count': 1,
+        })
+        self.assertEqual(data['trip_stats'], {'active': 1, 'scheduled': 0, 'completed': 0})
+        rollup_reads = [q for q in ctx.captured_queries
+                        if 'matwanaapp_statsrollup' in q['sql'] or 'matwanaapp_tripstatuscount' in q['sql']]
+        self.assertEqual(len(rollup_reads), 2)
+
+
+class ResponseCacheTests(SessionLoginMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.passenger = make_user(credits=Decimal('500.00'))
+        sacco = make_sacco()
+        self.trip = make_trip(make_matatu(sacco), make_route(sacco))
+        self.login_as(self.passenger)
+        self.url = reverse('active_bookings_api')
+
+    def test_unchanged_poll_is_304_without_queries(self):
+        first = self.client.get(self.url)
+        self.assertEqual(first.status_code, 200)
+        self.assertIn('ETag', first)
+
+        with self.assertNumQueries(0):
+            second = self.client.get(self.url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(second.status_code, 304)
+
+    def test_write_bumps_version(self):
+        first = self.client.get(self.url)
+        self.assertEqual(first.json()['bookings'], [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            make_booking(self.passenger, self.trip)
+
+        second = self.client.get(self.url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(second.status_code, 200)
+        self.assertNotEqual(second['ETag'], first['ETag'])
+        self.assertEqual(len(second.json()['bookings']), 1)
+
+        # A trip update invalidates every passenger's view of it
+        with self.captureOnCommitCallbacks(execute=True):
+            self.trip.status = 'active'
+            self.trip.save()
+        third = self.client.get(self.url, HTTP_IF_NONE_MATCH=second['ETag'])
+        self.assertEqual(third.json()['bookings'][0]['status'], 'active')
+
+    def test_cache_is_per_user(self):
+        self.client.get(reverse('dashboard_data_api'))
+
+        other = make_user(credits=Decimal('20.00'))
+        self.login_as(other)
+        data = self.client.get(reverse('dashboard_data_api')).json()
+        self.assertEqual(data['stats']['wallet_balance'], 20.0)
+
+    def test_wrong_role_is_not_cached(self):
+        self.login_as(make_user('driver'))
+        response = self.client.get(self.url)
+        self.assertFalse(response.json()['success'])
+        self.assertNotIn('ETag', response)
+
+    def test_demoted_admin_loses_cached_stats(self):
+        admin = make_user('super_admin')
+        self.login_as(admin)
+        url = reverse('admin_dashboard_stats')
+        self.client.get(url)
+        cached = self.client.get(url)
+        self.assertTrue(cached.json()['success'])
+
+        # Demoted without touching the stats the entry was built from
+        with self.captureOnCommitCallbacks(execute=True):
+            User.objects.filter(pk=admin.pk).update(user_type='passenger')
+            principal.forget(admin.pk)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=cached['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.json()['success'])
+
+    def test_versions_are_shared_between_cache_instances(self):
+        # Two workers: each opens its own connection to the configured cache
+        worker_a, worker_b = caches.create_connection('default'), caches.create_connection('default')
+        with mock.patch('matwanaapp.response_cache.cache', worker_b):
+            before = get_versions(['trips'])
+        with mock.patch('matwanaapp.response_cache.cache', worker_a):
+            with self.captureOnCommitCallbacks(execute=True):
+                bump('trips')
+        with mock.patch('matwanaapp.response_cache.cache', worker_b):
+            self.assertNotEqual(get_versions(['trips']), before)
+
+class PrincipalTests(SessionLoginMixin, TestCase):
+    def user_queries(self, url):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        return response, [q['sql'] for q in ctx.captured_queries if 'FROM "matwanaapp_user"' in q['sql']]
+
+    def test_role_gated_views_skip_the_user_query(self):
+        self.login_as(make_user('driver'))
+        url = reverse('driver_dashboard')
+
+        response, queries = self.user_queries(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(queries), 1)
+
+        response, queries = self.user_queries(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(queries, [])
+
+        # Another process starts from the copy in the session
+        with mock.patch.object(principal, '_cache', principal.PrincipalCache()):
+            response, queries = self.user_queries(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(queries, [])
+
+    def test_principal_carries_the_sacco(self):
+        admin = make_user('sacco_admin')
+        sacco = make_sacco(admin=admin)
+        driver = make_user('driver')
+        make_matatu(sacco, current_driver=driver)
+
+        self.assertEqual(principal.load(admin.id).sacco_id, sacco.id)
+        self.assertEqual(principal.load(driver.id).sacco_id, sacco.id)
+        self.assertEqual(principal.load(driver.id).name, f'{driver.first_name} {driver.last_name}')
+        self.assertIsNone(principal.load(make_user().id).sacco_id)
+
+        self.login_as(admin)
+        self.assertEqual(self.client.get(reverse('sacco_dashboard')).context['sacco'], sacco)
+
+    def test_edit_and_delete_invalidate(self):
+        admin = make_user('super_admin')
+        self.login_as(admin)
+        url = reverse('admin_manage_users')
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            admin.user_type = 'passenger'
+            admin.save()
+        self.assertRedirects(self.client.get(url), reverse('login'), fetch_redirect_response=False)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            admin.user_type = 'super_admin'
+            admin.save()
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            admin.delete()
+        self.assertRedirects(self.client.get(url), reverse('login'), fetch_redirect_response=False)
+
+    def test_forget_reaches_other_processes(self):
+        admin = make_user('super_admin')
+        self.login_as(admin)
+        url = reverse('admin_manage_users')
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+        # The demotion is handled by another process, with its own LRU
+        with mock.patch.object(principal, '_cache', principal.PrincipalCache()):
+            with self.captureOnCommitCallbacks(execute=True):
+                User.objects.filter(pk=admin.pk).update(user_type='passenger')
+                principal.forget(admin.pk)
+        self.assertRedirects(self.client.get(url), reverse('login'), fetch_redirect_response=False)
+
+    def test_api_refusals(self):
+        url = reverse('admin_dashboard_stats')
+        self.assertEqual(self.client.get(url).json()['message'], 'Not authenticated')
+        self.login_as(make_user())
+        self.assertEqual(self.client.get(url).json()['message'], 'Access denied')
+
+    def test_cache_is_bounded(self):
+        cache = principal.PrincipalCache(max_entries=2, ttl=60)
+        now = time.time()
+        for pk in (1, 2, 3):
+            cache.put(principal.Principal(pk, 'passenger', None, 'A B'), now, now)
+        self.assertIsNone(cache.get(1, now))
+        self.assertEqual(cache.get(3, now).id, 3)
+        self.assertIsNone(cache.get(3, now + 61))
+
+        # A copy read before a forget() is not taken back in
+        cache.forget(2)
+        self.assertFalse(cache.put(principal.Principal(2, 'passenger', None, 'A B'), now, now))
+
+
+class LoginTests(TestCase):
+    def test_classify(self):
+        self.assertEqual(logins.classify(' Jane@Example.COM '), ('email', 'Jane@example.com'))
+        self.assertEqual(logins.classify('12345678'), ('id_number', '12345678'))
+        self.assertEqual(logins.classify('123456789'), ('id_number', '123456789'))
+        for phone in ('0712345678', '0712 345 678', '+254712345678', '254712345678', '+254 712-345-678'):
+            self.assertEqual(logins.classify(phone), ('phone_number', '+254712345678'), phone)
+        for junk in ('', '1234', 'jane', '0712abc678'):
+            self.assertIsNone(logins.classify(junk), junk)
+
+    def test_login_by_each_identifier_uses_one_index(self):
+        user = make_user(password='secret-pass', phone_number='+254712345678', id_number='12345678')
+        for identifier in (user.email, '0712 345 678', '12345678'):
+            self.client.logout()
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.client.post(reverse('login'), {'username': identifier, 'password': 'secret-pass'})
+            self.assertRedirects(response, reverse('dashboard'), fetch_redirect_response=False)
+            lookups = [q['sql'] for q in ctx.captured_queries if 'FROM "matwanaapp_user"' in q['sql']]
+            self.assertEqual(len(lookups), 1)
+            self.assertNotIn(' OR ', lookups[0])
+            self.assertFalse([q for q in ctx.captured_queries if q['sql'].startswith('UPDATE "matwanaapp_user"')])
+
+        self.client.logout()
+        response = self.client.post(reverse('login'), {'username': '0799999999', 'password': 'secret-pass'})
+        self.assertIn('Account not found', response.content.decode())
+
+    def test_last_login_is_written_in_one_update(self):
+        users = [make_user() for _ in range(3)]
+        self.assertTrue(all(user.last_login is None for user in users))
+
+        with self.settings(TASKS_ALWAYS_EAGER=True):
+            with CaptureQueriesContext(connection) as ctx, self.captureOnCommitCallbacks() as callbacks:
+                for user in users:
+                    logins.record_login(user.id)
+            # Only the first login schedules a flush
+            self.assertEqual(len(callbacks), 1)
+            self.assertEqual(len(ctx.captured_queries), 0)
+
+            with CaptureQueriesContext(connection) as ctx:
+                callbacks[0]()
+        self.assertEqual(len(ctx.captured_queries), 1)
+        self.assertIn('"last_login"', ctx.captured_queries[0]['sql'])
+        self.assertTrue(all(user.last_login for user in User.objects.filter(pk__in=[u.pk for u in users])))
+
+
+class HashingTests(SessionLoginMixin, TestCase):
+    def test_pool_turns_work_away_when_full(self):
+        pool = hashing.HashPool(workers=1, queue_limit=0, timeout=0.05)
+        started, release = threading.Event(), threading.Event()
+
+        def block():
+            started.set()
+            release.wait(5)
+            return 'done'
+
+        result = []
+        thread = threading.Thread(target=lambda: result.append(pool.run(block)))
+        thread.start()
+        started.wait(5)
+        self.assertEqual(pool.metrics()['running'], 1)
+        with self.assertRaises(hashing.HashingBusy):
+            pool.run(block)
+        release.set()
+        thread.join()
+
+        metrics = pool.metrics()
+        self.assertEqual(result, ['done'])
+        self.assertEqual((metrics['completed'], metrics['rejected'], metrics['queue_depth']), (1, 1, 0))
+        self.assertIsNotNone(metrics['hash_ms']['p95'])
+
+    def test_login_rehashes_to_the_current_cost(self):
+        with self.settings(PASSWORD_HASH_ITERATIONS=1000):
+            user = make_user(password='secret-pass')
+        self.assertTrue(user.password.startswith('pbkdf2_sha256$1000$'))
+
+        with self.settings(PASSWORD_HASH_ITERATIONS=2000, TASKS_ALWAYS_EAGER=True):
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(reverse('login'), {'username': user.email, 'password': 'secret-pass'})
+            self.assertRedirects(response, reverse('dashboard'), fetch_redirect_response=False)
+            user.refresh_from_db()
+            self.assertTrue(user.password.startswith('pbkdf2_sha256$2000$'))
+            self.assertEqual(hashing.verify('secret-pass', user.password), (True, False))
+
+    def test_busy_pool_answers_503(self):
+        user = make_user(password='secret-pass')
+        with mock.patch.object(hashing, 'verify', side_effect=hashing.HashingBusy):
+            response = self.client.post(reverse('login'), {'username': user.email, 'password': 'secret-pass'})
+        self.assertEqual(response.status_code, 503)
+        self.assertNotIn('user_id', self.client.session)
+
+    def test_metrics_api(self):
+        self.login_as(make_user('super_admin', password='secret-pass'))
+        metrics = self.client.get(reverse('admin_hashing_metrics')).json()['metrics']
+        self.assertGreaterEqual(metrics['completed'], 1)
+        self.assertIn('queue_depth', metrics)
+
+class BulkImportTests(SessionLoginMixin, TestCase):
+    def csv_file(self, *lines):
+        return BytesIO('\n'.join(lines).encode())
+
+    def test_matatus_report_duplicates_and_bad_rows(self):
+        sacco = make_sacco(registration_number='REG-IMPORT')
+        make_matatu(sacco, plate_number='KDA 001A')
+        driver = make_user('driver', phone_number='+254711000001')
+        file = self.csv_file(
+            'Plate Number,Fleet Number,Sacco,Vehicle Type,Capacity,Driver',
+            'kdb 100a,F-100,REG-IMPORT,minibus,14,0711000001',
+            'KDA 001A,F-101,REG-IMPORT,minibus,14,',
+            'KDB 100A,F-102,REG-IMPORT,minibus,14,',
+            'KDB 101A,F-103,Nowhere,minibus,14,',
+            'KDB 102A,F-104,REG-IMPORT,lorry,14,',
+            'KDB 103A,F-105,REG-IMPORT,bus,many,',
+            'KDB 104A,F-106,REG-IMPORT,bus,33,',
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            report = bulk_import.run('matatus', file, 'matatus.csv')
+
+        self.assertEqual((report.rows, report.created, report.error_count), (7, 2, 5))
+        self.assertEqual([line for line, _ in report.errors], [3, 4, 5, 6, 7])
+        self.assertIn('already registered', report.errors[0][1])
+        self.assertIn('already registered', report.errors[1][1])
+        matatu = Matatu.objects.get(plate_number='KDB 100A')
+        self.assertEqual((matatu.sacco, matatu.current_driver), (sacco, driver))
+        self.assertTrue(matatu.qr_code_data.startswith('MATATU:KDB 100A:F-100:'))
+
+    def test_queries_do_not_grow_with_rows(self):
+        sacco = make_sacco()
+
+        def run(count):
+            lines = ['name,start_point,end_point,distance_km,estimated_duration_minutes,standard_fare,sacco']
+            first = next(_seq) * 1000
+            lines += [f'Route {first + n},Town,Ngong,12.5,45,100,{sacco.name}' for n in range(count)]
+            with CaptureQueriesContext(connection) as queries:
+                report = bulk_import.run('routes', self.csv_file(*lines), 'routes.csv', chunk_size=50)
+            self.assertEqual(report.created, count)
+            return len(queries)
+
+        # Another chunk costs its INSERT and savepoint, not a query per row
+        self.assertLessEqual(run(100) - run(50), 3)
+        route = Route.objects.filter(sacco=sacco).first()
+        self.assertIn('ngong', route.search_text)
+
+    def test_users_from_xlsx(self):
+        from openpyxl import Workbook
+
+        sacco = make_sacco(name='Import Sacco')
+        taken = make_user()
+        workbook = Workbook()
+        sheet = workbook.active
+        sheet.append(['user_type', 'first_name', 'last_name', 'email', 'phone_number', 'id_number', 'password', 'sacco'])
+        sheet.append(['sacco_admin', 'Ann', 'Admin', 'Ann@Example.com', 722000001, 30000001, 'secret-pass', 'import sacco'])
+        sheet.append(['passenger', 'Dup', 'Email', taken.email, '0722000002', '30000002', None, None])
+        sheet.append(['passenger', 'Dup', 'Phone', 'dup@example.com', '+254 722 000 001', '30000003', None, None])
+        sheet.append(['captain', 'Bad', 'Type', 'bad@example.com', '0722000004', '30000004', None, None])
+        sheet.append(['passenger', 'Pat', 'Passenger', 'pat@example.com', '0722000005', '30000005', None, None])
+        file = BytesIO()
+        workbook.save(file)
+        file.seek(0)
+
+        registrations = StatsRollup.objects.aggregate(total=Sum('registrations'))['total']
+        with self.captureOnCommitCallbacks(execute=True):
+            report = bulk_import.run('users', file, 'users.xlsx')
+
+        self.assertEqual((report.created, report.error_count), (2, 3), report.errors)
+        admin = User.objects.get(email='Ann@example.com')
+        self.assertEqual((admin.phone_number, admin.id_number), ('+254722000001', '30000001'))
+        self.assertTrue(admin.check_password('secret-pass'))
+        self.assertFalse(User.objects.get(email='pat@example.com').has_usable_password())
+        sacco.refresh_from_db()
+        self.assertEqual(sacco.admin, admin)
+        self.assertEqual(StatsRollup.objects.aggregate(total=Sum('registrations'))['total'], registrations + 2)
+
+    def test_dry_run_writes_nothing(self):
+        make_sacco(name='Dry Sacco')
+        file = self.csv_file(
+            'plate_number,fleet_number,sacco,vehicle_type,capacity',
+            'KDC 001A,F-200,Dry Sacco,minibus,14',
+        )
+        report = bulk_import.run('matatus', file, 'matatus.csv', dry_run=True)
+        self.assertEqual(report.created, 1)
+        self.assertFalse(Matatu.objects.filter(plate_number='KDC 001A').exists())
+
+    def test_passwords_hash_in_parallel_and_not_on_dry_runs(self):
+        lines = ['user_type,first_name,last_name,email,phone_number,id_number,password']
+        lines += [f'passenger,P{n},Hash,hash{n}@example.com,07330000{n:02d},400000{n:02d},pass-{n}' for n in range(6)]
+        lock = threading.Lock()
+        running = []
+        peak = []
+
+        def slow_hash(password, *args):
+            if password is None:
+                return '!unusable'
+            if password == 'pass-5':
+                raise hashing.HashingBusy('Too many passwords waiting to be hashed')
+            with lock:
+                running.append(password)
+                peak.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(password)
+            return f'hashed:{password}'
+
+        with mock.patch('matwanaapp.hashing.hashers.make_password', side_effect=slow_hash) as make_password:
+            report = bulk_import.run('users', self.csv_file(*lines), 'users.csv', dry_run=True)
+            self.assertEqual(report.created, 6)
+            # Only the shared unusable password
+            self.assertEqual(make_password.call_args_list, [mock.call(None)])
+
+            with self.captureOnCommitCallbacks(execute=True):
+                report = bulk_import.run('users', self.csv_file(*lines), 'users.csv')
+
+        self.assertGreater(max(peak), 1)
+        self.assertEqual(report.created, 5)
+        self.assertEqual(report.errors, [(7, 'Password could not be hashed now; import this row again later')])
+        self.assertEqual(User.objects.get(email='hash0@example.com').password, 'hashed:pass-0')
+        self.assertFalse(User.objects.filter(email='hash5@example.com').exists())
+
+    def test_failure_part_way_keeps_the_report_and_follow_up(self):
+        sacco = make_sacco()
+        lines = ['name,start_point,end_point,distance_km,estimated_duration_minutes,standard_fare,sacco']
+        lines += [f'Stopped Route {n},Town,Ngong,12.5,45,100,{sacco.name}' for n in range(4)]
+        insert = bulk_import._insert
+
+        def insert_then_fail(importer, accepted, report):
+            if report.created:
+                raise RuntimeError('connection lost')
+            insert(importer, accepted, report)
+
+        before = get_versions(['routes'])
+        with mock.patch('matwanaapp.bulk_import._insert', side_effect=insert_then_fail), \
+                self.captureOnCommitCallbacks(execute=True), \
+                self.assertRaisesMessage(bulk_import.ImportStopped, 'Stopped after 4 rows: connection lost') as stopped:
+            bulk_import.run('routes', self.csv_file(*lines), 'routes.csv', chunk_size=2)
+
+        self.assertEqual((stopped.exception.report.rows, stopped.exception.report.created), (4, 2))
+        self.assertEqual(Route.objects.filter(name__startswith='Stopped Route').count(), 2)
+        # The routes written are searchable straight away
+        self.assertNotEqual(get_versions(['routes']), before)
+
+    def test_admin_upload(self):
+        make_sacco(name='Upload Sacco')
+        self.login_as(make_user('super_admin'))
+        self.assertEqual(self.client.get(reverse('admin_import_data')).status_code, 200)
+
+        upload = SimpleUploadedFile('matatus.csv', b'plate_number,fleet_number,sacco,vehicle_type\nKDD 001A,F-300,Upload Sacco,bus\n')
+        response = self.client.post(reverse('admin_import_data'), {'kind': 'matatus', 'file': upload})
+        self.assertContains(response, 'Missing column(s): capacity')
+
+        upload = SimpleUploadedFile('matatus.csv', b'plate_number,fleet_number,sacco,vehicle_type,capacity\nKDD 001A,F-300,Upload Sacco,bus,33\n')
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('admin_import_data'), {'kind': 'matatus', 'file': upload})
+        self.assertContains(response, '1 of 1 rows imported')
+        self.assertTrue(Matatu.objects.filter(plate_number='KDD 001A').exists())
+
+class ExportTests(SessionLoginMixin, TestCase):
+    def setUp(self):
+        self.login_as(make_user('super_admin'))
+        self.passenger = make_user(first_name='Pay', last_name='Er')
+        for n, (status, payment_type) in enumerate([('completed', 'trip'), ('completed', 'credit_topup'),
+                                                     ('failed', 'trip'), ('completed', 'trip')]):
+            Payment.objects.create(
+                passenger=self.passenger, payment_type=payment_type, amount=Decimal('50.00'),
+                transaction_id=f'EXP{n}', payment_method='mpesa', status=status,
+            )
+        Payment.objects.filter(transaction_id='EXP3').update(created_at=timezone.now() - timedelta(days=3))
+
+    def download(self, name, **params):
+        response = self.client.get(reverse(name), params)
+        self.assertTrue(response.streaming)
+        return response, b''.join(response.streaming_content)
+
+    def test_payments_csv_applies_filters(self):
+        today = timezone.localdate().isoformat()
+        response, content = self.download('admin_export_payments', status='completed', payment_type='trip', date_from=today)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertIn('attachment; filename="payments-', response['Content-Disposition'])
+
+        rows = list(csv.reader(StringIO(content.decode())))
+        self.assertEqual(rows[0][:2], ['Transaction ID', 'Created'])
+        self.assertEqual([row[0] for row in rows[1:]], ['EXP0'])
+        # Phone numbers start with '+', which Excel would read as a formula
+        self.assertEqual(rows[1][3:9], ['Pay Er', "'" + self.passenger.phone_number, 'Trip Payment', 'mpesa', '50.00', 'Completed'])
+
+    def test_trips_xlsx_applies_sacco_filter(self):
+        from openpyxl import load_workbook
+
+        sacco, other = make_sacco(), make_sacco()
+        driver = make_user('driver', first_name='Dee', last_name='River')
+        trip = make_trip(make_matatu(sacco, current_driver=driver), make_route(sacco), driver=driver)
+        make_trip(make_matatu(other), make_route(other))
+
+        response, content = self.download('admin_export_trips', sacco=sacco.pk, format='xlsx')
+        self.assertIn('trips-', response['Content-Disposition'])
+        sheet = load_workbook(BytesIO(content), read_only=True).active
+        rows = list(sheet.iter_rows(values_only=True))
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[1][0], trip.pk)
+        self.assertEqual(rows[1][6:10], (sacco.name, trip.matatu.plate_number, trip.matatu.fleet_number, 'Dee River'))
+        self.assertEqual(rows[1][1], timezone.localtime(trip.scheduled_departure).replace(tzinfo=None, microsecond=0))
+
+    def test_queries_do_not_grow_with_rows(self):
+        # Warm the session principal
+        self.download('admin_export_payments')
+        with CaptureQueriesContext(connection) as few:
+            self.download('admin_export_payments')
+        for n in range(20):
+            Payment.objects.create(
+                passenger=make_user(), payment_type='trip', amount=Decimal('10.00'),
+                transaction_id=f'MORE{n}', payment_method='mpesa', status='completed',
+            )
+        with CaptureQueriesContext(connection) as many:
+            self.download('admin_export_payments')
+        self.assertEqual(len(many), len(few))
+
+    def test_cells_that_excel_would_run_are_escaped(self):
+        from openpyxl import load_workbook
+
+        User.objects.filter(pk=self.passenger.pk).update(first_name='=HYPERLINK("http://evil.example","x")', last_name='Er')
+        Payment.objects.filter(transaction_id='EXP0').update(gateway_reference='@SUM(1+1)')
+        Payment.objects.filter(transaction_id='EXP1').update(gateway_reference='-2+3')
+
+        _, content = self.download('admin_export_payments')
+        rows = {row[0]: row for row in csv.reader(StringIO(content.decode()))}
+        self.assertEqual(rows['EXP0'][3], '\'=HYPERLINK("http://evil.example","x") Er')
+        self.assertEqual(rows['EXP0'][9], "'@SUM(1+1)")
+        self.assertEqual(rows['EXP1'][9], "'-2+3")
+        self.assertEqual(rows['EXP2'][9], '')
+
+        _, content = self.download('admin_export_payments', format='xlsx')
+        sheet = load_workbook(BytesIO(content)).active
+        rows = {row[0].value: row for row in sheet.iter_rows(min_row=2)}
+        self.assertEqual(rows['EXP0'][3].data_type, 's')
+        self.assertEqual(rows['EXP0'][3].value, '\'=HYPERLINK("http://evil.example","x") Er')
+        self.assertEqual(rows['EXP0'][9].value, "'@SUM(1+1)")
+
+    def test_reads_in_keyset_batches(self):
+        # Ties on created_at are broken by pk, so no row is skipped or repeated
+        Payment.objects.filter(transaction_id__in=['EXP0', 'EXP1', 'EXP2']).update(created_at=timezone.now())
+        self.download('admin_export_payments')
+        with mock.patch('matwanaapp.exports.CHUNK_SIZE', 2), CaptureQueriesContext(connection) as queries:
+            _, content = self.download('admin_export_payments')
+        rows = list(csv.reader(StringIO(content.decode())))
+        self.assertEqual([row[0] for row in rows[1:]], ['EXP2', 'EXP1', 'EXP0', 'EXP3'])
+        # Each batch reads one row ahead to know whether another follows
+        batches = [query for query in queries if 'matwanaapp_payment' in query['sql']]
+        self.assertEqual(len(batches), 2)
+        self.assertTrue(all('LIMIT 3' in query['sql'] for query in batches))
+
+    def test_requires_super_admin(self):
+        self.login_as(self.passenger)
+        response = self.client.get(reverse('admin_export_payments'))
+        self.assertFalse(response.streaming)
+
+def run_concurrently(func, calls):
+    """Run func(*args) for each args tuple on its own thread, all released at once"""
+    barrier = threading.Barrier(len(calls))
+    results = []
+    lock = threading.Lock()
+
+    def worker(args):
+        try:
+            barrier.wait()
+            try:
+                result = func(*args)
+            except Exception as e:
+                result = e
+            with lock:
+                results.append(result)
+        finally:
+            connections.close_all()
+
+    threads = [threading.Thread(target=worker, args=(args,)) for args in calls]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class BookingTests(SessionLoginMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        sacco = make_sacco()
+        self.route = make_route(sacco, standard_fare=Decimal('100.00'))
+        self.trip = make_trip(make_matatu(sacco, capacity=2), self.route)
+        self.passenger = make_user(credits=Decimal('250.00'))
+
+    def test_booking_debits_wallet_and_takes_a_seat(self):
+        booking = book_trip(self.passenger.id, self.trip.id, self.route.id)
+
+        self.passenger.refresh_from_db()
+        self.trip.refresh_from_db()
+        self.assertEqual(self.passenger.credits, Decimal('150.00'))
+        self.assertEqual(self.trip.booked_seats, 1)
+        self.assertTrue(Payment.objects.filter(
+            passenger=self.passenger, payment_type='trip', amount=Decimal('100.00'), status='completed'
+        ).exists())
+        self.assertEqual(booking.fare_paid, Decimal('100.00'))
+
+    def test_refusals_leave_no_trace(self):
+        book_trip(self.passenger.id, self.trip.id)
+        with self.assertRaisesMessage(BookingError, 'already booked'):
+            book_trip(self.passenger.id, self.trip.id)
+
+        broke = make_user(credits=Decimal('10.00'))
+        with self.assertRaisesMessage(BookingError, 'Insufficient'):
+            book_trip(broke.id, self.trip.id)
+
+        book_trip(make_user(credits=Decimal('100.00')).id, self.trip.id)
+        with self.assertRaisesMessage(BookingError, 'fully booked'):
+            book_trip(make_user(credits=Decimal('100.00')).id, self.trip.id)
+
+        self.trip.refresh_from_db()
+        broke.refresh_from_db()
+        self.assertEqual(self.trip.booked_seats, 2)
+        self.assertEqual(PassengerTrip.objects.filter(trip=self.trip).count(), 2)
+        self.assertEqual(broke.credits, Decimal('10.00'))
+
+    def test_book_trip_api(self):
+        self.login_as(self.passenger)
+        response = self.client.post(
+            reverse('book_trip_api'),
+            {'route_id': self.route.id, 'trip_id': self.trip.id},
+            content_type='application/json',
+        )
+        self.assertTrue(response.json()['success'])
+
+        response = self.client.post(
+            reverse('book_trip_api'),
+            {'route_id': self.route.id, 'trip_id': 0},
+            content_type='application/json',
+        )
+        self.assertEqual(response.json(), {'success': False, 'message': 'Trip not found'})
+
+
+class BookingConcurrencyTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        sacco = make_sacco()
+        self.route = make_route(sacco, standard_fare=Decimal('100.00'))
+        self.matatu = make_matatu(sacco, capacity=5)
+
+    def test_no_overbooking_under_contention(self):
+        trip = make_trip(self.matatu, self.route)
+        passengers = [make_user(credits=Decimal('100.00')) for _ in range(20)]
+
+        results = run_concurrently(book_trip, [(p.id, trip.id) for p in passengers])
+
+        booked = [r for r in results if isinstance(r, PassengerTrip)]
+        refused = [r for r in results if isinstance(r, BookingError)]
+        self.assertEqual(len(booked), 5)
+        self.assertEqual(len(refused), 15)
+
+        trip.refresh_from_db()
+        self.assertEqual(trip.booked_seats, 5)
+        self.assertEqual(PassengerTrip.objects.filter(trip=trip).count(), 5)
+        self.assertEqual(User.objects.filter(credits=0).count(), 5)
+
+    def test_no_double_spend_across_trips(self):
+        trips = [make_trip(self.matatu, self.route) for _ in range(10)]
+        passenger = make_user(credits=Decimal('200.00'))
+
+        results = run_concurrently(book_trip, [(passenger.id, trip.id) for trip in trips])
+
+        self.assertEqual(len([r for r in results if isinstance(r, PassengerTrip)]), 2)
+        passenger.refresh_from_db()
+        self.assertEqual(passenger.credits, Decimal('0.00'))
+        self.assertEqual(Trip.objects.filter(booked_seats=1).count(), 2)
+
+
+class WalletTests(SessionLoginMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.passenger = make_user(credits=Decimal('50.00'))
+
+    def ledger(self):
+        return list(self.passenger.wallet_entries.order_by('pk').values_list('kind', 'amount', 'balance_after'))
+
+    def test_every_change_is_in_the_ledger(self):
+        sacco = make_sacco()
+        route = make_route(sacco, standard_fare=Decimal('80.00'))
+        trip = make_trip(make_matatu(sacco), route)
+
+        with self.settings(TASKS_ALWAYS_EAGER=True), self.captureOnCommitCallbacks(execute=True):
+            payments.start_top_up(self.passenger.id, Decimal('100.00'), 'mpesa')
+        booking = book_trip(self.passenger.id, trip.id)
+        cancel_booking(self.passenger.id, booking.id)
+        self.assertIsNone(wallet.debit(self.passenger.id, Decimal('500.00'), 'trip'))
+
+        self.assertEqual(self.ledger(), [
+            ('opening', Decimal('50.00'), Decimal('50.00')),
+            ('topup', Decimal('100.00'), Decimal('150.00')),
+            ('trip', Decimal('-80.00'), Decimal('70.00')),
+            ('refund', Decimal('80.00'), Decimal('150.00')),
+        ])
+        self.passenger.refresh_from_db()
+        self.assertEqual(self.passenger.credits, Decimal('150.00'))
+        self.assertEqual(wallet.drifted_wallets(), [])
+
+    def test_admin_edit_keeps_concurrent_top_up(self):
+        self.login_as(make_user('super_admin'))
+
+        def load_then_top_up(model, **lookup):
+            user = get_object_or_404(model, **lookup)
+            # Commits while the edit form is being handled
+            wallet.credit(user.pk, Decimal('100.00'), 'topup')
+            return user
+
+        with mock.patch('matwanaapp.views.get_object_or_404', side_effect=load_then_top_up):
+            response = self.client.post(reverse('admin_edit_user', args=[self.passenger.id]), {
+                'user_type': 'passenger', 'first_name': 'Renamed', 'last_name': 'User',
+                'email': self.passenger.email, 'phone_number': self.passenger.phone_number, 'is_active': 'on',
+            })
+        self.assertRedirects(response, reverse('admin_manage_users'), fetch_redirect_response=False)
+
+        self.passenger.refresh_from_db()
+        self.assertEqual((self.passenger.first_name, self.passenger.credits), ('Renamed', Decimal('150.00')))
+        self.assertEqual(wallet.drifted_wallets(), [])
+
+    def test_top_up_views_use_decimals(self):
+        self.login_as(self.passenger)
+        with self.settings(TASKS_ALWAYS_EAGER=True), self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse('process_payment'), {'amount': '100.10', 'payment_method': 'mpesa'},
+                content_type='application/json',
+            )
+        self.assertEqual(response.json()['status'], 'pending')
+        self.passenger.refresh_from_db()
+        self.assertEqual(self.passenger.credits, Decimal('150.10'))
+
+        for amount in ('abc', '50', 'NaN', '-200'):
+            response = self.client.post(
+                reverse('process_payment'), {'amount': amount}, content_type='application/json',
+            )
+            self.assertFalse(response.json()['success'])
+
+        with self.settings(TASKS_ALWAYS_EAGER=True), self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('top_up_wallet'), {'amount': '200.05', 'payment_method': 'card'})
+        self.passenger.refresh_from_db()
+        self.assertEqual(self.passenger.credits, Decimal('350.15'))
+        self.assertEqual(Payment.objects.filter(passenger=self.passenger, status='completed').count(), 2)
+        self.assertEqual(wallet.drifted_wallets(), [])
+
+    def test_reconcile_wallets_repairs_drift(self):
+        wallet.credit(self.passenger.id, Decimal('25.00'), 'adjustment')
+        User.objects.filter(pk=self.passenger.pk).update(credits=Decimal('999.00'))
+
+        out = StringIO()
+        call_command('reconcile_wallets', '--dry-run', stdout=out)
+        self.assertIn(f'User {self.passenger.pk}: credits=999.00, ledger=75.00', out.getvalue())
+
+        call_command('reconcile_wallets', stdout=StringIO())
+        self.passenger.refresh_from_db()
+        self.assertEqual(self.passenger.credits, Decimal('75.00'))
+        self.assertEqual(wallet.drifted_wallets(), [])
+
+
+class WalletConcurrencyTests(TransactionTestCase):
+    def test_parallel_top_ups_and_bookings_balance(self):
+        cache.clear()
+        sacco = make_sacco()
+        route = make_route(sacco, standard_fare=Decimal('100.00'))
+        matatu = make_matatu(sacco, capacity=14)
+        trips = [make_trip(matatu, route) for _ in range(100)]
+        passenger = make_user(credits=Decimal('1000.00'))
+
+        calls = [(payments.start_top_up, passenger.id, Decimal('50.00'), 'mpesa') for _ in range(100)]
+        calls += [(book_trip, passenger.id, trip.id) for trip in trips]
+        random.Random(7).shuffle(calls)
+        with self.settings(TASKS_ALWAYS_EAGER=True):
+            results = run_concurrently(lambda func, *args: func(*args), calls)
+
+        errors = [r for r in results if isinstance(r, Exception) and not isinstance(r, BookingError)]
+        self.assertEqual(errors, [])
+        booked = PassengerTrip.objects.filter(passenger=passenger).count()
+        refused = len([r for r in results if isinstance(r, BookingError)])
+        self.assertEqual(booked + refused, 100)
+
+        passenger.refresh_from_db()
+        self.assertEqual(passenger.credits, Decimal('1000.00') + 100 * Decimal('50.00') - booked * Decimal('100.00'))
+        self.assertGreaterEqual(passenger.credits, 0)
+        self.assertEqual(WalletEntry.objects.filter(user=passenger).count(), 1 + 100 + booked)
+        self.assertEqual(wallet.drifted_wallets(), [])
+
+
+def make_ids(count):
+    return [ids.new_id() for _ in range(count)]
+
+
+class TransactionIdTests(TestCase):
+    def test_ids_are_unique_and_ordered(self):
+        made = make_ids(50000)
+        self.assertEqual(len(set(made)), len(made))
+        self.assertEqual(made, sorted(made))
+        self.assertTrue(all(len(value) == ids.LENGTH for value in made))
+
+        results = run_concurrently(make_ids, [(5000,)] * 8)
+        threaded = [value for result in results for value in result]
+        self.assertEqual(len(set(threaded + made)), len(threaded) + len(made))
+
+    def test_ids_from_other_processes_differ(self):
+        import multiprocessing
+        with multiprocessing.get_context('fork').Pool(4) as pool:
+            results = pool.map(make_ids, [5000] * 4)
+        made = [value for result in results for value in result] + make_ids(5000)
+        self.assertEqual(len(set(made)), len(made))
+
+    def test_sequence_overflow_and_clock_steps(self):
+        generator = ids.IdGenerator(node=7)
+        with mock.patch.object(ids.time, 'time_ns', return_value=1_700_000_000_000 * 1_000_000):
+            made = [generator.next_int() for _ in range(ids.MAX_SEQUENCE + 3)]
+        with mock.patch.object(ids.time, 'time_ns', return_value=1_600_000_000_000 * 1_000_000):
+            made.append(generator.next_int())
+        self.assertEqual(made, sorted(set(made)))
+        self.assertEqual(ids.timestamp_ms(ids.encode(made[-1])), 1_700_000_000_001)
+
+    def test_payments_get_prefixed_ids(self):
+        passenger = make_user(credits=Decimal('100.00'))
+        sacco = make_sacco()
+        trip = make_trip(make_matatu(sacco), make_route(sacco, standard_fare=Decimal('50.00')))
+        with self.settings(TASKS_ALWAYS_EAGER=True), self.captureOnCommitCallbacks(execute=True):
+            payments.start_top_up(passenger.id, Decimal('100.00'), 'mpesa')
+            payments.start_top_up(passenger.id, Decimal('100.00'), 'mpesa')
+        cancel_booking(passenger.id, book_trip(passenger.id, trip.id).id)
+
+        transaction_ids = list(Payment.objects.order_by('pk').values_list('transaction_id', flat=True))
+        self.assertEqual([value[:-ids.LENGTH] for value in transaction_ids], ['TOPUP', 'TOPUP', 'TRIP', 'REFUND'])
+        self.assertEqual(len(set(transaction_ids)), 4)
+
+
+class IdempotencyTests(SessionLoginMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.passenger = make_user(credits=Decimal('0.00'))
+        self.login_as(self.passenger)
+
+    def top_up(self, key, amount='100'):
+        headers = {'Idempotency-Key': key} if key else {}
+        with self.settings(TASKS_ALWAYS_EAGER=True), self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(
+                reverse('process_payment'), {'amount': amount, 'payment_method': 'mpesa'},
+                content_type='application/json', headers=headers,
+            )
+
+    def balance(self):
+        self.passenger.refresh_from_db()
+        return self.passenger.credits
+
+    def test_retry_replays_the_stored_response(self):
+        first = self.top_up('key-1')
+        retry = self.top_up('key-1')
+        self.assertEqual(retry.content, first.content)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(self.balance(), Decimal('100.00'))
+        self.assertEqual(Payment.objects.count(), 1)
+
+        # A new key, or none at all, is a new top-up
+        self.top_up('key-2')
+        self.top_up(None)
+        self.assertEqual(self.balance(), Decimal('300.00'))
+
+    def test_key_reused_for_another_request_is_refused(self):
+        self.top_up('key-1')
+        response = self.top_up('key-1', amount='500')
+        self.assertIn('different request', response.json()['message'])
+        self.assertEqual(self.balance(), Decimal('100.00'))
+
+        # Keys belong to one user
+        self.login_as(make_user())
+        self.assertTrue(self.top_up('key-1').json()['success'])
+
+    def test_book_trip_api_is_idempotent(self):
+        sacco = make_sacco()
+        route = make_route(sacco, standard_fare=Decimal('40.00'))
+        trip = make_trip(make_matatu(sacco), route)
+        self.top_up('key-1')
+
+        responses = [
+            self.client.post(reverse('book_trip_api'), {'route_id': route.id, 'trip_id': trip.id},
+                             content_type='application/json', headers={'Idempotency-Key': 'book-1'})
+            for _ in range(2)
+        ]
+        self.assertEqual(responses[0].json(), responses[1].json())
+        self.assertTrue(responses[1].json()['success'])
+        self.assertEqual(self.balance(), Decimal('60.00'))
+
+    def test_expired_and_abandoned_keys_are_reused(self):
+        self.top_up('key-1')
+        IdempotencyRecord.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertNotIn('Idempotent-Replayed', self.top_up('key-1'))
+        self.assertEqual(self.balance(), Decimal('200.00'))
+
+        # A claim whose request never finished
+        record = IdempotencyRecord.objects.get()
+        IdempotencyRecord.objects.update(status_code=None, body=None)
+        self.assertIn('still being processed', self.top_up('key-1').json()['message'])
+        IdempotencyRecord.objects.update(created_at=record.created_at - idempotency.LOCK_TIMEOUT)
+        self.assertTrue(self.top_up('key-1').json()['success'])
+        self.assertEqual(self.balance(), Decimal('300.00'))
+
+        IdempotencyRecord.objects.update(expires_at=timezone.now())
+        self.assertEqual(idempotency.prune(), 1)
+
+    def test_replay_keeps_headers_and_cookies(self):
+        def view(request):
+            response = HttpResponseRedirect('/done/')
+            response['Connection'] = 'close'
+            response['Cache-Control'] = 'no-store'
+            response.set_cookie('receipt', 'r-1', max_age=60, httponly=True, samesite='Lax')
+            return response
+
+        view = idempotency.idempotent(view)
+        request = mock.Mock(method='POST', path='/x/', body=b'{}', headers={'Idempotency-Key': 'k'},
+                            session={'user_id': self.passenger.id})
+        first = view(request)
+        retry = view(request)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.status_code, 302)
+        self.assertEqual(retry['Location'], '/done/')
+        self.assertEqual(retry['Cache-Control'], 'no-store')
+        self.assertEqual(retry.cookies['receipt'].OutputString(), first.cookies['receipt'].OutputString())
+        # Hop-by-hop headers belong to the first connection only
+        self.assertNotIn('Connection', retry)
+
+    def test_crashed_view_frees_the_key(self):
+        view = idempotency.idempotent(mock.Mock(side_effect=RuntimeError('boom')))
+        request = mock.Mock(method='POST', path='/x/', body=b'{}', headers={'Idempotency-Key': 'k'},
+                            session={'user_id': self.passenger.id})
+        with self.assertRaises(RuntimeError):
+            view(request)
+        self.assertFalse(IdempotencyRecord.objects.exists())
+
+
+class IdempotencyConcurrencyTests(TransactionTestCase):
+    def test_concurrent_duplicates_credit_once(self):
+        passenger = make_user()
+        client = self.client_class()
+        session = client.session
+        session['user_id'] = passenger.id
+        session['user_type'] = 'passenger'
+        session.save()
+
+        def post():
+            duplicate = self.client_class()
+            duplicate.cookies = client.cookies
+            return duplicate.post(
+                reverse('process_payment'), {'amount': '100', 'payment_method': 'mpesa'},
+                content_type='application/json', headers={'Idempotency-Key': 'same-key'},
+            ).json()
+
+        with self.settings(TASKS_ALWAYS_EAGER=True):
+            results = run_concurrently(post, [()] * 12)
+
+        self.assertTrue(all(isinstance(r, dict) for r in results), results)
+        succeeded = [r for r in results if r['success']]
+        self.assertGreaterEqual(len(succeeded), 1)
+        self.assertTrue(all(r == succeeded[0] for r in succeeded))
+        self.assertTrue(all('still being processed' in r['message'] for r in results if not r['success']))
+
+        passenger.refresh_from_db()
+        self.assertEqual(passenger.credits, Decimal('100.00'))
+        self.assertEqual(Payment.objects.filter(passenger=passenger).count(), 1)
+
+
+class RecordingGateway:
+    requested = []
+
+    def request_payment(self, payment):
+        self.requested.append(payment.transaction_id)
+        return f'REF-{payment.pk}'
+
+
+@override_settings(PAYMENT_CALLBACK_SECRET='test-secret')
+class PaymentPipelineTests(SessionLoginMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        RecordingGateway.requested = []
+        self.passenger = make_user()
+        self.login_as(self.passenger)
+
+    def request_top_up(self, amount):
+        with self.settings(TASKS_ALWAYS_EAGER=True, PAYMENT_GATEWAY='matwanaapp.tests.RecordingGateway'), \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse('process_payment'), {'amount': amount, 'payment_method': 'mpesa'},
+                content_type='application/json',
+            )
+        return Payment.objects.get(transaction_id=response.json()['transaction_id'])
+
+    def callback(self, results, secret=None):
+        body = json.dumps({'results': results}).encode()
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(
+                reverse('payment_callback_api'), body, content_type='application/json',
+                headers={payments.SIGNATURE_HEADER: payments.sign(body, secret)},
+            )
+
+    def balance(self):
+        self.passenger.refresh_from_db()
+        return self.passenger.credits
+
+    def test_top_up_waits_for_the_gateway(self):
+        first = self.request_top_up('150')
+        second = self.request_top_up('200')
+        self.assertEqual(RecordingGateway.requested, [first.transaction_id, second.transaction_id])
+        self.assertEqual((first.status, first.gateway_reference), ('pending', f'REF-{first.pk}'))
+        self.assertEqual(self.balance(), 0)
+
+        response = self.callback([
+            {'transaction_id': first.transaction_id, 'status': 'completed'},
+            {'transaction_id': second.transaction_id, 'status': 'failed'},
+            {'transaction_id': 'UNKNOWN', 'status': 'completed'},
+        ])
+        self.assertEqual(response.json(), {'success': True, 'completed': 1, 'failed': 1})
+        self.assertEqual(self.balance(), Decimal('150.00'))
+        statuses = dict(Payment.objects.values_list('transaction_id', 'status'))
+        self.assertEqual(statuses, {first.transaction_id: 'completed', second.transaction_id: 'failed'})
+        self.assertEqual(StatsRollup.objects.get().completed_amount, Decimal('150.00'))
+
+        # Gateways repeat callbacks
+        self.callback([{'transaction_id': first.transaction_id, 'status': 'completed'}])
+        self.assertEqual(self.balance(), Decimal('150.00'))
+
+        status = self.client.get(reverse('payment_status_api', args=[first.transaction_id])).json()
+        self.assertEqual(status['payment']['status'], 'completed')
+
+    def test_callback_needs_a_valid_signature(self):
+        payment = self.request_top_up('150')
+        response = self.callback([{'transaction_id': payment.transaction_id, 'status': 'completed'}], 'wrong')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.balance(), 0)
+
+    def test_callbacks_need_their_own_secret(self):
+        payment = self.request_top_up('150')
+        results = [{'transaction_id': payment.transaction_id, 'status': 'completed'}]
+        with self.settings(PAYMENT_CALLBACK_SECRET=''):
+            # Not even a body signed with the key everyone would guess
+            response = self.callback(results, settings.SECRET_KEY)
+            self.assertEqual(response.status_code, 403)
+            with self.assertRaises(ImproperlyConfigured):
+                payments.HttpGateway()
+        self.assertEqual(self.balance(), 0)
+
+    def test_unreachable_gateway_fails_the_payment(self):
+        with self.settings(TASKS_ALWAYS_EAGER=True, PAYMENT_GATEWAY='matwanaapp.payments.HttpGateway',
+                           PAYMENT_GATEWAY_URL='http://127.0.0.1:9', PAYMENT_GATEWAY_TIMEOUT=1), \
+                self.captureOnCommitCallbacks(execute=True):
+            payment = payments.start_top_up(self.passenger.id, Decimal('100.00'), 'mpesa')
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, 'failed')
+
+
+    def test_sweep_resubmits_lost_payments_and_fails_stale_ones(self):
+        def pending(age, reference=''):
+            with self.captureOnCommitCallbacks():
+                # The queued send is dropped, as when the worker restarts
+                payment = payments.start_top_up(self.passenger.id, Decimal('100.00'), 'mpesa')
+            Payment.objects.filter(pk=payment.pk).update(
+                created_at=timezone.now() - age, gateway_reference=reference,
+            )
+            return payment
+
+        fresh = pending(timedelta(minutes=1))
+        lost = pending(timedelta(minutes=30))
+        waiting = pending(timedelta(minutes=30), reference='REF-WAITING')
+        stale = pending(timedelta(days=2), reference='REF-STALE')
+
+        out = StringIO()
+        with self.settings(PAYMENT_GATEWAY='matwanaapp.tests.RecordingGateway'), \
+                self.captureOnCommitCallbacks(execute=True):
+            call_command('sweep_pending_payments', stdout=out)
+        self.assertIn('Resubmitted 1 and failed 1', out.getvalue())
+        self.assertEqual(RecordingGateway.requested, [lost.transaction_id])
+
+        statuses = dict(Payment.objects.values_list('transaction_id', 'status'))
+        self.assertEqual(statuses, {
+            fresh.transaction_id: 'pending', lost.transaction_id: 'pending',
+            waiting.transaction_id: 'pending', stale.transaction_id: 'failed',
+        })
+        lost.refresh_from_db()
+        self.assertEqual(lost.gateway_reference, f'REF-{lost.pk}')
+        self.assertEqual(self.balance(), 0)
+
+
+class PaymentGatewayStubTests(LiveServerTestCase):
+    def test_round_trip_through_the_stub(self):
+        secret = 'stub-secret'
+        gateway = StubGateway(secret, delay=0.5, batch_seconds=0.05).start()
+        self.addCleanup(gateway.stop)
+        passenger = make_user()
+        client = self.client_class()
+        session = client.session
+        session['user_id'] = passenger.id
+        session['user_type'] = 'passenger'
+        session.save()
+
+        with self.settings(PAYMENT_GATEWAY='matwanaapp.payments.HttpGateway', PAYMENT_GATEWAY_URL=gateway.url,
+                           PAYMENT_CALLBACK_URL=self.live_server_url + reverse('payment_callback_api'),
+                           PAYMENT_CALLBACK_SECRET=secret):
+            started = time.monotonic()
+            for amount in ('100', '250', '300.99'):
+                response = client.post(reverse('process_payment'), {'amount': amount, 'payment_method': 'mpesa'},
+                                       content_type='application/json')
+                self.assertEqual(response.json()['status'], 'pending')
+            # Three requests answered without waiting on the gateway's 0.5 s each
+            self.assertLess(time.monotonic() - started, 0.5)
+
+            deadline = time.monotonic() + 10
+            while Payment.objects.filter(status='pending').exists() and time.monotonic() < deadline:
+                time.sleep(0.05)
+
+        self.assertEqual(sorted(Payment.objects.values_list('status', flat=True)), ['completed', 'completed', 'failed'])
+        self.assertEqual(len(gateway.received), 3)
+        passenger.refresh_from_db()
+        self.assertEqual(passenger.credits, Decimal('350.00'))
+
+
+class SeatCounterTests(SessionLoginMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        sacco = make_sacco()
+        self.route = make_route(sacco, standard_fare=Decimal('100.00'))
+        self.matatu = make_matatu(sacco, capacity=14, current_driver=make_user('driver'))
+        self.trip = make_trip(self.matatu, self.route, driver=self.matatu.current_driver)
+        self.passenger = make_user(credits=Decimal('300.00'))
+
+    def test_cancellation_frees_seat_and_refunds(self):
+        booking = book_trip(self.passenger.id, self.trip.id)
+        cancel_booking(self.passenger.id, booking.id)
+
+        self.trip.refresh_from_db()
+        self.passenger.refresh_from_db()
+        self.assertEqual(self.trip.booked_seats, 0)
+        self.assertEqual(self.passenger.credits, Decimal('300.00'))
+        self.assertTrue(Payment.objects.filter(payment_type='refund', amount=Decimal('100.00')).exists())
+
+        with self.assertRaisesMessage(BookingError, 'Booking not found'):
+            cancel_booking(self.passenger.id, booking.id)
+
+    def test_active_bookings_reads_seat_counter(self):
+        User.objects.filter(pk=self.passenger.pk).update(credits=Decimal('1000.00'))
+        self.login_as(self.passenger)
+        url = reverse('active_bookings_api')
+
+        self.client.get(url)  # resolves the session principal
+        book_trip(self.passenger.id, self.trip.id)
+        cache.clear()
+        with CaptureQueriesContext(connection) as small:
+            response = self.client.get(url)
+        self.assertEqual(response.json()['bookings'][0]['seats_available'], 13)
+
+        for _ in range(4):
+            trip = make_trip(self.matatu, self.route, driver=self.matatu.current_driver)
+            book_trip(self.passenger.id, trip.id)
+        cache.clear()
+        with CaptureQueriesContext(connection) as large:
+            response = self.client.get(url)
+
+        self.assertEqual(len(response.json()['bookings']), 5)
+        self.assertEqual(len(small.captured_queries), len(large.captured_queries))
+
+    def test_seat_changes_invalidate_trip_listings(self):
+        def drift_and_repair():
+            Trip.objects.filter(pk=self.trip.pk).update(booked_seats=3)
+            repair_seat_counts()
+
+        booking = []
+        for change in (lambda: booking.append(book_trip(self.passenger.id, self.trip.id)),
+                       lambda: cancel_booking(self.passenger.id, booking[0].id),
+                       drift_and_repair):
+            before = get_versions(['trips'])
+            with self.captureOnCommitCallbacks(execute=True):
+                change()
+            self.assertNotEqual(get_versions(['trips']), before)
+
+    def test_reconcile_seats_repairs_drift(self):
+        book_trip(self.passenger.id, self.trip.id)
+        Trip.objects.filter(pk=self.trip.pk).update(booked_seats=7)
+
+        out = StringIO()
+        call_command('reconcile_seats', '--dry-run', stdout=out)
+        self.assertIn(f'Trip {self.trip.pk}: booked_seats=7, bookings=1', out.getvalue())
+        self.trip.refresh_from_db()
+        self.assertEqual(self.trip.booked_seats, 7)
+
+        call_command('reconcile_seats', stdout=StringIO())
+        self.trip.refresh_from_db()
+        self.assertEqual(self.trip.booked_seats, 1)
+        self.assertFalse(Trip.objects.with_seat_drift().exists())
+
+
+class RouteSearchTests(SessionLoginMixin, TestCase):
+    def setUp(self):
+        self.sacco = make_sacco(name='Super Metro')
+        self.westlands = make_route(self.sacco, name='Town - Westlands', start_point='Town', end_point='Westlands')
+        self.thika = make_route(self.sacco, name='Thika Road Express', start_point='Thika', end_point='Town')
+        self.ruaka = make_route(self.sacco, name='Ruaka', start_point='Ruaka', end_point='Westlands')
+        self.inactive = make_route(self.sacco, name='Old Westlands', is_active=False)
+        # Routes were created outside on_commit, so start from a fresh index
+        cache.clear()
+
+    def test_search_text_is_normalised(self):
+        route = make_route(self.sacco, name="Murang'a – Nyéri", start_point='Murang\'a', end_point='NYERI')
+        self.assertEqual(route.search_text, 'murang a nyeri murang a nyeri super metro')
+
+    def test_prefix_matches_rank_before_substring(self):
+        other = make_sacco(name='Lands Movers')
+        lands = make_route(other, name='Kilimani', start_point='Yaya', end_point='Kilimani')
+        cache.clear()
+
+        results = route_search.search('lands')
+        # "Lands Movers" starts a word; "Westlands" only contains it
+        self.assertEqual(results[0], lands)
+        self.assertEqual(set(results[1:]), {self.westlands, self.ruaka})
+        self.assertNotIn(self.inactive, results)
+
+    def test_every_word_must_match(self):
+        self.assertEqual(route_search.search('thika town'), [self.thika])
+        self.assertEqual(route_search.search('thika westlands'), [])
+
+    def test_filter_routes_by_field(self):
+        routes = Route.objects.filter(is_active=True)
+        self.assertEqual(set(route_search.filter_routes(routes, 'west', fields=['end'])), {self.westlands, self.ruaka})
+        self.assertEqual(list(route_search.filter_routes(routes, 'west', fields=['start'])), [])
+
+    def test_index_follows_edits_and_sacco_renames(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.sacco.name = 'Metro Trans'
+            self.sacco.save()
+            make_route(self.sacco, name='Kitengela', start_point='Kitengela', end_point='Town')
+
+        self.westlands.refresh_from_db()
+        self.assertIn('metro trans', self.westlands.search_text)
+        self.assertEqual(len(route_search.search('trans')), 4)
+        self.assertEqual([r.name for r in route_search.search('kiteng')], ['Kitengela'])
+
+    def test_search_api_and_routes_list(self):
+        response = self.client.get(reverse('search_routes_api'), {'q': 'ruak'})
+        self.assertEqual([r['id'] for r in response.json()['routes']], [self.ruaka.id])
+
+        self.login_as(make_user())
+        response = self.client.get(reverse('routes_list'), {'start_point': 'thi'})
+        self.assertEqual(list(response.context['routes']), [self.thika])
+
+
+class StopSuggestTests(SessionLoginMixin, TestCase):
+    def setUp(self):
+        self.sacco = make_sacco()
+        self.cbd = make_route(self.sacco, start_point='Nairobi CBD', end_point='Karen')
+        self.karen = make_route(self.sacco, start_point='Karen', end_point='nairobi  cbd')
+        self.kikuyu = make_route(self.sacco, start_point='Kikuyu', end_point='Nairobi CBD')
+        make_route(self.sacco, start_point='Kangemi', end_point='Karatina', is_active=False)
+        cache.clear()
+
+    def test_stop_dictionary(self):
+        index = StopIndex([(1, 'Nairobi CBD', 'Karen'), (2, 'nairobi  cbd', 'Kikuyu'), (3, 'Nairobi CBD', 'Karen')])
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.stop_names('start'), ['Nairobi CBD'])
+        self.assertEqual(index.suggest('nai'), [{'name': 'Nairobi CBD', 'route_ids': [1, 2, 3]}])
+        # Whole-name matches come before a match on a later word
+        self.assertEqual([s['name'] for s in index.suggest('k')], ['Karen', 'Kikuyu'])
+        self.assertEqual(index.suggest('cbd', role='end'), [])
+
+    def test_suggest_api(self):
+        url = reverse('stop_suggest_api')
+        # The first call builds the dictionary; after that no queries at all
+        response = self.client.get(url, {'q': 'ka', 'role': 'end'})
+        self.assertEqual(response.json()['stops'], [{'name': 'Karen', 'route_ids': [self.cbd.id]}])
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url, {'q': 'cbd'})
+        self.assertEqual(response.json()['stops'][0]['route_ids'], [self.cbd.id, self.karen.id, self.kikuyu.id])
+
+        self.assertFalse(self.client.get(url, {'q': 'ka', 'role': 'middle'}).json()['success'])
+
+    def test_dictionary_refreshes_on_route_writes(self):
+        url = reverse('stop_suggest_api')
+        self.assertEqual(self.client.get(url, {'q': 'thika'}).json()['stops'], [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            route = make_route(self.sacco, start_point='Thika', end_point='Nairobi CBD')
+        self.assertEqual(self.client.get(url, {'q': 'thika'}).json()['stops'][0]['route_ids'], [route.id])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            route.delete()
+        self.assertEqual(self.client.get(url, {'q': 'thika'}).json()['stops'], [])
+
+    def test_routes_list_reads_stop_dictionary(self):
+        self.login_as(make_user())
+        response = self.client.get(reverse('routes_list'))
+        self.assertEqual(response.context['start_points'], ['Karen', 'Kikuyu', 'Nairobi CBD'])
+        self.assertEqual(response.context['end_point_count'], 2)
+
+
+class JourneyPlannerTests(TestCase):
+    def setUp(self):
+        self.sacco = make_sacco()
+        self.direct = make_route(self.sacco, start_point='Kikuyu', end_point='Thika',
+                                 estimated_duration_minutes=150, standard_fare=Decimal('300'))
+        self.to_town = make_route(self.sacco, start_point='Kikuyu', end_point='Town',
+                                  estimated_duration_minutes=40, standard_fare=Decimal('100'))
+        self.town_thika = make_route(self.sacco, start_point='Town', end_point='Thika',
+                                     estimated_duration_minutes=50, standard_fare=Decimal('120'))
+        cache.clear()
+
+    def route_ids(self, journeys_found):
+        return [[leg['route_id'] for leg in journey['legs']] for journey in journeys_found]
+
+    def test_k_cheapest_journeys(self):
+        # 40 + 10 (change) + 50 beats 150 minutes on the direct route
+        found = journeys.plan('kikuyu', 'THIKA', k=3)
+        self.assertEqual(self.route_ids(found), [[self.to_town.id, self.town_thika.id], [self.direct.id]])
+        self.assertEqual(found[0]['duration_minutes'], 100)
+        self.assertEqual(found[0]['transfers'], 1)
+        self.assertEqual(found[0]['legs'][0]['to'], 'Town')
+
+        self.assertEqual(self.route_ids(journeys.plan('Kikuyu', 'Thika', k=1)), [[self.to_town.id, self.town_thika.id]])
+        self.assertEqual(self.route_ids(journeys.plan('Kikuyu', 'Thika', max_transfers=0)), [[self.direct.id]])
+        self.assertEqual(journeys.plan('Thika', 'Kikuyu'), [])
+
+    def test_weights(self):
+        graph = journeys.RouteGraph([
+            (1, 'Fast', 'A', 'B', 10, Decimal('5'), Decimal('200'), True),
+            (2, 'Cheap', 'A', 'B', 30, Decimal('4'), Decimal('50'), True),
+            (3, 'Off', 'A', 'B', 1, Decimal('1'), Decimal('1'), False),
+        ])
+        self.assertEqual(graph.plan('A', 'B', k=1, weight='time')[0][0].route_id, 1)
+        self.assertEqual(graph.plan('A', 'B', k=1, weight='fare')[0][0].route_id, 2)
+        self.assertEqual(len(graph.plan('A', 'B', k=5)), 2)
+
+    def test_graph_applies_route_changes_incrementally(self):
+        graph = journeys.get_graph()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.town_thika.is_active = False
+            self.town_thika.save()
+            shortcut = make_route(self.sacco, start_point='Kikuyu', end_point='Thika', estimated_duration_minutes=60)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.to_town.delete()
+
+        self.assertIs(journeys.get_graph(), graph)
+        self.assertEqual(self.route_ids(journeys.plan('Kikuyu', 'Thika')), [[shortcut.id], [self.direct.id]])
+        self.assertNotIn(self.to_town.id, graph.edges)
+
+        # Changes the journal did not see force a full rebuild
+        cache.clear()
+        self.assertIsNot(journeys.get_graph(), graph)
+
+    def test_plan_api(self):
+        url = reverse('journey_plan_api')
+        data = self.client.get(url, {'from': 'kiku', 'to': 'thika', 'optimise': 'fare', 'k': 1}).json()
+        self.assertEqual(data['from'], 'Kikuyu')
+        self.assertEqual(self.route_ids(data['journeys']), [[self.to_town.id, self.town_thika.id]])
+        self.assertEqual(data['journeys'][0]['fare'], 220.0)
+
+        self.assertFalse(self.client.get(url, {'from': 'Nowhere', 'to': 'Thika'}).json()['success'])
+        self.assertFalse(self.client.get(url, {'from': 'Kikuyu', 'to': 'Thika', 'optimise': 'vibes'}).json()['success'])
+
+
+class QueryPlanTests(TestCase):
+    """EXPLAIN the hot queries from views.py; each must be served by an index.
+
+    The query shapes here mirror the views. If a view changes shape, change
+    the matching test with it rather than dropping the assertion.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.sacco = make_sacco()
+        cls.driver = make_user('driver')
+        cls.conductor = make_user('conductor')
+        cls.passenger = make_user()
+        cls.matatu = make_matatu(cls.sacco, current_driver=cls.driver, current_conductor=cls.conductor)
+        cls.route = make_route(cls.sacco)
+        cls.trip = make_trip(cls.matatu, cls.route, driver=cls.driver, conductor=cls.conductor)
+        make_booking(cls.passenger, cls.trip)
+
+    def explain(self, queryset):
+        if connection.vendor == 'postgresql':
+            # Tiny test tables would always be sequential scans otherwise
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+        return queryset.explain()
+
+    def assertUsesIndex(self, queryset, *index_names):
+        plan = self.explain(queryset)
+        self.assertTrue(
+            any(name in plan for name in index_names),
+            f'Expected one of {index_names} in the plan:\n{plan}',
+        )
+
+    def test_route_details_upcoming_trips(self):
+        # route_details_api
+        self.assertUsesIndex(Trip.objects.filter(
+            route=self.route,
+            scheduled_departure__gte=timezone.now(),
+            status='scheduled'
+        ).order_by('scheduled_departure'), 'trip_route_status_dep_idx')
+
+    def test_routes_list_upcoming_counts(self):
+        # routes_list, via RouteQuerySet.with_upcoming_trip_count()
+        self.assertUsesIndex(
+            Route.objects.filter(is_active=True).with_upcoming_trip_count(),
+            'trip_route_status_dep_idx',
+        )
+
+    def test_driver_and_conductor_dashboards(self):
+        # driver_dashboard
+        self.assertUsesIndex(Trip.objects.filter(
+            driver=self.driver,
+            status__in=['active', 'scheduled']
+        ).order_by('-scheduled_departure'), 'trip_driver_status_dep_idx')
+        self.assertUsesIndex(
+            Trip.objects.filter(driver=self.driver, status='completed'),
+            'trip_driver_status_dep_idx',
+        )
+        # conductor_dashboard
+        self.assertUsesIndex(Trip.objects.filter(
+            conductor=self.conductor,
+            status__in=['active', 'scheduled']
+        ).order_by('-scheduled_departure'), 'trip_cond_status_dep_idx')
+
+    def test_payment_listings(self):
+        start_of_today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        # admin_dashboard_stats recent activity
+        self.assertUsesIndex(Payment.objects.filter(
+            created_at__gte=start_of_today, status='completed'
+        ).order_by('-created_at'), 'payment_status_created_idx')
+        # admin_dashboard pending count
+        self.assertUsesIndex(
+            Payment.objects.filter(status='pending'),
+            'payment_pending_idx', 'payment_status_created_idx',
+        )
+        # admin_manage_payments keyset pages
+        self.assertUsesIndex(Payment.objects.order_by('-created_at', '-pk'), 'payment_created_idx')
+
+    def test_passenger_trip_history(self):
+        # my_trips
+        self.assertUsesIndex(PassengerTrip.objects.filter(
+            passenger=self.passenger
+        ).order_by('-transaction_time'), 'ptrip_passenger_time_idx')
+
+    def test_user_listings(self):
+        # admin_dashboard role counts and admin_manage_users
+        self.assertUsesIndex(User.objects.filter(user_type='passenger'), 'user_type_joined_idx')
+        self.assertUsesIndex(
+            User.objects.filter(user_type='driver').order_by('-date_joined', '-pk'),
+            'user_type_joined_idx',
+        )
+        self.assertUsesIndex(User.objects.order_by('-date_joined', '-pk'), 'user_joined_idx')
+
+    def test_departure_date_ranges(self):
+        start = timezone.now()
+        # admin_manage_trips date filters and keyset pages
+        self.assertUsesIndex(
+            Trip.objects.filter(scheduled_departure__gte=start).order_by('-scheduled_departure', '-pk'),
+            'trip_departure_idx',
+        )
+        # quick_book
+        self.assertUsesIndex(Trip.objects.filter(
+            route__in=Route.objects.filter(is_active=True),
+            scheduled_departure__gte=start,
+            scheduled_departure__lt=start + timedelta(days=1),
+            status='scheduled'
+        ), 'trip_route_status_dep_idx', 'trip_departure_idx')
+
+
+class NotificationAudienceTests(SessionLoginMixin, TestCase):
+    def setUp(self):
+        self.admin = make_user('super_admin')
+        self.passenger = make_user()
+        self.driver = make_user('driver')
+        self.sacco = make_sacco()
+        self.other_sacco = make_sacco()
+        make_matatu(self.sacco, current_driver=self.driver)
+
+    def send(self, **kwargs):
+        return notifications.create(self.admin, 'Title', 'Message', 'system', **kwargs)
+
+    def test_rules_resolve_at_read_time(self):
+        everyone = self.send(audience='all')
+        drivers = self.send(audience='user_type', user_type='driver')
+        members = self.send(audience='saccos', sacco_ids=[self.sacco.id, self.other_sacco.id])
+        others = self.send(audience='saccos', sacco_ids=[self.other_sacco.id])
+
+        # Rules write no per-user rows, and users joining later are covered
+        self.assertFalse(Notification.recipients.through.objects.exists())
+        late = make_user()
+        self.assertEqual(list(notifications.visible_to(late)), [everyone])
+
+        self.assertEqual(set(notifications.visible_to(self.passenger)), {everyone})
+        self.assertEqual(
+            sorted(n.pk for n in notifications.visible_to(self.driver)),
+            [everyone.pk, drivers.pk, members.pk],
+        )
+        self.sacco.admin = self.admin
+        self.sacco.save()
+        self.assertIn(members, notifications.visible_to(self.admin))
+        self.assertNotIn(others, notifications.visible_to(self.admin))
+
+        self.assertEqual(notifications.audience_size(drivers), 1)
+        self.assertEqual(notifications.audience_size(members), 2)
+        self.assertEqual(notifications.audience_size(others), 0)
+
+    def test_audience_sizes_cost_the_same_for_any_page(self):
+        self.sacco.admin = self.driver
+        self.sacco.save()
+        make_matatu(self.other_sacco, current_driver=make_user('driver'), current_conductor=make_user('conductor'))
+
+        def sizes(count):
+            sent = []
+            for n in range(count):
+                sent += [
+                    self.send(audience='all'),
+                    self.send(audience='user_type', user_type='driver'),
+                    self.send(audience='saccos', sacco_ids=[self.sacco.id, self.other_sacco.id]),
+                    self.send(audience='explicit', recipient_ids=[self.passenger.id, self.driver.id]),
+                ]
+            with CaptureQueriesContext(connection) as queries:
+                found = notifications.audience_sizes(sent)
+            # Five active users; the driver is also the SACCO's admin
+            expected = {'all': 5, 'user_type': 2, 'saccos': 3, 'explicit': 2}
+            self.assertEqual(found, {n.pk: expected[n.audience] for n in sent})
+            return len(queries)
+
+        self.assertEqual(sizes(5), sizes(1))
+
+    def test_admin_views_show_audience_size(self):
+        drivers = self.send(audience='user_type', user_type='driver')
+        self.send(audience='all')
+        self.login_as(self.admin)
+
+        # The templates are rendered elsewhere; the counts are the views' job
+        with mock.patch('matwanaapp.views.render', return_value=HttpResponse()) as render:
+            self.client.get(reverse('admin_manage_notifications'))
+            listed = render.call_args.args[2]['notifications']
+            self.assertEqual([n.recipient_count for n in listed], [3, 1])
+
+            self.client.get(reverse('admin_edit_notification', args=[drivers.pk]))
+            self.assertEqual(render.call_args.args[2]['notification'].recipient_count, 1)
+
+    def test_explicit_recipients_in_chunks(self):
+        users = [make_user() for _ in range(5)]
+        users[0].is_active = False
+        users[0].save()
+        notification = self.send(audience='explicit', recipient_ids=[users[0].id])
+
+        with CaptureQueriesContext(connection) as queries:
+            added = notifications.add_recipients(notification.pk, [u.id for u in users] * 2, chunk_size=2)
+        self.assertEqual(added, 4)
+        inserts = [q for q in queries.captured_queries if q['sql'].startswith('INSERT')]
+        self.assertEqual(len(inserts), 3)
+
+        self.assertIn(notification, notifications.visible_to(users[1]))
+        self.assertNotIn(notification, notifications.visible_to(self.passenger))
+
+    @mock.patch.object(notifications, 'BACKGROUND_THRESHOLD', 2)
+    def test_large_lists_fan_out_in_background(self):
+        users = [make_user() for _ in range(3)]
+        with self.settings(TASKS_ALWAYS_EAGER=True):
+            with self.captureOnCommitCallbacks(execute=True):
+                notification = self.send(audience='explicit', recipient_ids=[u.id for u in users])
+                self.assertEqual(notification.recipients.count(), 0)
+        self.assertEqual(notification.recipients.count(), 3)
+
+    def test_add_notification_view_stores_segment(self):
+        self.login_as(self.admin)
+        response = self.client.post(reverse('admin_add_notification'), {
+            'title': 'Fare change',
+            'message': 'Fares go up on Monday',
+            'notification_type': 'price_change',
+            'send_to': 'passengers',
+        })
+        self.assertRedirects(response, reverse('admin_manage_notifications'), fetch_redirect_response=False)
+
+        notification = Notification.objects.get()
+        self.assertEqual((notification.audience, notification.audience_user_type), ('user_type', 'passenger'))
+        self.assertEqual(notification.recipients.count(), 0)
+
+        self.client.post(reverse('admin_add_notification'), {
+            'title': 'Hello',
+            'message': 'Just you',
+            'notification_type': 'system',
+            'send_to': 'custom',
+            'custom_recipients': f'{self.passenger.email}, {self.driver.phone_number}',
+        })
+        self.assertEqual(
+            set(Notification.objects.get(title='Hello').recipients.all()), {self.passenger, self.driver}
+        )
+
+        # A misspelt audience is refused, not sent to a guessed one
+        with mock.patch('matwanaapp.views.render', return_value=HttpResponse()) as render:
+            self.client.post(reverse('admin_add_notification'), {
+                'title': 'Typo',
+                'message': 'Who gets this?',
+                'notification_type': 'system',
+                'send_to': 'passanger',
+                'custom_recipients': self.passenger.email,
+            })
+        self.assertFalse(Notification.objects.filter(title='Typo').exists())
+        shown = [str(message) for message in get_messages(render.call_args.args[0])]
+        self.assertEqual(shown[-1], 'Unknown recipients "passanger"')
+
+
+class InboxTests(SessionLoginMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.admin = make_user('super_admin')
+        self.passenger = make_user()
+
+    def send(self, **kwargs):
+        return notifications.create(self.admin, 'Title', 'Message', 'system', **kwargs)
+
+    def read_state(self):
+        return {n.pk: n.is_read for n in inbox.notifications_for(self.passenger)}
+
+    def test_cursor_and_single_reads(self):
+        first, second, third = self.send(), self.send(), self.send()
+        self.assertEqual(inbox.unread_count(self.passenger), 3)
+
+        self.assertTrue(inbox.mark_read(self.passenger, second.pk))
+        self.assertEqual(self.read_state(), {first.pk: False, second.pk: True, third.pk: False})
+
+        # Not in this user's inbox
+        drivers = self.send(audience='user_type', user_type='driver')
+        self.assertFalse(inbox.mark_read(self.passenger, drivers.pk))
+
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(inbox.mark_all_read(self.passenger), 2)
+        writes = [q for q in queries.captured_queries if q['sql'].startswith(('INSERT', 'UPDATE'))]
+        self.assertEqual(len(writes), 1)
+        self.assertEqual(InboxState.objects.get(user=self.passenger).read_through_id, third.pk)
+        self.assertFalse(NotificationRead.objects.exists())
+        self.assertEqual(set(self.read_state().values()), {True})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            fourth = self.send()
+        self.assertEqual(self.read_state()[fourth.pk], False)
+        self.assertEqual(inbox.unread_count(self.passenger), 1)
+
+    def test_unread_count_is_cached_and_invalidated(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            notification = self.send()
+        self.assertEqual(inbox.unread_count(self.passenger), 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(inbox.unread_count(self.passenger), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            inbox.mark_read(self.passenger, notification.pk)
+        self.assertEqual(inbox.unread_count(self.passenger), 0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.send()
+        self.assertEqual(inbox.unread_count(self.passenger), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            notification.is_active = False
+            notification.save()
+            self.send(audience='explicit', recipient_ids=[self.passenger.id])
+        self.assertEqual(inbox.unread_count(self.passenger), 2)
+
+    def test_notifications_before_joining_count_as_read(self):
+        old = self.send()
+        Notification.objects.filter(pk=old.pk).update(created_at=timezone.now() - timedelta(days=30))
+        late = make_user()
+        new = self.send()
+        states = {n.pk: n.is_read for n in inbox.notifications_for(late)}
+        self.assertEqual(states, {old.pk: True, new.pk: False})
+        self.assertEqual(inbox.unread_count(late), 1)
+
+    def test_inbox_api(self):
+        sent = [self.send() for _ in range(3)]
+        self.login_as(self.passenger)
+
+        with mock.patch.object(inbox, 'PER_PAGE', 2):
+            response = self.client.get(reverse('notifications_api')).json()
+        self.assertEqual([n['id'] for n in response['notifications']], [sent[2].pk, sent[1].pk])
+        self.assertEqual(response['unread_count'], 3)
+
+        response = self.client.post(reverse('mark_notification_read_api', args=[sent[0].pk])).json()
+        self.assertTrue(response['success'])
+
+        response = self.client.post(reverse('mark_all_notifications_read_api')).json()
+        self.assertEqual(response['marked'], 2)
+        response = self.client.get(reverse('notifications_api')).json()
+        self.assertTrue(all(n['is_read'] for n in response['notifications']))
+
+        response = self.client.get(reverse('mark_all_notifications_read_api')).json()
+        self.assertFalse(response['success'])
+
+    def test_inbox_api_does_not_load_the_user(self):
+        sent = self.send()
+        self.login_as(self.passenger)
+        self.client.get(reverse('notifications_api'))
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('notifications_api'))
+            self.client.post(reverse('mark_notification_read_api', args=[sent.pk]))
+            self.client.post(reverse('mark_all_notifications_read_api'))
+        # The user table may appear in subqueries, never as a row fetch
+        loads = [q['sql'] for q in queries if q['sql'].split(' FROM ', 1)[-1].startswith('"matwanaapp_user"')]
+        self.assertEqual(loads, [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.passenger.delete()
+        self.assertEqual(self.client.get(reverse('notifications_api')).json(), {'success': False, 'message': 'User not found'})
+
+    def test_dashboard_badge_uses_unread_count(self):
+        self.send()
+        self.login_as(self.passenger)
+        response = self.client.get(reverse('dashboard'))
+        self.assertEqual(response.context['unread_count'], 1)
+        self.assertContains(response, '<span class="notification-badge" data-unread-badge>1</span>')
+
+
+class LiveUpdatesTests(SessionLoginMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.broker = live.LocalBroker()
+        patcher = mock.patch.object(live, '_broker', self.broker)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.admin = make_user('super_admin')
+        self.sacco = make_sacco()
+        self.route = make_route(self.sacco)
+        self.trip = make_trip(make_matatu(self.sacco), self.route)
+        self.passenger = make_user(credits=Decimal('250.00'))
+
+    def events(self, channel):
+        return [(event, data) for _, event, data in self.broker.history.get(channel, ())]
+
+    def test_broker_delivers_replays_and_resyncs(self):
+        async def scenario():
+            subscription = self.broker.subscribe(['a', 'b'])
+            first = self.broker.publish('a', 'ping', {'n': 1})
+            self.broker.publish('c', 'ping', {'n': 2})
+            self.broker.publish('b', 'ping', {'n': 3})
+            received = [await subscription.get(timeout=1), await subscription.get(timeout=1)]
+            self.assertEqual([data['n'] for _, _, data in received], [1, 3])
+            self.assertIsNone(await subscription.get(timeout=0.01))
+            subscription.close()
+            self.assertEqual(self.broker.subscribers, {})
+
+            # A reconnecting client gets what it missed on its channels
+            again = self.broker.subscribe(['a', 'b'], last_event_id=first)
+            self.assertEqual((await again.get(timeout=1))[2], {'n': 3})
+            again.close()
+
+            # Ids it cannot account for mean a resync
+            stale = self.broker.subscribe(['a'], last_event_id=10 ** 6)
+            self.assertEqual((await stale.get(timeout=1))[1], 'resync')
+            stale.close()
+
+            # ...and so do ids whose events have dropped out of the history
+            for n in range(live.HISTORY):
+                self.broker.publish('b', 'ping', {'n': n})
+            forgetful = self.broker.subscribe(['b'], last_event_id=first)
+            self.assertEqual((await forgetful.get(timeout=1))[1], 'resync')
+            forgetful.close()
+
+            # So does falling too far behind
+            slow = self.broker.subscribe(['a'])
+            for n in range(live.QUEUE_SIZE + 5):
+                self.broker.publish('a', 'ping', {'n': n})
+            self.assertEqual((await slow.get(timeout=1))[1], 'resync')
+            self.assertIsNone(await slow.get(timeout=0.01))
+            slow.close()
+
+        async_to_sync(scenario)()
+
+    def test_writes_publish_after_commit(self):
+        channel = live.user_channel(self.passenger.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            booking = book_trip(self.passenger.id, self.trip.id)
+            self.assertEqual(self.events(channel), [])
+
+        self.assertEqual(self.events(channel), [
+            ('booking', {'id': booking.id, 'trip_id': self.trip.id, 'is_paid': True,
+                         'boarded': False, 'alighted': False, 'cancelled': False}),
+            ('wallet', {'balance': 170.0}),
+        ])
+        self.assertIn(('stats', {}), self.events('staff'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.trip.status = 'active'
+            self.trip.save()
+            self.passenger.credits = Decimal('500.00')
+            self.passenger.save()
+        self.assertEqual(self.events(channel)[2:], [
+            ('trip', {'trip_id': self.trip.id, 'old_status': 'scheduled', 'status': 'active'}),
+            ('wallet', {'balance': 500.0}),
+        ])
+
+    def test_notifications_publish_to_audience_channels(self):
+        member = make_user('driver')
+        with self.captureOnCommitCallbacks(execute=True):
+            notifications.create(self.admin, 'All', 'Message', 'system')
+            notifications.create(self.admin, 'Drivers', 'Message', 'system', audience='user_type', user_type='driver')
+            notifications.create(self.admin, 'Sacco', 'Message', 'system', audience='saccos', sacco_ids=[self.sacco.id])
+            notifications.create(self.admin, 'You', 'Message', 'system', audience='explicit',
+                                 recipient_ids=[self.passenger.id])
+
+        def titles(channel):
+            return [data['title'] for event, data in self.events(channel) if event == 'notification']
+
+        self.assertEqual(titles('notifications:all'), ['All'])
+        self.assertEqual(titles('notifications:driver'), ['Drivers'])
+        self.assertEqual(titles(f'notifications:sacco:{self.sacco.id}'), ['Sacco'])
+        self.assertEqual(titles(live.user_channel(self.passenger.id)), ['You'])
+        self.assertEqual(titles(live.user_channel(member.id)), [])
+
+        self.assertEqual(
+            live.channels_for(member, [self.sacco.id]),
+            [live.user_channel(member.id), 'notifications:all', 'notifications:driver',
+             f'notifications:sacco:{self.sacco.id}'],
+        )
+        self.assertIn('staff', live.channels_for(self.admin))
+
+    def test_event_stream(self):
+        self.login_as(self.passenger)
+        self.async_client.cookies = self.client.cookies
+
+        async def scenario():
+            response = await self.async_client.get(reverse('live_events'))
+            self.assertEqual(response['Content-Type'], 'text/event-stream')
+            chunks = aiter(response.streaming_content)
+            self.assertEqual(await anext(chunks), b'retry: 5000\n\n')
+
+            event_id = self.broker.publish(live.user_channel(self.passenger.id), 'wallet', {'balance': 10.0})
+            self.broker.publish(live.user_channel(self.admin.id), 'wallet', {'balance': 99.0})
+            self.broker.publish('notifications:all', 'notification', {'id': 1})
+            self.assertEqual(
+                await anext(chunks), f'id: {event_id}\nevent: wallet\ndata: {{"balance": 10.0}}\n\n'.encode()
+            )
+            self.assertIn(b'event: notification', await anext(chunks))
+            await response.streaming_content.aclose()
+
+        async_to_sync(scenario)()
+        self.assertEqual(self.broker.subscribers, {})
+
+    def test_event_stream_needs_asgi(self):
+        self.assertFalse(self.client.get(reverse('live_events')).json()['success'])
+        self.login_as(self.passenger)
+        response = self.client.get(reverse('live_events')).json()
+        self.assertEqual(response['message'], 'Live updates need the ASGI server')
+
+
+class TelemetryTests(SessionLoginMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        sacco = make_sacco()
+        self.driver = make_user('driver')
+        route = make_route(sacco)
+        self.trip = make_trip(make_matatu(sacco), route, driver=self.driver, status='active')
+        self.other_trip = make_trip(make_matatu(sacco), route, status='active')
+        self.now = timezone.now().timestamp()
+
+    def post(self, rows):
+        with self.settings(TASKS_ALWAYS_EAGER=True):
+            return self.client.post(
+                reverse('telemetry_positions_api'), {'positions': rows}, content_type='application/json'
+            ).json()
+
+    def test_parse_fix_validates(self):
+        fix = telemetry.parse_fix([1, self.now, -1.2863891, 36.8172, 42.4])
+        self.assertEqual((fix.lat, fix.lng, fix.speed_kmh), (Decimal('-1.286389'), Decimal('36.817200'), 42))
+
+        for row in ([1, self.now, 91, 36.8], [1, self.now + 3600, -1.2, 36.8], [1, self.now - 3 * 86400, -1.2, 36.8],
+                    ['1', self.now, -1.2, 36.8], [1, 'soon', -1.2, 36.8], [1, self.now, -1.2, 36.8, -5], [1, 2]):
+            with self.assertRaises(ValueError):
+                telemetry.parse_fix(row)
+
+    def test_batches_coalesce_onto_the_trip_row(self):
+        self.login_as(self.driver)
+        rows = [[self.trip.id, self.now - 10 + n, -1.28 + n / 1000, 36.81, 30] for n in range(5)]
+        response = self.post(rows + [[self.other_trip.id, self.now, -1.2, 36.8], [self.trip.id, 'bad', 0, 0]])
+        self.assertEqual((response['accepted'], response['rejected']), (5, 2))
+
+        self.trip.refresh_from_db()
+        self.assertEqual(self.trip.current_location_lat, Decimal('-1.276000'))
+        self.assertEqual(TripPosition.objects.filter(trip=self.trip).count(), 5)
+
+        # A resent batch adds nothing, and a late one never moves the trip back
+        self.post(rows)
+        self.post([[self.trip.id, self.now - 60, -1.5, 36.5]])
+        self.trip.refresh_from_db()
+        self.assertEqual(self.trip.current_location_lat, Decimal('-1.276000'))
+        self.assertEqual(TripPosition.objects.filter(trip=self.trip).count(), 6)
+
+    def test_buffer_keeps_newest_fix_per_trip(self):
+        buffer = telemetry.PositionBuffer()
+        buffer.add([telemetry.parse_fix([7, self.now - n, 1, 1]) for n in range(3)])
+        history, latest = buffer.drain()
+        self.assertEqual(len(history), 3)
+        self.assertEqual(latest[7].recorded_at.timestamp(), self.now)
+        self.assertEqual(len(buffer), 0)
+
+    def test_only_crew_of_active_trips_report(self):
+        self.assertFalse(self.post([[self.trip.id, self.now, -1.2, 36.8]])['success'])
+        self.login_as(make_user())
+        self.assertEqual(self.post([[self.trip.id, self.now, -1.2, 36.8]])['message'], 'Not authenticated')
+
+        self.login_as(self.driver)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.trip.status = 'completed'
+            self.trip.save()
+        self.assertEqual(self.post([[self.trip.id, self.now, -1.2, 36.8]])['rejected'], 1)
+
+    def test_fixes_for_deleted_trips_do_not_sink_the_flush(self):
+        gone = make_trip(self.trip.matatu, self.trip.route, status='active')
+        fixes = [telemetry.parse_fix([trip.id, self.now - n, -1.28, 36.81]) for trip in (self.trip, gone) for n in range(3)]
+        gone_id = gone.id
+        gone.delete()
+
+        telemetry.write(fixes, {fix.trip_id: fix for fix in fixes})
+        self.assertEqual(TripPosition.objects.filter(trip=self.trip).count(), 3)
+        self.assertFalse(TripPosition.objects.filter(trip_id=gone_id).exists())
+
+    def test_history_is_inserted_in_batches(self):
+        fixes = [telemetry.parse_fix([self.trip.id, self.now - n, -1.28, 36.81, 20]) for n in range(25)]
+        with CaptureQueriesContext(connection) as queries:
+            telemetry.write(fixes, {self.trip.id: fixes[0]}, batch_size=10)
+        inserts = [q for q in queries if q['sql'].lstrip().startswith('INSERT INTO matwanaapp_tripposition')]
+        self.assertEqual(len(inserts), 3)
+        self.assertEqual(TripPosition.objects.filter(trip=self.trip, speed_kmh=20).count(), 25)
+
+    def test_crew_lookup_survives_bookings(self):
+        telemetry.reporting_trip_ids(self.driver.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            book_trip(make_user(credits=Decimal('500.00')).pk, self.trip.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(telemetry.reporting_trip_ids(self.driver.id), {self.trip.id})
+
+    def test_prune_positions(self):
+        old = timezone.now() - timedelta(days=100)
+        TripPosition.objects.create(trip=self.trip, recorded_at=old, lat=1, lng=1)
+        TripPosition.objects.create(trip=self.trip, recorded_at=timezone.now(), lat=1, lng=1)
+        self.assertEqual(telemetry.prune_positions(keep_days=90), 1)
+        self.assertEqual(TripPosition.objects.count(), 1)
+
+
+class NearbyTests(SessionLoginMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        nearby._index_cache.__init__()
+        self.sacco = make_sacco()
+        self.route = make_route(self.sacco)
+        self.other_route = make_route(self.sacco)
+        self.now = timezone.now()
+
+    def located_trip(self, lat, lng, route=None, **extra):
+        fields = {
+            'status': 'active',
+            'current_location_lat': Decimal(str(lat)),
+            'current_location_lng': Decimal(str(lng)),
+            'location_updated_at': self.now,
+        }
+        fields.update(extra)
+        return make_trip(make_matatu(self.sacco), route or self.route, **fields)
+
+    def test_grid_matches_a_full_scan(self):
+        rng = random.Random(5)
+        rows = [
+            (pk, -1.28 + rng.uniform(-0.1, 0.1), 36.82 + rng.uniform(-0.1, 0.1), pk % 3, self.now)
+            for pk in range(1, 2001)
+        ]
+        index = nearby.GridIndex(rows)
+        for _ in range(30):
+            lat, lng = -1.28 + rng.uniform(-0.1, 0.1), 36.82 + rng.uniform(-0.1, 0.1)
+            radius, k, route = rng.choice([0.5, 2, 8]), rng.choice([1, 5, 20]), rng.choice([None, 1])
+            expected = sorted(
+                (nearby.distance_km(lat, lng, row[1], row[2]), row[0]) for row in rows
+                if (route is None or row[3] == route) and nearby.distance_km(lat, lng, row[1], row[2]) <= radius
+            )[:k]
+            found = [(distance, trip_id) for distance, trip_id, _ in index.nearest(lat, lng, radius, k, route)]
+            self.assertEqual(found, expected)
+
+    def test_grid_updates(self):
+        index = nearby.GridIndex([(1, -1.28, 36.82, 1, self.now)])
+        index.update(1, -1.5, 36.5, 1, self.now - timedelta(seconds=5))
+        self.assertEqual(len(index.nearest(-1.28, 36.82, 1)), 1)
+
+        index.update(1, -1.5, 36.5, 1, self.now + timedelta(seconds=5))
+        self.assertEqual(index.nearest(-1.28, 36.82, 1), [])
+        self.assertEqual([trip_id for _, trip_id, _ in index.nearest(-1.5, 36.5, 1)], [1])
+
+        index.remove(1)
+        self.assertEqual((len(index), index.cells), (0, {}))
+
+    def test_nearby_api_and_database_fallback(self):
+        near = self.located_trip(-1.2800, 36.8200)
+        further = self.located_trip(-1.2900, 36.8200)
+        other_route = self.located_trip(-1.2805, 36.8200, route=self.other_route)
+        self.located_trip(-1.4000, 36.8200)
+        self.located_trip(-1.2801, 36.8201, location_updated_at=self.now - timedelta(hours=1))
+        self.located_trip(-1.2801, 36.8201, status='completed')
+
+        self.login_as(make_user())
+        url = reverse('nearby_vehicles_api')
+        params = {'lat': -1.2799, 'lng': 36.82, 'radius_km': 3}
+        for use_index in (True, False):
+            with self.settings(NEARBY_INDEX=use_index):
+                vehicles = self.client.get(url, params).json()['vehicles']
+                self.assertEqual([v['trip_id'] for v in vehicles], [near.id, other_route.id, further.id])
+                self.assertEqual(vehicles[0]['plate_number'], near.matatu.plate_number)
+
+                vehicles = self.client.get(url, {**params, 'route': self.route.id, 'limit': 1}).json()['vehicles']
+                self.assertEqual([v['trip_id'] for v in vehicles], [near.id])
+
+        self.assertFalse(self.client.get(url, {'lat': 'here'}).json()['success'])
+
+    def test_index_follows_position_writes(self):
+        trip = self.located_trip(-1.28, 36.82)
+        self.assertEqual([t for _, t, *_ in nearby.find(-1.28, 36.82, 1)], [trip.id])
+
+        # A flush in this process moves the vehicle straight away
+        fix = telemetry.parse_fix([trip.id, timezone.now().timestamp(), -1.35, 36.9])
+        with self.captureOnCommitCallbacks(execute=True):
+            telemetry.write([fix], {trip.id: fix})
+        self.assertEqual(nearby.find(-1.28, 36.82, 1), [])
+        self.assertEqual([t for _, t, *_ in nearby.find(-1.35, 36.9, 1)], [trip.id])
+
+        # Writes from elsewhere arrive with the next refresh
+        later = timezone.now() + timedelta(seconds=1)
+        Trip.objects.filter(pk=trip.pk).update(
+            current_location_lat=Decimal('-1.2'), current_location_lng=Decimal('36.7'), location_updated_at=later,
+        )
+        with mock.patch.object(nearby, 'REFRESH_SECONDS', 0):
+            self.assertEqual([t for _, t, *_ in nearby.find(-1.2, 36.7, 1)], [trip.id])
+
+
+    def test_bookings_do_not_rebuild_the_grid(self):
+        trip = self.located_trip(-1.28, 36.82)
+        nearby.find(-1.28, 36.82, 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            book_trip(make_user(credits=Decimal('500.00')).pk, trip.pk)
+
+        with mock.patch.object(nearby.IndexCache, '_rebuild', wraps=nearby._index_cache._rebuild) as rebuild:
+            self.assertEqual([t for _, t, *_ in nearby.find(-1.28, 36.82, 1)], [trip.id])
+            rebuild.assert_not_called()
+
+            with self.captureOnCommitCallbacks(execute=True):
+                trip.status = 'completed'
+                trip.save()
+            self.assertEqual(nearby.find(-1.28, 36.82, 1), [])
+            rebuild.assert_called_once()
+
+
+class EtaTests(SessionLoginMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.sacco = make_sacco()
+        self.matatu = make_matatu(self.sacco)
+        self.route = make_route(self.sacco, estimated_duration_minutes=30)
+        # A Monday, 08:00 local time
+        self.monday = timezone.make_aware(timezone.datetime(2026, 3, 2, 8, 0))
+
+    def completed(self, departure, minutes, route=None):
+        arrival = departure + timedelta(minutes=minutes)
+        return make_trip(
+            self.matatu, route or self.route, status='completed',
+            scheduled_departure=departure, scheduled_arrival=arrival,
+            actual_departure=departure, actual_arrival=arrival, completed_at=arrival,
+        )
+
+    def test_percentiles_follow_numpy(self):
+        rng = random.Random(3)
+        durations = [rng.uniform(15, 90) for _ in range(500)]
+        histogram = [0] * eta.BINS
+        for minutes in durations:
+            histogram[int(minutes)] += 1
+        p50, p80, p95 = eta.percentiles([histogram])[0]
+        for value, q in ((p50, 50), (p80, 80), (p95, 95)):
+            self.assertAlmostEqual(value, eta.np.percentile(durations, q), delta=1)
+        self.assertTrue(all(eta.np.isnan(eta.percentiles([[0] * eta.BINS])[0])))
+
+    def test_refresh_is_incremental_and_matches_rebuild(self):
+        for n in range(6):
+            self.completed(self.monday + timedelta(weeks=n), 40 + n)
+        now = self.monday + timedelta(weeks=6)
+        self.assertEqual(eta.refresh(now), 6)
+        self.assertEqual(eta.refresh(now), 0)
+
+        for n in range(4):
+            self.completed(now + timedelta(days=1, hours=n), 20)
+        later = now + timedelta(days=2)
+        self.assertEqual(eta.refresh(later), 4)
+        incremental = set(RouteDurationStats.objects.values_list(
+            'hour_of_week', 'samples', 'p50_minutes', 'p80_minutes', 'p95_minutes', 'histogram',
+        ))
+
+        self.assertEqual(eta.rebuild(later), 10)
+        rebuilt = set(RouteDurationStats.objects.values_list(
+            'hour_of_week', 'samples', 'p50_minutes', 'p80_minutes', 'p95_minutes', 'histogram',
+        ))
+        self.assertEqual(incremental, rebuilt)
+        monday = RouteDurationStats.objects.get(hour_of_week=8)
+        self.assertEqual(monday.samples, 6)
+        self.assertEqual(RouteDurationStats.objects.get(hour_of_week=eta.ANY_HOUR).samples, 10)
+
+    def test_refresh_counts_trips_completed_after_arrival(self):
+        trip = make_trip(
+            self.matatu, self.route, status='active',
+            scheduled_departure=self.monday, scheduled_arrival=self.monday + timedelta(minutes=30),
+            actual_departure=self.monday, actual_arrival=self.monday + timedelta(minutes=35),
+        )
+        later = self.monday + timedelta(hours=3)
+        self.assertEqual(eta.refresh(later), 0)
+
+        # Closed off hours after it arrived, behind where the last refresh read to
+        with mock.patch('django.utils.timezone.now', return_value=later + timedelta(minutes=1)):
+            trip.status = 'completed'
+            trip.save(update_fields=['status'])
+        trip.refresh_from_db()
+        self.assertEqual(trip.completed_at, later + timedelta(minutes=1))
+
+        self.assertEqual(eta.refresh(later + timedelta(minutes=10)), 1)
+        self.assertEqual(RouteDurationStats.objects.get(hour_of_week=eta.ANY_HOUR).samples, 1)
+
+    def test_estimate_falls_back_from_hour_to_route_to_schedule(self):
+        for n in range(5):
+            self.completed(self.monday + timedelta(weeks=n), 50)
+        self.completed(self.monday + timedelta(days=1), 10)
+        eta.refresh(self.monday + timedelta(weeks=5))
+
+        hour = eta.estimate(self.route, self.monday + timedelta(weeks=6, minutes=30))
+        self.assertEqual((hour['basis'], hour['samples'], hour['minutes']), ('hour', 5, 50.5))
+
+        # Tuesday has a single trip, too few on its own
+        route = eta.estimate(self.route, self.monday + timedelta(weeks=6, days=1))
+        self.assertEqual((route['basis'], route['samples']), ('route', 6))
+
+        other = make_route(self.sacco, estimated_duration_minutes=45)
+        self.assertEqual(eta.estimate(other, self.monday)['basis'], 'schedule')
+        self.assertEqual(eta.estimate(other, self.monday)['minutes'], 45)
+
+    def test_apis_include_eta(self):
+        for n in range(5):
+            self.completed(timezone.now() - timedelta(weeks=n + 1), 50)
+        with self.captureOnCommitCallbacks(execute=True):
+            eta.refresh()
+
+        trip = make_trip(self.matatu, self.route)
+        data = self.client.get(reverse('route_details_api', args=[self.route.id])).json()
+        self.assertEqual(data['route']['duration'], 30)
+        # Leaving now: the same hour of the week as every past trip
+        self.assertEqual(data['route']['eta']['basis'], 'hour')
+        self.assertEqual(data['upcoming_trips'][0]['eta']['minutes'], 50.5)
+
+        passenger = make_user()
+        make_booking(passenger, trip)
+        self.login_as(passenger)
+        bookings = self.client.get(reverse('active_bookings_api')).json()['bookings']
+        expected = (trip.scheduled_departure + timedelta(minutes=50.5)).isoformat()
+        self.assertEqual(bookings[0]['eta']['arrival'], expected)
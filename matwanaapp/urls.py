@@ -20,6 +20,8 @@ urlpatterns = [
     path('my-trips/', views.my_trips, name='my_trips'),
     path('top-up/', views.top_up_wallet, name='top_up_wallet'),
     path('process-payment/', views.process_payment, name='process_payment'),
+    path('api/payments/callback/', views.payment_callback_api, name='payment_callback_api'),
+    path('api/payments/<str:transaction_id>/', views.payment_status_api, name='payment_status_api'),
 
     # Other dashboards
     path('sacco/', views.sacco_dashboard, name='sacco_dashboard'),
@@ -30,9 +32,18 @@ urlpatterns = [
     # API endpoints
     path('api/dashboard-data/', views.dashboard_data_api, name='dashboard_data_api'),
     path('api/routes/search/', views.search_routes_api, name='search_routes_api'),
+    path('api/stops/suggest/', views.stop_suggest_api, name='stop_suggest_api'),
+    path('api/journeys/plan/', views.journey_plan_api, name='journey_plan_api'),
     path('api/routes/<int:route_id>/details/', views.route_details_api, name='route_details_api'),
     path('api/book-trip/', views.book_trip_api, name='book_trip_api'),
     path('api/active-bookings/', views.active_bookings_api, name='active_bookings_api'),
+    path('api/bookings/<int:booking_id>/cancel/', views.cancel_booking_api, name='cancel_booking_api'),
+    path('api/live/', views.live_events, name='live_events'),
+    path('api/telemetry/positions/', views.telemetry_positions_api, name='telemetry_positions_api'),
+    path('api/vehicles/nearby/', views.nearby_vehicles_api, name='nearby_vehicles_api'),
+    path('api/notifications/', views.notifications_api, name='notifications_api'),
+    path('api/notifications/<int:notification_id>/read/', views.mark_notification_read_api, name='mark_notification_read_api'),
+    path('api/notifications/read-all/', views.mark_all_notifications_read_api, name='mark_all_notifications_read_api'),
 
 # Admin Dashboard
     path('superadmin/', views.admin_dashboard, name='admin_dashboard'),
@@ -69,10 +80,16 @@ urlpatterns = [
     
     # Trip Management
     path('superadmin/trips/', views.admin_manage_trips, name='admin_manage_trips'),
+    path('superadmin/trips/export/', views.admin_export_trips, name='admin_export_trips'),
     
     # Payment Management
     path('superadmin/payments/', views.admin_manage_payments, name='admin_manage_payments'),
+    path('superadmin/payments/export/', views.admin_export_payments, name='admin_export_payments'),
+    
+    # Bulk Import
+    path('superadmin/import/', views.admin_import_data, name='admin_import_data'),
     
     # API Endpoints
     path('superadmin/api/dashboard-stats/', views.admin_dashboard_stats, name='admin_dashboard_stats'),
+    path('superadmin/api/hashing-metrics/', views.admin_hashing_metrics, name='admin_hashing_metrics'),
 ]
\ No newline at end of file
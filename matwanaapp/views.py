@@ -1,15 +1,30 @@
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import HttpResponse, JsonResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.contrib import messages
+from django.views.decorators.csrf import csrf_exempt
 from django.template import loader
 from django.db.models import Q, Count, Sum, Avg
-from django.contrib.auth.hashers import check_password
 from django.utils import timezone
 from datetime import datetime, timedelta
 import json
 
 from .models import User, PassengerTrip, Route, Trip, Notification, Payment, Sacco, Matatu
 from .forms import LoginForm, SignupForm, ForgotPasswordForm
+from .pagination import KeysetPaginator
+from . import bulk_import, eta, exports, hashing, inbox, journeys, live, logins, nearby, notifications, payments, route_search, stats, telemetry, wallet
+from .stops import ROLES as STOP_ROLES, get_stop_index
+from .booking import BookingError, book_trip, cancel_booking
+from .idempotency import idempotent
+from .principal import get_principal, role_required
+from .response_cache import cached_json, passenger_scope
+
+def day_range(day):
+    """(start, end) of a local calendar day, for index-friendly date filters"""
+    if isinstance(day, str):
+        day = datetime.strptime(day, '%Y-%m-%d').date()
+    start = timezone.make_aware(datetime.combine(day, datetime.min.time()))
+    return start, timezone.make_aware(datetime.combine(day + timedelta(days=1), datetime.min.time()))
 
 def home(request):
     template = loader.get_template('home.html')
@@ -36,23 +51,21 @@ def login(request):
         password = form.cleaned_data['password']
         
         try:
-            # Search for user matching the input
-            user = User.objects.get(
-                Q(id_number=login_input) | 
-                Q(email=login_input) | 
-                Q(phone_number=login_input)
-            )
+            # One unique index, picked by what the input looks like
+            user = logins.find_user(login_input)
             
-            # Check the hashed password
-            if check_password(password, user.password):
+            # Check the hashed password (on the hashing pool)
+            valid, outdated = hashing.verify(password, user.password)
+            if valid:
                 # Set session variables
                 request.session['user_id'] = user.id
                 request.session['user_type'] = user.user_type
                 request.session['user_name'] = f"{user.first_name} {user.last_name}"
                 
-                # Update last login
-                user.last_login = timezone.now()
-                user.save()
+                # Update last login (batched, in the background)
+                logins.record_login(user.id)
+                if outdated:
+                    logins.rehash_later(user.id, user.password, password)
                 
                 # Redirect based on user type
                 if user.user_type == 'passenger':
@@ -72,6 +85,9 @@ def login(request):
                 
         except User.DoesNotExist:
             form.add_error('username', 'Account not found with that Email, ID or Phone')
+        except hashing.HashingBusy:
+            form.add_error(None, 'Too many people are signing in right now, please try again in a moment')
+            return render(request, 'auth/login.html', {'form': form}, status=503)
 
     return render(request, 'auth/login.html', {'form': form})
 
@@ -172,18 +188,9 @@ def admin_dashboard(request):
     return render(request, 'admin/dashboard.html', context)
 
 # User Management Views
+@role_required('super_admin')
 def admin_manage_users(request):
     """Manage all users"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
-    
     # Get filter parameters
     user_type = request.GET.get('user_type', '')
     search = request.GET.get('search', '')
@@ -203,11 +210,12 @@ def admin_manage_users(request):
             Q(id_number__icontains=search)
         )
     
-    # Order by date joined
-    users = users.order_by('-date_joined')
+    # One page at a time, keyed on date joined
+    page = KeysetPaginator(users, '-date_joined').page(request.GET.get('cursor'), with_total=True)
     
     context = {
-        'users': users,
+        'users': page.object_list,
+        'page': page,
         'user_types': User.USER_TYPES,
         'selected_type': user_type,
         'search_query': search,
@@ -215,18 +223,9 @@ def admin_manage_users(request):
     
     return render(request, 'admin/manage_users.html', context)
 
+@role_required('super_admin')
 def admin_add_user(request):
     """Add new user (any type)"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
-    
     if request.method == 'POST':
         try:
             # Get form data
@@ -298,18 +297,10 @@ def admin_add_user(request):
     
     return render(request, 'admin/add_user.html', context)
 
+@role_required('super_admin')
 def admin_edit_user(request, user_id):
     """Edit user"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-        user = get_object_or_404(User, id=user_id)
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
+    user = get_object_or_404(User, id=user_id)
     
     if request.method == 'POST':
         try:
@@ -341,12 +332,16 @@ def admin_edit_user(request, user_id):
             user.phone_number = phone_number
             user.is_active = is_active
             
+            edited = ['user_type', 'first_name', 'last_name', 'email', 'phone_number', 'is_active']
+            
             # Update password if provided
             password = request.POST.get('password')
             if password:
-                user.set_password(password)
+                user.password = hashing.make_password(password)
+                edited.append('password')
             
-            user.save()
+            # Never credits: a top-up or booking since the row was read would be undone
+            user.save(update_fields=edited)
             
             # Update sacco admin if applicable
             if user_type == 'sacco_admin':
@@ -389,18 +384,10 @@ def admin_edit_user(request, user_id):
     
     return render(request, 'admin/edit_user.html', context)
 
+@role_required('super_admin')
 def admin_delete_user(request, user_id):
     """Delete user"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-        user = get_object_or_404(User, id=user_id)
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
+    user = get_object_or_404(User, id=user_id)
     
     if request.method == 'POST':
         try:
@@ -414,23 +401,14 @@ def admin_delete_user(request, user_id):
     return render(request, 'admin/delete_user.html', {'user': user})
 
 # Sacco Management Views
+@role_required('super_admin')
 def admin_manage_saccos(request):
     """Manage all saccos"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
-    
     # Get filter parameters
     search = request.GET.get('search', '')
     
     # Filter saccos
-    saccos = Sacco.objects.all()
+    saccos = Sacco.objects.select_related('admin').with_stats()
     
     if search:
         saccos = saccos.filter(
@@ -443,15 +421,6 @@ def admin_manage_saccos(request):
     # Order by date registered
     saccos = saccos.order_by('-date_registered')
     
-    # Get stats for each sacco
-    for sacco in saccos:
-        sacco.matatu_count = Matatu.objects.filter(sacco=sacco).count()
-        sacco.route_count = Route.objects.filter(sacco=sacco).count()
-        sacco.driver_count = User.objects.filter(
-            user_type='driver',
-            assigned_matatu_as_driver__sacco=sacco
-        ).distinct().count()
-    
     context = {
         'saccos': saccos,
         'search_query': search,
@@ -459,18 +428,9 @@ def admin_manage_saccos(request):
     
     return render(request, 'admin/manage_saccos.html', context)
 
+@role_required('super_admin')
 def admin_add_sacco(request):
     """Add new sacco"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
-    
     if request.method == 'POST':
         try:
             name = request.POST.get('name')
@@ -535,18 +495,10 @@ def admin_add_sacco(request):
     
     return render(request, 'admin/add_sacco.html', context)
 
+@role_required('super_admin')
 def admin_edit_sacco(request, sacco_id):
     """Edit sacco"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-        sacco = get_object_or_404(Sacco, id=sacco_id)
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
+    sacco = get_object_or_404(Sacco, id=sacco_id)
     
     if request.method == 'POST':
         try:
@@ -611,18 +563,10 @@ def admin_edit_sacco(request, sacco_id):
     
     return render(request, 'admin/edit_sacco.html', context)
 
+@role_required('super_admin')
 def admin_delete_sacco(request, sacco_id):
     """Delete sacco"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-        sacco = get_object_or_404(Sacco, id=sacco_id)
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
+    sacco = get_object_or_404(Sacco, id=sacco_id)
     
     if request.method == 'POST':
         try:
@@ -641,18 +585,9 @@ def admin_delete_sacco(request, sacco_id):
     return render(request, 'admin/delete_sacco.html', {'sacco': sacco})
 
 # Matatu Management Views
+@role_required('super_admin')
 def admin_manage_matatus(request):
     """Manage all matatus"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
-    
     # Get filter parameters
     sacco_id = request.GET.get('sacco', '')
     search = request.GET.get('search', '')
@@ -670,11 +605,12 @@ def admin_manage_matatus(request):
             Q(sacco__name__icontains=search)
         )
     
-    # Order by registration date
-    matatus = matatus.order_by('-registration_date')
+    # One page at a time, keyed on registration date
+    page = KeysetPaginator(matatus, '-registration_date').page(request.GET.get('cursor'), with_total=True)
     
     context = {
-        'matatus': matatus,
+        'matatus': page.object_list,
+        'page': page,
         'saccos': Sacco.objects.all(),
         'selected_sacco': sacco_id,
         'search_query': search,
@@ -682,18 +618,9 @@ def admin_manage_matatus(request):
     
     return render(request, 'admin/manage_matatus.html', context)
 
+@role_required('super_admin')
 def admin_add_matatu(request):
     """Add new matatu"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
-    
     if request.method == 'POST':
         try:
             plate_number = request.POST.get('plate_number')
@@ -774,18 +701,10 @@ def admin_add_matatu(request):
     
     return render(request, 'admin/add_matatu.html', context)
 
+@role_required('super_admin')
 def admin_edit_matatu(request, matatu_id):
     """Edit matatu"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-        matatu = get_object_or_404(Matatu, id=matatu_id)
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
+    matatu = get_object_or_404(Matatu, id=matatu_id)
     
     if request.method == 'POST':
         try:
@@ -865,18 +784,10 @@ def admin_edit_matatu(request, matatu_id):
     
     return render(request, 'admin/edit_matatu.html', context)
 
+@role_required('super_admin')
 def admin_delete_matatu(request, matatu_id):
     """Delete matatu"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-        matatu = get_object_or_404(Matatu, id=matatu_id)
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
+    matatu = get_object_or_404(Matatu, id=matatu_id)
     
     if request.method == 'POST':
         try:
@@ -890,24 +801,15 @@ def admin_delete_matatu(request, matatu_id):
     return render(request, 'admin/delete_matatu.html', {'matatu': matatu})
 
 # Route Management Views
+@role_required('super_admin')
 def admin_manage_routes(request):
     """Manage all routes"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
-    
     # Get filter parameters
     sacco_id = request.GET.get('sacco', '')
     search = request.GET.get('search', '')
     
     # Filter routes
-    routes = Route.objects.select_related('sacco')
+    routes = Route.objects.select_related('sacco').with_trip_stats()
     
     if sacco_id:
         routes = routes.filter(sacco_id=sacco_id)
@@ -922,11 +824,6 @@ def admin_manage_routes(request):
     # Order by name
     routes = routes.order_by('name')
     
-    # Get trip counts for each route
-    for route in routes:
-        route.trip_count = Trip.objects.filter(route=route).count()
-        route.active_trips = Trip.objects.filter(route=route, status='active').count()
-    
     context = {
         'routes': routes,
         'saccos': Sacco.objects.all(),
@@ -936,18 +833,9 @@ def admin_manage_routes(request):
     
     return render(request, 'admin/manage_routes.html', context)
 
+@role_required('super_admin')
 def admin_add_route(request):
     """Add new route"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
-    
     if request.method == 'POST':
         try:
             name = request.POST.get('name')
@@ -997,18 +885,10 @@ def admin_add_route(request):
     
     return render(request, 'admin/add_route.html', context)
 
+@role_required('super_admin')
 def admin_edit_route(request, route_id):
     """Edit route"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-        route = get_object_or_404(Route, id=route_id)
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
+    route = get_object_or_404(Route, id=route_id)
     
     if request.method == 'POST':
         try:
@@ -1061,18 +941,10 @@ def admin_edit_route(request, route_id):
     
     return render(request, 'admin/edit_route.html', context)
 
+@role_required('super_admin')
 def admin_delete_route(request, route_id):
     """Delete route"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-        route = get_object_or_404(Route, id=route_id)
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
+    route = get_object_or_404(Route, id=route_id)
     
     if request.method == 'POST':
         try:
@@ -1091,108 +963,86 @@ def admin_delete_route(request, route_id):
     return render(request, 'admin/delete_route.html', {'route': route})
 
 # Notification Management Views
+@role_required('super_admin')
 def admin_manage_notifications(request):
     """Manage all notifications"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
+    # One page at a time, keyed on creation time
+    page = KeysetPaginator(
+        Notification.objects.select_related('created_by'), '-created_at'
+    ).page(request.GET.get('cursor'))
     
-    # Get notifications
-    notifications = Notification.objects.select_related('created_by').order_by('-created_at')
+    # Who each one reaches right now, counted for the whole page at once
+    sizes = notifications.audience_sizes(page.object_list)
+    for notification in page.object_list:
+        notification.recipient_count = sizes[notification.pk]
     
     context = {
-        'notifications': notifications,
+        'notifications': page.object_list,
+        'page': page,
     }
     
     return render(request, 'admin/manage_notifications.html', context)
 
+@role_required('super_admin')
 def admin_add_notification(request):
     """Add new notification"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
-    
     if request.method == 'POST':
         try:
             title = request.POST.get('title')
             message = request.POST.get('message')
             notification_type = request.POST.get('notification_type')
-            recipient_type = request.POST.get('recipient_type')
+            recipient_type = request.POST.get('recipient_type') or request.POST.get('send_to')
             recipient_ids = request.POST.getlist('recipients')
-            sacco_ids = request.POST.getlist('saccos')
+            sacco_ids = request.POST.getlist('saccos') or request.POST.getlist('sacco_id')
+            custom_recipients = request.POST.get('custom_recipients', '')
             
             # Validate required fields
             if not all([title, message, notification_type, recipient_type]):
                 raise ValidationError('All required fields must be filled')
             
-            # Create notification
-            notification = Notification.objects.create(
-                title=title,
-                message=message,
-                notification_type=notification_type,
-                created_by=admin
-            )
+            # Broadcasts and segments are stored as audience rules; only
+            # hand-picked recipients are written out per user
+            user_type = notifications.USER_TYPE_SEGMENTS.get(recipient_type, '')
+            if user_type:
+                audience = 'user_type'
+            elif recipient_type in notifications.AUDIENCE_CHOICES:
+                audience = notifications.AUDIENCE_CHOICES[recipient_type]
+            else:
+                raise ValidationError(f'Unknown recipients "{recipient_type}"')
+            if audience == 'explicit':
+                identifiers = [value.strip() for value in custom_recipients.split(',') if value.strip()]
+                recipient_ids = recipient_ids + notifications.lookup_user_ids(identifiers)
             
-            # Add recipients based on type
-            if recipient_type == 'all':
-                # Send to all users
-                all_users = User.objects.filter(is_active=True)
-                notification.recipients.set(all_users)
-            elif recipient_type == 'specific':
-                # Send to specific users
-                if recipient_ids:
-                    recipients = User.objects.filter(id__in=recipient_ids, is_active=True)
-                    notification.recipients.set(recipients)
-            
-            # Add saccos if specified
-            if sacco_ids:
-                saccos = Sacco.objects.filter(id__in=sacco_ids)
-                notification.saccos.set(saccos)
+            try:
+                notifications.create(
+                    request.principal.id, title, message, notification_type,
+                    audience=audience,
+                    user_type=user_type,
+                    sacco_ids=[sacco_id for sacco_id in sacco_ids if sacco_id],
+                    recipient_ids=recipient_ids,
+                )
+            except ValueError as e:
+                raise ValidationError(str(e))
             
             messages.success(request, 'Notification created and sent successfully')
             return redirect('admin_manage_notifications')
             
         except ValidationError as e:
-            messages.error(request, str(e))
+            messages.error(request, ' '.join(e.messages))
         except Exception as e:
             messages.error(request, f'Error creating notification: {str(e)}')
     
-    # Get all users for recipient selection
-    all_users = User.objects.filter(is_active=True)
-    
     context = {
         'notification_types': Notification.NOTIFICATION_TYPES,
-        'all_users': all_users,
         'saccos': Sacco.objects.all(),
     }
     
     return render(request, 'admin/add_notification.html', context)
 
+@role_required('super_admin')
 def admin_edit_notification(request, notification_id):
     """Edit notification"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')  
-        
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-        notification = get_object_or_404(Notification, id=notification_id)
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
+    notification = get_object_or_404(Notification, id=notification_id)
     
     if request.method == 'POST':
         try:
@@ -1220,6 +1070,7 @@ def admin_edit_notification(request, notification_id):
         except Exception as e:
             messages.error(request, f'Error updating notification: {str(e)}')
     
+    notification.recipient_count = notifications.audience_size(notification)
     context = {
         'notification': notification,
         'notification_types': Notification.NOTIFICATION_TYPES,
@@ -1227,18 +1078,10 @@ def admin_edit_notification(request, notification_id):
     
     return render(request, 'admin/edit_notification.html', context)
 
+@role_required('super_admin')
 def admin_delete_notification(request, notification_id):
     """Delete notification"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-        notification = get_object_or_404(Notification, id=notification_id)
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
+    notification = get_object_or_404(Notification, id=notification_id)
     
     if request.method == 'POST':
         try:
@@ -1251,18 +1094,27 @@ def admin_delete_notification(request, notification_id):
     return render(request, 'admin/delete_notification.html', {'notification': notification})
 
 # Trip Management Views
-def admin_manage_trips(request):
-    """Manage all trips"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
+def filter_trips(trips, params):
+    """``trips`` narrowed by the admin listing's filters in ``params``"""
+    if params.get('status'):
+        trips = trips.filter(status=params['status'])
     
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
+    if params.get('sacco'):
+        trips = trips.filter(matatu__sacco_id=params['sacco'])
     
+    # Ranges rather than __date so the departure index applies
+    try:
+        if params.get('date_from'):
+            trips = trips.filter(scheduled_departure__gte=day_range(params['date_from'])[0])
+        if params.get('date_to'):
+            trips = trips.filter(scheduled_departure__lt=day_range(params['date_to'])[1])
+    except ValueError:
+        pass
+    return trips
+
+@role_required('super_admin')
+def admin_manage_trips(request):
+    """Manage all trips"""
     # Get filter parameters
     status = request.GET.get('status', '')
     sacco_id = request.GET.get('sacco', '')
@@ -1270,28 +1122,16 @@ def admin_manage_trips(request):
     date_to = request.GET.get('date_to', '')
     
     # Filter trips
-    trips = Trip.objects.select_related(
+    trips = filter_trips(Trip.objects.select_related(
         'matatu', 'matatu__sacco', 'route', 'driver', 'conductor'
-    ).order_by('-scheduled_departure')
-    
-    if status:
-        trips = trips.filter(status=status)
+    ).with_passenger_count(), request.GET)
     
-    if sacco_id:
-        trips = trips.filter(matatu__sacco_id=sacco_id)
-    
-    if date_from:
-        trips = trips.filter(scheduled_departure__date__gte=date_from)
-    
-    if date_to:
-        trips = trips.filter(scheduled_departure__date__lte=date_to)
-    
-    # Get passenger counts for each trip
-    for trip in trips:
-        trip.passenger_count = PassengerTrip.objects.filter(trip=trip).count()
+    # One page at a time, keyed on departure
+    page = KeysetPaginator(trips, '-scheduled_departure').page(request.GET.get('cursor'), with_total=True)
     
     context = {
-        'trips': trips,
+        'trips': page.object_list,
+        'page': page,
         'status_choices': Trip.TRIP_STATUS,
         'saccos': Sacco.objects.all(),
         'selected_status': status,
@@ -1302,19 +1142,35 @@ def admin_manage_trips(request):
     
     return render(request, 'admin/manage_trips.html', context)
 
+@role_required('super_admin')
+def admin_export_trips(request):
+    """Download the filtered trips as CSV or XLSX"""
+    trips = filter_trips(Trip.objects.all(), request.GET)
+    name = f'trips-{timezone.localdate():%Y%m%d}'
+    return exports.streaming_response(request.GET.get('format'), name, exports.TRIP_HEADER, exports.trip_rows(trips))
+
 # Payment Management Views
-def admin_manage_payments(request):
-    """Manage all payments"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
+def filter_payments(payments, params):
+    """``payments`` narrowed by the admin listing's filters in ``params``"""
+    if params.get('status'):
+        payments = payments.filter(status=params['status'])
     
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
+    if params.get('payment_type'):
+        payments = payments.filter(payment_type=params['payment_type'])
     
+    # Ranges rather than __date so the created_at indexes apply
+    try:
+        if params.get('date_from'):
+            payments = payments.filter(created_at__gte=day_range(params['date_from'])[0])
+        if params.get('date_to'):
+            payments = payments.filter(created_at__lt=day_range(params['date_to'])[1])
+    except ValueError:
+        pass
+    return payments
+
+@role_required('super_admin')
+def admin_manage_payments(request):
+    """Manage all payments"""
     # Get filter parameters
     status = request.GET.get('status', '')
     payment_type = request.GET.get('payment_type', '')
@@ -1322,26 +1178,17 @@ def admin_manage_payments(request):
     date_to = request.GET.get('date_to', '')
     
     # Filter payments
-    payments = Payment.objects.select_related('passenger').order_by('-created_at')
-    
-    if status:
-        payments = payments.filter(status=status)
+    payments = filter_payments(Payment.objects.select_related('passenger'), request.GET)
     
-    if payment_type:
-        payments = payments.filter(payment_type=payment_type)
+    # Totals for these filters, cached until a payment changes
+    total_amount, completed_amount = stats.payment_totals(payments)
     
-    if date_from:
-        payments = payments.filter(created_at__date__gte=date_from)
-    
-    if date_to:
-        payments = payments.filter(created_at__date__lte=date_to)
-    
-    # Calculate totals
-    total_amount = payments.aggregate(Sum('amount'))['amount__sum'] or 0
-    completed_amount = payments.filter(status='completed').aggregate(Sum('amount'))['amount__sum'] or 0
+    # One page at a time, keyed on creation time
+    page = KeysetPaginator(payments, '-created_at').page(request.GET.get('cursor'), with_total=True)
     
     context = {
-        'payments': payments,
+        'payments': page.object_list,
+        'page': page,
         'status_choices': Payment.STATUS_CHOICES,
         'payment_types': Payment.PAYMENT_TYPES,
         'selected_status': status,
@@ -1354,56 +1201,44 @@ def admin_manage_payments(request):
     
     return render(request, 'admin/manage_payments.html', context)
 
+@role_required('super_admin')
+def admin_export_payments(request):
+    """Download the filtered payments as CSV or XLSX"""
+    payments = filter_payments(Payment.objects.all(), request.GET)
+    name = f'payments-{timezone.localdate():%Y%m%d}'
+    return exports.streaming_response(request.GET.get('format'), name, exports.PAYMENT_HEADER, exports.payment_rows(payments))
+
 # Dashboard Statistics API
+@cached_json('super_admin', lambda user_id: ['stats'], per_user=False)
+@role_required('super_admin', api=True)
 def admin_dashboard_stats(request):
     """API endpoint for dashboard statistics"""
-    if 'user_id' not in request.session:
-        return JsonResponse({'success': False, 'message': 'Not authenticated'})
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-    except User.DoesNotExist:
-        return JsonResponse({'success': False, 'message': 'Access denied'})
-    
-    # Get stats for the last 7 days
-    from datetime import datetime, timedelta
-    
-    today = timezone.now().date()
+    # Stats for the last 7 days, read from the hourly rollups
+    today = timezone.localdate()
     last_week = today - timedelta(days=7)
     
-    # User registrations by day
     user_registrations = []
-    for i in range(7):
-        date = last_week + timedelta(days=i)
-        count = User.objects.filter(date_joined__date=date).count()
+    payment_stats = []
+    for date, totals in stats.daily_series(last_week, 7):
         user_registrations.append({
             'date': date.strftime('%Y-%m-%d'),
-            'count': count
+            'count': totals['registrations']
         })
-    
-    # Payment statistics by day
-    payment_stats = []
-    for i in range(7):
-        date = last_week + timedelta(days=i)
-        daily_payments = Payment.objects.filter(created_at__date=date, status='completed')
-        total = daily_payments.aggregate(Sum('amount'))['amount__sum'] or 0
-        count = daily_payments.count()
         payment_stats.append({
             'date': date.strftime('%Y-%m-%d'),
-            'total': float(total),
-            'count': count
+            'total': float(totals['total']),
+            'count': totals['count']
         })
     
-    # Active trips by status
-    active_trips = Trip.objects.filter(status='active').count()
-    scheduled_trips = Trip.objects.filter(status='scheduled').count()
-    completed_trips = Trip.objects.filter(status='completed').count()
+    # Trips by status
+    trip_counts = stats.trip_status_counts()
+    start_of_today = timezone.make_aware(datetime.combine(today, datetime.min.time()))
     
     # Recent activities
     recent_activities = []
     
     # Add user registrations
-    new_users = User.objects.filter(date_joined__date=today)[:5]
+    new_users = User.objects.filter(date_joined__gte=start_of_today)[:5]
     for user in new_users:
         recent_activities.append({
             'type': 'user_registration',
@@ -1414,7 +1249,9 @@ def admin_dashboard_stats(request):
         })
     
     # Add new payments
-    new_payments = Payment.objects.filter(created_at__date=today, status='completed')[:5]
+    new_payments = Payment.objects.filter(
+        created_at__gte=start_of_today, status='completed'
+    ).select_related('passenger').order_by('-created_at')[:5]
     for payment in new_payments:
         recent_activities.append({
             'type': 'payment',
@@ -1425,7 +1262,9 @@ def admin_dashboard_stats(request):
         })
     
     # Add new trips
-    new_trips = Trip.objects.filter(created_at__date=today)[:5]
+    new_trips = Trip.objects.filter(
+        created_at__gte=start_of_today
+    ).select_related('route', 'matatu').order_by('-created_at')[:5]
     for trip in new_trips:
         recent_activities.append({
             'type': 'trip',
@@ -1443,13 +1282,51 @@ def admin_dashboard_stats(request):
         'user_registrations': user_registrations,
         'payment_stats': payment_stats,
         'trip_stats': {
-            'active': active_trips,
-            'scheduled': scheduled_trips,
-            'completed': completed_trips
+            'active': trip_counts['active'],
+            'scheduled': trip_counts['scheduled'],
+            'completed': trip_counts['completed']
         },
         'recent_activities': recent_activities[:10]
     })
 
+@role_required('super_admin', api=True)
+def admin_hashing_metrics(request):
+    """API endpoint for this process's password hashing pool"""
+    return JsonResponse({'success': True, 'metrics': hashing.metrics()})
+
+@role_required('super_admin')
+def admin_import_data(request):
+    """Import users, matatus or routes from a CSV or XLSX file"""
+    report = None
+    if request.method == 'POST':
+        kind = request.POST.get('kind')
+        upload = request.FILES.get('file')
+        try:
+            if kind not in bulk_import.IMPORTERS:
+                raise ValueError('Choose what to import')
+            if not upload:
+                raise ValueError('Choose a file to import')
+            report = bulk_import.run(kind, upload.file, upload.name, dry_run=request.POST.get('dry_run') == 'on')
+        except ValueError as e:
+            messages.error(request, str(e))
+        except bulk_import.ImportStopped as e:
+            # Show what did go in, and what was rejected before it stopped
+            report = e.report
+            messages.error(request, f'Error importing {kind}: {str(e)}')
+        except Exception as e:
+            messages.error(request, f'Error importing {kind}: {str(e)}')
+        else:
+            if report.dry_run:
+                messages.info(request, f'{report.created} of {report.rows} rows would be imported')
+            else:
+                messages.success(request, f'{report.created} of {report.rows} rows imported')
+
+    context = {
+        'report': report,
+        'kinds': [(kind, importer.columns) for kind, importer in bulk_import.IMPORTERS.items()],
+    }
+    return render(request, 'admin/import_data.html', context)
+
 def forgot_password(request):
     if request.method == 'POST':
         form = ForgotPasswordForm(request.POST)
@@ -1469,18 +1346,10 @@ def logout(request):
     return redirect('login')
 
 # Dashboard view
+@role_required('passenger', login_message='Please login to access dashboard', denied_message='Passenger not found')
 def dashboard(request):
-    # Check if user is logged in via session
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login to access dashboard')
-        return redirect('login')
-    
-    user_id = request.session['user_id']
-    try:
-        user = User.objects.get(id=user_id, user_type='passenger')
-    except User.DoesNotExist:
-        messages.error(request, 'Passenger not found')
-        return redirect('login')
+    # The template and the inbox need the whole row
+    user = User.objects.get(id=request.principal.id)
     
     # Calculate greeting based on time
     current_hour = timezone.now().hour
@@ -1522,25 +1391,9 @@ def dashboard(request):
         passenger=user
     ).select_related('trip', 'trip__route').order_by('-alighted_at')[:10]
     
-    # Get notifications
-    unread_notifications = []
-    recent_notifications = []
-    
-    try:
-        # Get unread notifications
-        unread_notifications = Notification.objects.filter(
-            recipients=user,
-            created_at__gte=user.last_login or timezone.now() - timedelta(days=7)
-        ).exclude(
-            id__in=request.session.get('read_notifications', [])
-        )
-        
-        # Get recent notifications for dropdown
-        recent_notifications = Notification.objects.filter(
-            Q(recipients=user) | Q(recipients__isnull=True)
-        ).order_by('-created_at')[:10]
-    except:
-        pass  # If notifications model doesn't exist yet
+    # Get notifications: one query for the dropdown, unread count from cache
+    recent_notifications = inbox.notifications_for(user)[:10]
+    unread_count = inbox.unread_count(user)
     
     context = {
         'passenger': user,
@@ -1551,7 +1404,7 @@ def dashboard(request):
         'total_spent': total_spent,
         'popular_routes': popular_routes,
         'recent_trips': recent_trips,
-        'unread_notifications': unread_notifications,
+        'unread_count': unread_count,
         'recent_notifications': recent_notifications,
         'average_rating': 4.8,  # Default value
     }
@@ -1559,23 +1412,12 @@ def dashboard(request):
     return render(request, 'passenger/dashboard.html', context)
 
 # Other dashboard views
+@role_required('sacco_admin', login_message='Please login to access dashboard', denied_message='Access denied. Sacco admin only.')
 def sacco_dashboard(request):
     """Sacco Admin Dashboard"""
-    # Check if user is logged in and is a sacco admin
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login to access dashboard')
-        return redirect('login')
-    
-    user_id = request.session['user_id']
-    try:
-        user = User.objects.get(id=user_id, user_type='sacco_admin')
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied. Sacco admin only.')
-        return redirect('login')
-    
     # Get sacco associated with this admin
     try:
-        sacco = Sacco.objects.get(admin=user)
+        sacco = Sacco.objects.get(pk=request.principal.sacco_id)
     except Sacco.DoesNotExist:
         messages.error(request, 'No Sacco assigned to your account')
         return render(request, 'sacco/dashboard.html', {'sacco': None})
@@ -1602,20 +1444,9 @@ def sacco_dashboard(request):
     
     return render(request, 'sacco/dashboard.html', context)
 
+@role_required('super_admin', login_message='Please login to access dashboard', denied_message='Access denied. Super admin only.')
 def admin_dashboard(request):
     """Super Admin Dashboard"""
-    # Check if user is logged in and is a super admin
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login to access dashboard')
-        return redirect('login')
-    
-    user_id = request.session['user_id']
-    try:
-        user = User.objects.get(id=user_id, user_type='super_admin')
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied. Super admin only.')
-        return redirect('login')
-    
     # Admin statistics
     total_saccos = Sacco.objects.count()
     total_passengers = User.objects.filter(user_type='passenger').count()
@@ -1635,25 +1466,16 @@ def admin_dashboard(request):
     
     return render(request, 'admin/dashboard.html', context)
 
+@role_required('driver', login_message='Please login to access dashboard', denied_message='Access denied. Driver only.')
 def driver_dashboard(request):
     """Driver Dashboard"""
-    # Check if user is logged in and is a driver
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login to access dashboard')
-        return redirect('login')
-    
-    user_id = request.session['user_id']
-    try:
-        user = User.objects.get(id=user_id, user_type='driver')
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied. Driver only.')
-        return redirect('login')
+    user = request.principal
     
     # Get assigned matatu
     try:
-        matatu = Matatu.objects.filter(current_driver=user).first()
+        matatu = Matatu.objects.filter(current_driver_id=user.id).first()
         current_trip = Trip.objects.filter(
-            driver=user,
+            driver_id=user.id,
             status__in=['active', 'scheduled']
         ).order_by('-scheduled_departure').first()
     except:
@@ -1661,8 +1483,8 @@ def driver_dashboard(request):
         current_trip = None
     
     # Driver statistics
-    total_trips_driven = Trip.objects.filter(driver=user).count()
-    completed_trips = Trip.objects.filter(driver=user, status='completed').count()
+    total_trips_driven = Trip.objects.filter(driver_id=user.id).count()
+    completed_trips = Trip.objects.filter(driver_id=user.id, status='completed').count()
     
     context = {
         'driver': user,
@@ -1674,25 +1496,16 @@ def driver_dashboard(request):
     
     return render(request, 'driver/dashboard.html', context)
 
+@role_required('conductor', login_message='Please login to access dashboard', denied_message='Access denied. Conductor only.')
 def conductor_dashboard(request):
     """Conductor Dashboard"""
-    # Check if user is logged in and is a conductor
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login to access dashboard')
-        return redirect('login')
-    
-    user_id = request.session['user_id']
-    try:
-        user = User.objects.get(id=user_id, user_type='conductor')
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied. Conductor only.')
-        return redirect('login')
+    user = request.principal
     
     # Get assigned matatu
     try:
-        matatu = Matatu.objects.filter(current_conductor=user).first()
+        matatu = Matatu.objects.filter(current_conductor_id=user.id).first()
         current_trip = Trip.objects.filter(
-            conductor=user,
+            conductor_id=user.id,
             status__in=['active', 'scheduled']
         ).order_by('-scheduled_departure').first()
     except:
@@ -1700,14 +1513,15 @@ def conductor_dashboard(request):
         current_trip = None
     
     # Conductor statistics
-    total_trips_conducted = Trip.objects.filter(conductor=user).count()
+    total_trips_conducted = Trip.objects.filter(conductor_id=user.id).count()
     
     # Today's passengers
-    today = timezone.now().date()
+    day_start, day_end = day_range(timezone.localdate())
     todays_passengers = PassengerTrip.objects.filter(
-        trip__conductor=user,
-        trip__scheduled_departure__date=today
-    ).select_related('passenger').count()
+        trip__conductor_id=user.id,
+        trip__scheduled_departure__gte=day_start,
+        trip__scheduled_departure__lt=day_end
+    ).count()
     
     context = {
         'conductor': user,
@@ -1720,24 +1534,19 @@ def conductor_dashboard(request):
     return render(request, 'conductor/dashboard.html', context)
 
 # API Views
+@cached_json('passenger', lambda user_id: [passenger_scope(user_id), 'trips'])
+@role_required('passenger', api=True, denied_message='User not found')
 def dashboard_data_api(request):
     """API endpoint for dashboard data updates"""
-    # Check if user is logged in
-    if 'user_id' not in request.session:
-        return JsonResponse({'success': False, 'message': 'Not authenticated'})
-    
-    user_id = request.session['user_id']
-    try:
-        passenger = User.objects.get(id=user_id, user_type='passenger')
-    except User.DoesNotExist:
-        return JsonResponse({'success': False, 'message': 'User not found'})
+    passenger_id = request.principal.id
+    credits = User.objects.filter(id=passenger_id).values_list('credits', flat=True).first() or 0
     
     # Get updated stats
     stats = {
-        'total_trips': PassengerTrip.objects.filter(passenger=passenger).count(),
-        'wallet_balance': float(passenger.credits),
+        'total_trips': PassengerTrip.objects.filter(passenger_id=passenger_id).count(),
+        'wallet_balance': float(credits),
         'active_bookings': PassengerTrip.objects.filter(
-            passenger=passenger,
+            passenger_id=passenger_id,
             trip__status__in=['scheduled', 'active'],
             trip__scheduled_departure__gte=timezone.now()
         ).count(),
@@ -1753,13 +1562,8 @@ def search_routes_api(request):
     """API endpoint for route search"""
     query = request.GET.get('q', '')
     
-    routes = Route.objects.filter(
-        Q(name__icontains=query) |
-        Q(start_point__icontains=query) |
-        Q(end_point__icontains=query) |
-        Q(sacco__name__icontains=query),
-        is_active=True
-    ).select_related('sacco')[:10]
+    # Ranked: words starting with the query come before mid-word matches
+    routes = route_search.search(query, limit=10)
     
     route_list = []
     for route in routes:
@@ -1778,6 +1582,46 @@ def search_routes_api(request):
         'routes': route_list
     })
 
+def stop_suggest_api(request):
+    """API endpoint for stop name autocomplete"""
+    query = request.GET.get('q', '')
+    role = request.GET.get('role') or None
+    if role is not None and role not in STOP_ROLES:
+        return JsonResponse({'success': False, 'message': 'Invalid stop role'})
+    try:
+        limit = min(max(int(request.GET.get('limit', 10)), 1), 25)
+    except ValueError:
+        limit = 10
+    
+    return JsonResponse({
+        'success': True,
+        'stops': get_stop_index().suggest(query, role=role, limit=limit)
+    })
+
+def journey_plan_api(request):
+    """API endpoint for multi-leg journey planning"""
+    # Get filter parameters
+    origin = journeys.resolve_stop(request.GET.get('from', ''), 'start')
+    destination = journeys.resolve_stop(request.GET.get('to', ''), 'end')
+    weight = request.GET.get('optimise', 'time')
+    try:
+        k = min(max(int(request.GET.get('k', 3)), 1), 5)
+        max_transfers = min(max(int(request.GET.get('max_transfers', 1)), 0), 2)
+    except ValueError:
+        return JsonResponse({'success': False, 'message': 'Invalid number'})
+    
+    if not origin or not destination:
+        return JsonResponse({'success': False, 'message': 'Unknown stop'})
+    if weight not in journeys.WEIGHTS:
+        return JsonResponse({'success': False, 'message': 'Invalid optimise option'})
+    
+    return JsonResponse({
+        'success': True,
+        'from': origin,
+        'to': destination,
+        'journeys': journeys.plan(origin, destination, k=k, max_transfers=max_transfers, weight=weight)
+    })
+
 def route_details_api(request, route_id):
     """API endpoint for route details"""
     route = get_object_or_404(Route, id=route_id)
@@ -1787,15 +1631,18 @@ def route_details_api(request, route_id):
         route=route,
         scheduled_departure__gte=timezone.now(),
         status='scheduled'
-    ).select_related('matatu')[:5]
+    ).select_related('matatu', 'driver').order_by('scheduled_departure')[:5]
     
     trips_list = []
     for trip in upcoming_trips:
+        trip.route = route
         trips_list.append({
             'id': trip.id,
             'time': trip.scheduled_departure.strftime('%I:%M %p'),
             'matatu': trip.matatu.plate_number if trip.matatu else 'Not assigned',
-            'driver': trip.driver.get_full_name() if trip.driver else 'Not assigned'
+            'driver': trip.driver.get_full_name() if trip.driver else 'Not assigned',
+            'seats_available': trip.seats_available,
+            'eta': eta.arrival(trip)
         })
     
     return JsonResponse({
@@ -1807,11 +1654,14 @@ def route_details_api(request, route_id):
             'fare': float(route.standard_fare),
             'distance': float(route.distance_km) if route.distance_km else 0,
             'duration': route.estimated_duration_minutes,
+            # Expected duration leaving now, from past trips
+            'eta': eta.estimate(route),
             'description': f"{route.start_point} to {route.end_point}"
         },
         'upcoming_trips': trips_list
     })
 
+@idempotent
 def book_trip_api(request):
     """API endpoint to book a trip"""
     if request.method == 'POST':
@@ -1827,61 +1677,21 @@ def book_trip_api(request):
                     'message': 'Not authenticated'
                 })
             
-            user_id = request.session['user_id']
-            passenger = get_object_or_404(User, id=user_id, user_type='passenger')
-            
-            # Get trip
-            trip = get_object_or_404(Trip, id=trip_id, route_id=route_id)
-            
-            # Check if already booked
-            existing_booking = PassengerTrip.objects.filter(
-                passenger=passenger,
-                trip=trip
-            ).exists()
-            
-            if existing_booking:
+            if request.session.get('user_type') != 'passenger':
                 return JsonResponse({
                     'success': False,
-                    'message': 'You have already booked this trip'
+                    'message': 'Only passengers can book trips'
                 })
             
-            # Check wallet balance
-            if passenger.credits < trip.route.standard_fare:
+            # Debit, seat, booking and payment happen in one transaction
+            try:
+                booking = book_trip(request.session['user_id'], trip_id, route_id)
+            except BookingError as e:
                 return JsonResponse({
                     'success': False,
-                    'message': 'Insufficient wallet balance'
+                    'message': str(e)
                 })
             
-            # Create booking
-            booking = PassengerTrip.objects.create(
-                passenger=passenger,
-                trip=trip,
-                boarding_stop=trip.route.start_point,
-                alighting_stop=trip.route.end_point,
-                fare_paid=trip.route.standard_fare,
-                payment_method='credits',
-                is_paid=True
-            )
-            
-            # Deduct from wallet
-            passenger.credits -= booking.fare_paid
-            passenger.save()
-            
-            # Create payment record
-            try:
-                payment = Payment.objects.create(
-                    passenger=passenger,
-                    payment_type='trip',
-                    amount=booking.fare_paid,
-                    transaction_id=f"TRIP{booking.id:06d}",
-                    payment_method='credits',
-                    status='completed',
-                    description=f'Trip booking for {trip.route.name}',
-                    completed_at=timezone.now()
-                )
-            except:
-                pass  # If Payment model doesn't exist yet
-            
             return JsonResponse({
                 'success': True,
                 'booking_id': booking.id,
@@ -1896,20 +1706,186 @@ def book_trip_api(request):
     
     return JsonResponse({'success': False, 'message': 'Invalid request method'})
 
-def active_bookings_api(request):
-    """API endpoint for active bookings"""
-    # Check if user is logged in
+def cancel_booking_api(request, booking_id):
+    """API endpoint to cancel a booking and refund the fare"""
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'message': 'Invalid request method'})
+    
+    if request.session.get('user_type') != 'passenger':
+        return JsonResponse({'success': False, 'message': 'Not authenticated'})
+    
+    try:
+        booking = cancel_booking(request.session['user_id'], booking_id)
+    except BookingError as e:
+        return JsonResponse({'success': False, 'message': str(e)})
+    
+    return JsonResponse({
+        'success': True,
+        'refunded': float(booking.fare_paid) if booking.payment_method == 'credits' else 0,
+        'message': 'Booking cancelled'
+    })
+
+@role_required(api=True, denied_message='User not found')
+def notifications_api(request):
+    """API endpoint for the signed-in user's notification inbox"""
+    user = request.principal
+    page = inbox.page(user, request.GET.get('cursor'))
+    
+    return JsonResponse({
+        'success': True,
+        'notifications': [inbox.serialize(notification) for notification in page],
+        'next_cursor': page.next_cursor,
+        'previous_cursor': page.previous_cursor,
+        'unread_count': inbox.unread_count(user)
+    })
+
+@role_required(api=True, denied_message='User not found')
+def mark_notification_read_api(request, notification_id):
+    """API endpoint to mark one notification read"""
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'message': 'Invalid request method'})
+    
+    user = request.principal
+    if not inbox.mark_read(user, notification_id):
+        return JsonResponse({'success': False, 'message': 'Notification not found'})
+    
+    return JsonResponse({'success': True, 'unread_count': inbox.unread_count(user)})
+
+@role_required(api=True, denied_message='User not found')
+def mark_all_notifications_read_api(request):
+    """API endpoint to mark the whole inbox read"""
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'message': 'Invalid request method'})
+    
+    marked = inbox.mark_all_read(request.principal)
+    
+    return JsonResponse({'success': True, 'marked': marked, 'unread_count': 0})
+
+def telemetry_positions_api(request):
+    """API endpoint for batches of GPS fixes from driver devices"""
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'message': 'Invalid request method'})
+    
+    # Hot path: trust the session instead of loading the user
+    if request.session.get('user_type') not in ('driver', 'conductor'):
+        return JsonResponse({'success': False, 'message': 'Not authenticated'})
+    
+    try:
+        rows = json.loads(request.body)['positions']
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({'success': False, 'message': 'Invalid JSON data'})
+    
+    if not isinstance(rows, list) or len(rows) > telemetry.MAX_BATCH:
+        return JsonResponse({'success': False, 'message': f'Send a list of at most {telemetry.MAX_BATCH} positions'})
+    
+    # Keep the good fixes; a bad one should not cost the whole batch
+    allowed = telemetry.reporting_trip_ids(request.session['user_id'])
+    now = timezone.now()
+    fixes = []
+    rejected = 0
+    for row in rows:
+        try:
+            fix = telemetry.parse_fix(row, now)
+        except ValueError:
+            rejected += 1
+            continue
+        if fix.trip_id in allowed:
+            fixes.append(fix)
+        else:
+            rejected += 1
+    
+    telemetry.ingest(fixes)
+    
+    return JsonResponse({'success': True, 'accepted': len(fixes), 'rejected': rejected})
+
+def nearby_vehicles_api(request):
+    """API endpoint for active matatus near a point, nearest first"""
     if 'user_id' not in request.session:
         return JsonResponse({'success': False, 'message': 'Not authenticated'})
     
-    user_id = request.session['user_id']
+    # Get search parameters
     try:
-        passenger = User.objects.get(id=user_id, user_type='passenger')
+        lat = float(request.GET['lat'])
+        lng = float(request.GET['lng'])
+        radius_km = min(float(request.GET.get('radius_km', 2)), nearby.MAX_RADIUS_KM)
+        limit = min(int(request.GET.get('limit', 10)), nearby.MAX_RESULTS)
+        route_id = int(request.GET['route']) if request.GET.get('route') else None
+    except (KeyError, ValueError):
+        return JsonResponse({'success': False, 'message': 'Give lat and lng as numbers'})
+    
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180) or radius_km <= 0 or limit <= 0:
+        return JsonResponse({'success': False, 'message': 'Location or radius out of range'})
+    
+    found = nearby.find(lat, lng, radius_km, limit, route_id)
+    trips = Trip.objects.select_related('route', 'matatu').in_bulk([trip_id for _, trip_id, *_ in found])
+    
+    vehicles = []
+    for distance, trip_id, trip_lat, trip_lng, updated_at in found:
+        trip = trips.get(trip_id)
+        if trip is None:
+            continue
+        vehicles.append({
+            'trip_id': trip_id,
+            'route_id': trip.route_id,
+            'route_name': trip.route.name,
+            'plate_number': trip.matatu.plate_number,
+            'lat': trip_lat,
+            'lng': trip_lng,
+            'distance_km': round(distance, 3),
+            'updated_at': updated_at.isoformat(),
+        })
+    
+    return JsonResponse({'success': True, 'vehicles': vehicles})
+
+async def live_events(request):
+    """Server-Sent Events stream of live updates for the signed-in user"""
+    user_id = await request.session.aget('user_id')
+    if user_id is None:
+        return JsonResponse({'success': False, 'message': 'Not authenticated'})
+    
+    # Under WSGI the endless stream would be buffered; the pages fall back to polling
+    if not isinstance(request, ASGIRequest):
+        return JsonResponse({'success': False, 'message': 'Live updates need the ASGI server'})
+    
+    try:
+        user = await User.objects.aget(id=user_id)
     except User.DoesNotExist:
         return JsonResponse({'success': False, 'message': 'User not found'})
     
+    sacco_ids = {pk async for pk in notifications.member_sacco_ids(user).values_list('pk', flat=True)}
+    channels = live.channels_for(user, sacco_ids)
+    
+    # EventSource sends the last id it saw when it reconnects
+    try:
+        last_event_id = int(request.headers['Last-Event-ID'])
+    except (KeyError, ValueError):
+        last_event_id = None
+    
+    async def stream():
+        subscription = live.get_broker().subscribe(channels, last_event_id)
+        try:
+            yield f'retry: {live.RETRY_MS}\n\n'
+            while True:
+                message = await subscription.get(timeout=live.KEEPALIVE)
+                if message is None:
+                    # Comment line; keeps proxies from closing an idle stream
+                    yield ': keep-alive\n\n'
+                else:
+                    yield live.format_event(message)
+        finally:
+            subscription.close()
+    
+    response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+@cached_json('passenger', lambda user_id: [passenger_scope(user_id), 'trips', eta.SCOPE])
+@role_required('passenger', api=True, denied_message='User not found')
+def active_bookings_api(request):
+    """API endpoint for active bookings"""
     active_bookings = PassengerTrip.objects.filter(
-        passenger=passenger,
+        passenger_id=request.principal.id,
         trip__scheduled_departure__gte=timezone.now() - timedelta(hours=1),
         trip__status__in=['scheduled', 'active']
     ).select_related('trip', 'trip__route', 'trip__matatu', 'trip__driver')
@@ -1923,7 +1899,8 @@ def active_bookings_api(request):
             'driver': booking.trip.driver.get_full_name() if booking.trip.driver else 'Unknown',
             'status': booking.trip.status,
             'time': booking.trip.scheduled_departure.strftime('%I:%M %p'),
-            'seats_available': booking.trip.matatu.capacity - booking.trip.passengers.count() if booking.trip.matatu else 0
+            'seats_available': booking.trip.seats_available,
+            'eta': eta.arrival(booking.trip)
         })
     
     return JsonResponse({
@@ -1940,7 +1917,8 @@ def routes_list(request):
         return redirect('login')
     
     # Get all active routes
-    routes = Route.objects.filter(is_active=True).select_related('sacco').order_by('name')
+    routes = Route.objects.filter(is_active=True).select_related('sacco') \
+        .with_upcoming_trip_count().order_by('name')
     
     # Get filter parameters
     start_point = request.GET.get('start_point', '')
@@ -1951,9 +1929,9 @@ def routes_list(request):
     
     # Apply filters
     if start_point:
-        routes = routes.filter(start_point__icontains=start_point)
+        routes = route_search.filter_routes(routes, start_point, fields=['start'])
     if end_point:
-        routes = routes.filter(end_point__icontains=end_point)
+        routes = route_search.filter_routes(routes, end_point, fields=['end'])
     if sacco_id:
         routes = routes.filter(sacco_id=sacco_id)
     if min_fare:
@@ -1967,34 +1945,27 @@ def routes_list(request):
         except ValueError:
             pass
     
-    # Get passenger info for booking
+    # Get passenger info for booking; the header shows the wallet, so a
+    # signed-in passenger's row is loaded, and nobody else's
     passenger = None
-    if 'user_id' in request.session:
-        try:
-            passenger = User.objects.get(id=request.session['user_id'], user_type='passenger')
-        except User.DoesNotExist:
-            pass
+    principal = get_principal(request)
+    if principal is not None and principal.user_type == 'passenger':
+        passenger = User.objects.only('first_name', 'credits').filter(pk=principal.id).first()
     
     # Get all saccos for filter dropdown
     saccos = Sacco.objects.filter(is_active=True).order_by('name')
     
-    # Get unique start and end points for filter suggestions
-    start_points = Route.objects.filter(is_active=True).values_list('start_point', flat=True).distinct().order_by('start_point')[:20]
-    end_points = Route.objects.filter(is_active=True).values_list('end_point', flat=True).distinct().order_by('end_point')[:20]
-    
-    # Get upcoming trips count for each route
-    for route in routes:
-        route.upcoming_trips_count = Trip.objects.filter(
-            route=route,
-            scheduled_departure__gte=timezone.now(),
-            status='scheduled'
-        ).count()
+    # Stop suggestions come from the in-process stop dictionary; the
+    # datalists get the first 20 and /api/stops/suggest/ fills in as you type
+    stop_index = get_stop_index()
     
     context = {
         'routes': routes,
         'saccos': saccos,
-        'start_points': start_points,
-        'end_points': end_points,
+        'start_points': stop_index.stop_names('start', limit=20),
+        'end_points': stop_index.stop_names('end', limit=20),
+        'start_point_count': stop_index.count('start'),
+        'end_point_count': stop_index.count('end'),
         'start_point': start_point,
         'end_point': end_point,
         'sacco_id': sacco_id,
@@ -2006,22 +1977,11 @@ def routes_list(request):
     
     return render(request, 'passenger/routes_list.html', context)
 
+@role_required('passenger', login_message='Please login to access this page', denied_message='Passenger not found')
 def my_trips(request):
     """Display passenger's trip history"""
-    # Check if user is logged in
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login to access this page')
-        return redirect('login')
-    
-    user_id = request.session['user_id']
-    try:
-        passenger = User.objects.get(id=user_id, user_type='passenger')
-    except User.DoesNotExist:
-        messages.error(request, 'Passenger not found')
-        return redirect('login')
-    
     trips = PassengerTrip.objects.filter(
-        passenger=passenger
+        passenger_id=request.principal.id
     ).select_related('trip', 'trip__route', 'trip__matatu').order_by('-transaction_time')
     
     # Filter by date if provided
@@ -2058,7 +2018,7 @@ def top_up_wallet(request):
         
         # Validate amount
         try:
-            amount = float(amount)
+            amount = wallet.parse_amount(amount)
             if amount < 100:
                 messages.error(request, 'Minimum top-up amount is KES 100')
                 return redirect('top_up_wallet')
@@ -2066,33 +2026,15 @@ def top_up_wallet(request):
             messages.error(request, 'Invalid amount')
             return redirect('top_up_wallet')
         
-        user_id = request.session['user_id']
-        try:
-            passenger = User.objects.get(id=user_id, user_type='passenger')
-        except User.DoesNotExist:
+        principal = get_principal(request)
+        if principal is None or principal.user_type != 'passenger':
             messages.error(request, 'User not found')
             return redirect('login')
         
-        # Update wallet balance
-        passenger.credits += amount
-        passenger.save()
-        
-        # Create payment record
-        try:
-            payment = Payment.objects.create(
-                passenger=passenger,
-                payment_type='credit_topup',
-                amount=amount,
-                transaction_id=f"TOPUP{int(timezone.now().timestamp())}",
-                payment_method=payment_method,
-                status='completed',
-                description=f'Wallet top-up of KES {amount}',
-                completed_at=timezone.now()
-            )
-        except:
-            pass  # If Payment model doesn't exist yet
+        # The wallet is credited once the gateway confirms the payment
+        payments.start_top_up(principal.id, amount, payment_method)
         
-        messages.success(request, f'Successfully topped up KES {amount}')
+        messages.success(request, f'Top-up of KES {amount} requested, confirm it on your phone')
         return redirect('dashboard')
     
     return render(request, 'payments/top_up.html')
@@ -2111,22 +2053,35 @@ def quick_book(request):
         travel_date = request.POST.get('travel_date')
         
         # Find matching routes
-        routes = Route.objects.filter(
-            start_point__icontains=start_point,
-            end_point__icontains=end_point,
-            is_active=True
-        ).select_related('sacco')
+        routes = Route.objects.filter(is_active=True).select_related('sacco')
+        routes = route_search.filter_routes(routes, start_point, fields=['start'])
+        routes = route_search.filter_routes(routes, end_point, fields=['end'])
+        
+        # No direct route: suggest journeys with a change of matatu
+        journey_options = []
+        if start_point and end_point and not routes.exists():
+            origin = journeys.resolve_stop(start_point, 'start')
+            destination = journeys.resolve_stop(end_point, 'end')
+            if origin and destination:
+                journey_options = journeys.plan(origin, destination)
         
         # Find trips for the selected date
+        try:
+            day_start, day_end = day_range(travel_date)
+        except (TypeError, ValueError):
+            messages.error(request, 'Please pick a valid travel date')
+            return redirect('quick_book')
         trips = Trip.objects.filter(
             route__in=routes,
-            scheduled_departure__date=travel_date,
+            scheduled_departure__gte=day_start,
+            scheduled_departure__lt=day_end,
             status='scheduled'
         ).select_related('route', 'matatu', 'driver')
         
         context = {
             'routes': routes,
             'trips': trips,
+            'journeys': journey_options,
             'start_point': start_point,
             'end_point': end_point,
             'travel_date': travel_date,
@@ -2137,6 +2092,7 @@ def quick_book(request):
 
 
 
+@idempotent
 def process_payment(request):
     """Process payment for wallet top-up"""
     # Check if user is logged in
@@ -2150,45 +2106,29 @@ def process_payment(request):
             payment_method = data.get('payment_method')
             
             # Validate amount
-            if not amount or float(amount) < 100:
+            try:
+                amount = wallet.parse_amount(amount)
+            except ValueError:
+                amount = None
+            if not amount or amount < 100:
                 return JsonResponse({
                     'success': False, 
                     'message': 'Minimum top-up amount is KES 100'
                 })
             
-            user_id = request.session['user_id']
-            try:
-                passenger = User.objects.get(id=user_id, user_type='passenger')
-            except User.DoesNotExist:
+            principal = get_principal(request)
+            if principal is None or principal.user_type != 'passenger':
                 return JsonResponse({'success': False, 'message': 'User not found'})
             
-            # Simulate payment processing
-            # In a real app, you would integrate with M-Pesa, Stripe, etc.
-            amount_float = float(amount)
-            
-            # Update wallet balance
-            passenger.credits += amount_float
-            passenger.save()
-            
-            # Create payment record
-            try:
-                payment = Payment.objects.create(
-                    passenger=passenger,
-                    payment_type='credit_topup',
-                    amount=amount_float,
-                    transaction_id=f"PAY{int(timezone.now().timestamp())}",
-                    payment_method=payment_method,
-                    status='completed',
-                    description=f'Wallet top-up of KES {amount_float}',
-                    completed_at=timezone.now()
-                )
-            except:
-                pass  # If Payment model doesn't exist yet
+            # Sent to the gateway in the background; the result arrives
+            # on the live stream and from payment_status_api
+            payment = payments.start_top_up(principal.id, amount, payment_method)
             
             return JsonResponse({
                 'success': True,
-                'message': f'Successfully topped up KES {amount_float}',
-                'new_balance': float(passenger.credits)
+                'message': f'Top-up of KES {amount} requested, confirm it on your phone',
+                'transaction_id': payment.transaction_id,
+                'status': payment.status
             })
             
         except Exception as e:
@@ -2197,4 +2137,38 @@ def process_payment(request):
                 'message': f'Payment failed: {str(e)}'
             })
     
-    return JsonResponse({'success': False, 'message': 'Invalid request method'})
\ No newline at end of file
+    return JsonResponse({'success': False, 'message': 'Invalid request method'})
+
+def payment_status_api(request, transaction_id):
+    """API endpoint for the status of one of the passenger's payments"""
+    if 'user_id' not in request.session:
+        return JsonResponse({'success': False, 'message': 'Not authenticated'})
+    
+    payment = Payment.objects.filter(
+        passenger_id=request.session['user_id'], transaction_id=transaction_id
+    ).values('transaction_id', 'payment_type', 'amount', 'status', 'completed_at').first()
+    if payment is None:
+        return JsonResponse({'success': False, 'message': 'Payment not found'})
+    
+    payment['amount'] = float(payment['amount'])
+    return JsonResponse({'success': True, 'payment': payment})
+
+@csrf_exempt
+def payment_callback_api(request):
+    """Batches of payment results posted by the gateway"""
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'message': 'Invalid request method'})
+    
+    # No session here: the signature is the only credential
+    if not payments.valid_signature(request.body, request.headers.get(payments.SIGNATURE_HEADER)):
+        return JsonResponse({'success': False, 'message': 'Bad signature'}, status=403)
+    
+    try:
+        results = json.loads(request.body)['results']
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({'success': False, 'message': 'Invalid JSON data'}, status=400)
+    if not isinstance(results, list):
+        return JsonResponse({'success': False, 'message': 'Invalid JSON data'}, status=400)
+    
+    completed, failed = payments.apply_results(results)
+    return JsonResponse({'success': True, 'completed': completed, 'failed': failed})
\ No newline at end of file
@@ -0,0 +1,116 @@
+"""Passenger wallets.
+
+User.credits is the balance and WalletEntry the ledger behind it. Every
+change goes through credit() or debit(): one ``UPDATE ... SET credits =
+credits + amount`` (an F() expression, so concurrent top-ups and bookings
+never overwrite each other) and an entry recording the amount and the
+balance it left, in the same transaction. A debit only goes through while
+the balance covers it.
+
+Other writes to a User row must leave credits out of the UPDATE (save with
+update_fields), or they put back a balance read before the last change.
+Anything that bypasses these paths (raw SQL, the shell) shows up in
+``manage.py reconcile_wallets``, which checks every balance against the sum
+of its ledger; run it from cron.
+"""
+from decimal import Decimal, InvalidOperation
+
+from django.db import transaction
+from django.db.models import DecimalField, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+from . import live
+from .models import User, WalletEntry
+
+CENTS = Decimal('0.01')
+
+
+def parse_amount(value):
+    """A positive Decimal amount in shillings, or ValueError"""
+    try:
+        amount = Decimal(str(value)).quantize(CENTS)
+    except (InvalidOperation, ValueError, TypeError):
+        raise ValueError('Invalid amount')
+    if not amount.is_finite() or amount <= 0:
+        raise ValueError('Invalid amount')
+    return amount
+
+
+def credit(user_id, amount, kind, payment=None, description=''):
+    """Add ``amount`` to a passenger's wallet; returns the WalletEntry"""
+    return _apply(user_id, amount, kind, payment, description)
+
+
+def debit(user_id, amount, kind, payment=None, description=''):
+    """Take ``amount`` from a passenger's wallet.
+
+    Returns the WalletEntry, or None when the balance does not cover it.
+    """
+    return _apply(user_id, -amount, kind, payment, description)
+
+
+def _apply(user_id, amount, kind, payment, description):
+    with transaction.atomic():
+        wallets = User.objects.filter(pk=user_id, user_type='passenger')
+        if amount < 0:
+            wallets = wallets.filter(credits__gte=-amount)
+        if not wallets.update(credits=F('credits') + amount):
+            return None
+
+        # The UPDATE holds the row until commit, so this is our balance
+        balance = User.objects.filter(pk=user_id).values_list('credits', flat=True).get()
+        entry = WalletEntry.objects.create(
+            user_id=user_id,
+            kind=kind,
+            amount=amount,
+            balance_after=balance,
+            payment=payment,
+            description=description[:255],
+        )
+    # update() sends no signals, so announce the new balance here
+    live.wallet_changed(user_id, balance)
+    return entry
+
+
+def ledger_total():
+    """Sum of the wallet entries of the user row in the outer query"""
+    total = WalletEntry.objects.filter(user=OuterRef('pk')).order_by().values('user').annotate(
+        total=Sum('amount')
+    ).values('total')
+    output = DecimalField(max_digits=12, decimal_places=2)
+    return Coalesce(Subquery(total, output_field=output), Value(Decimal('0')), output_field=output)
+
+
+def drifted_wallets(users=None):
+    """(user id, balance, ledger total) for wallets that disagree with their ledger"""
+    users = User.objects.all() if users is None else users
+    return list(
+        users.annotate(ledger_total=ledger_total()).exclude(credits=F('ledger_total'))
+        .order_by('pk').values_list('pk', 'credits', 'ledger_total')
+    )
+
+
+def repair_wallets(users=None):
+    """Bring drifted balances back in line with the ledger.
+
+    The ledger is the record, so an edit that bypassed it is undone; a
+    deliberate correction belongs in an 'adjustment' entry instead. Returns
+    the (user id, balance, ledger total) triples that were repaired.
+    """
+    drifted = drifted_wallets(users)
+    if drifted:
+        with transaction.atomic():
+            # Recomputed in the UPDATE itself, so entries written since the
+            # check above are counted
+            User.objects.filter(pk__in=[pk for pk, _, _ in drifted]).update(credits=ledger_total())
+        for pk, _, _ in drifted:
+            live.wallet_changed(pk)
+    return drifted
+
+
+def open_wallet(user):
+    """Ledger entry for the balance a user was created with"""
+    if user.credits:
+        WalletEntry.objects.create(
+            user=user, kind='opening', amount=user.credits, balance_after=user.credits,
+        )